@@ -0,0 +1,156 @@
+"""Classes for acknowledging messages."""
+
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+BasicAck = Callable[[int, bool], None]
+CallLater = Callable[[float, Callable[[], None]], Any]
+
+
+@dataclass
+class AckCoalescerMetrics:
+    """Ack coalescer metrics."""
+
+    outstanding: int
+    completed: int
+    acknowledged: int
+    frames: int
+
+
+class AckCoalescer:
+    """Acknowledge messages on channel in batches.
+
+    Delivery tags are tracked when messages are delivered, and marked as
+    completed once processed. On flush, the longest range of completed delivery
+    tags, starting at the oldest outstanding one, is acknowledged with a single
+    frame (`multiple=True`). Completed delivery tags after a message that is
+    still being processed are acknowledged separately, so that a slow message
+    doesn't hold back others.
+
+    Flushes happen after the flush interval, or once the max amount of
+    completed messages is reached (usually the prefetch count, as the broker
+    stops delivering after that).
+
+    Not thread-safe: all methods must be called from the thread processing the
+    channel's I/O.
+    """
+
+    def __init__(
+        self,
+        basic_ack: BasicAck,
+        call_later: CallLater,
+        *,
+        flush_interval: float,
+        max_completed: int,
+    ) -> None:
+        """Set attributes."""
+        self.basic_ack = basic_ack
+        self.call_later = call_later
+        self.flush_interval = flush_interval
+        self.max_completed = max_completed
+
+        # Map outstanding delivery tags to whether they're completed. Delivery
+        # tags increase per channel, so this is ordered from oldest to newest.
+
+        self._outstanding: "OrderedDict[int, bool]" = OrderedDict()
+
+        self._completed = 0
+        self._flush_scheduled = False
+
+        self._acknowledged = 0
+        self._frames = 0
+
+    @property
+    def metrics(self) -> AckCoalescerMetrics:
+        """Get metrics."""
+        return AckCoalescerMetrics(
+            outstanding=len(self._outstanding),
+            completed=self._completed,
+            acknowledged=self._acknowledged,
+            frames=self._frames,
+        )
+
+    def track(self, delivery_tag: int) -> None:
+        """Track delivered message."""
+        self._outstanding[delivery_tag] = False
+
+    def forget(self, delivery_tag: int) -> None:
+        """Stop tracking message, e.g. when it's rejected."""
+        if self._outstanding.pop(delivery_tag, False):
+            self._completed -= 1
+
+    def complete(self, delivery_tag: int) -> None:
+        """Mark message as completed, so that it's acknowledged on next flush."""
+        if delivery_tag not in self._outstanding:
+            # Not tracked, so acknowledge directly
+
+            self._basic_ack(delivery_tag, False, 1)
+
+            return
+
+        self._outstanding[delivery_tag] = True
+
+        self._completed += 1
+
+        if self._completed >= self.max_completed:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+
+            self.call_later(self.flush_interval, self._on_timer)
+
+    def _on_timer(self) -> None:
+        """Flush on timer."""
+        self._flush_scheduled = False
+
+        self.flush()
+
+    def flush(self) -> None:
+        """Acknowledge completed messages."""
+        if not self._completed:
+            return
+
+        # Acknowledge range of completed messages, starting at the oldest
+        # outstanding one, in a single frame
+
+        last_delivery_tag = None
+        count = 0
+
+        while self._outstanding:
+            delivery_tag, completed = next(iter(self._outstanding.items()))
+
+            if not completed:
+                break
+
+            del self._outstanding[delivery_tag]
+
+            last_delivery_tag = delivery_tag
+            count += 1
+
+        if last_delivery_tag is not None:
+            self._basic_ack(last_delivery_tag, count > 1, count)
+
+        # Acknowledge completed messages after the range separately
+
+        for delivery_tag, completed in list(self._outstanding.items()):
+            if not completed:
+                continue
+
+            del self._outstanding[delivery_tag]
+
+            self._basic_ack(delivery_tag, False, 1)
+
+            count += 1
+
+        self._completed -= count
+
+    def _basic_ack(self, delivery_tag: int, multiple: bool, count: int) -> None:
+        """Send acknowledgement."""
+        self.basic_ack(delivery_tag, multiple)
+
+        self._acknowledged += count
+        self._frames += 1
@@ -0,0 +1,1220 @@
+"""Classes for consuming RPC requests on virtual host, using asyncio."""
+
+import asyncio
+import dataclasses
+import functools
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Union
+
+import pika
+import sdnotify
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.channel import Channel
+from pydantic import ValidationError
+
+from cyberfusion.RabbitMQConsumer.acknowledgement import AckCoalescer
+from cyberfusion.RabbitMQConsumer.config import (
+    Config,
+    Exchange,
+    VirtualHost,
+    get_added_exchanges,
+    get_exchange_limits,
+    get_queue_arguments,
+)
+from cyberfusion.RabbitMQConsumer.consumer import (
+    collect_component_metrics,
+    get_idempotency_store,
+    get_log_server_client,
+    reload_log_server_client,
+)
+from cyberfusion.RabbitMQConsumer.contracts import RPCResponseBase
+from cyberfusion.RabbitMQConsumer.dead_lettering import get_delivery_count
+from cyberfusion.RabbitMQConsumer.decryption import decrypt_body
+from cyberfusion.RabbitMQConsumer.exceptions import (
+    HandlerTimeoutError,
+    MalformedBodyError,
+)
+from cyberfusion.RabbitMQConsumer.idempotency import IdempotencyStore
+from cyberfusion.RabbitMQConsumer.locking import AsyncioLockManager
+from cyberfusion.RabbitMQConsumer.log_server_client import LogServerClient
+from cyberfusion.RabbitMQConsumer.metrics import (
+    PHASE_ACKNOWLEDGE,
+    PHASE_DECRYPT,
+    PHASE_DURATION,
+    PHASE_HANDLER,
+    PREFETCH_COUNT,
+    REASON_MALFORMED,
+    REASON_MAX_DELIVERIES,
+    REASON_UNPROCESSABLE,
+    REGISTRY,
+    RPC_REQUESTS_RECEIVED,
+    RPC_REQUESTS_REJECTED,
+    WORKERS_ACTIVE,
+)
+from cyberfusion.RabbitMQConsumer.prefetch import (
+    HandlerLatency,
+    get_memory_usage,
+    get_prefetch_controller,
+)
+from cyberfusion.RabbitMQConsumer.process_pool import HandlerProcessPool
+from cyberfusion.RabbitMQConsumer.processor import ProcessorBase
+from cyberfusion.RabbitMQConsumer.rabbitmq import ConfirmTracker, RabbitMQBase
+from cyberfusion.RabbitMQConsumer.registry import ExchangeHandler
+from cyberfusion.RabbitMQConsumer.reloading import reload_config
+from cyberfusion.RabbitMQConsumer.rpc_logging import LogBody, RPCRequestLoggerAdapter
+from cyberfusion.RabbitMQConsumer.scheduler import AsyncioPrioritySemaphore
+from cyberfusion.RabbitMQConsumer.serialization import get_loads
+from cyberfusion.RabbitMQConsumer.single_flight import SingleFlight
+from cyberfusion.RabbitMQConsumer.timeouts import TimeoutTracker
+from cyberfusion.RabbitMQConsumer.tracing import NULL_TRACE, TRACER, Trace
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioRabbitMQ(RabbitMQBase):
+    """Class to interact with RabbitMQ, using asyncio.
+
+    A single connection with a single channel is opened. All I/O is processed
+    on the event loop.
+    """
+
+    def __init__(self, virtual_host_name: str, config: Config) -> None:
+        """Set attributes."""
+        super().__init__(virtual_host_name, config)
+
+        self.connection: Optional[AsyncioConnection] = None
+        self.channel: Optional[Channel] = None
+
+        self._consumer_tag: Optional[str] = None
+        self._closing = False
+
+        self.ack_coalescer: Optional[AckCoalescer] = None
+
+        # Starts at the max amount of simultaneous requests. May be lowered by
+        # adaptive prefetch.
+
+        self.prefetch_count = self.virtual_host_config.max_simultaneous_requests
+
+        self.confirm_tracker: Optional[ConfirmTracker] = None
+
+        # Set when the connection or channel closes, to the reason
+
+        self.closed: "Optional[asyncio.Future[BaseException]]" = None
+
+        self._connection_closed: "Optional[asyncio.Future[None]]" = None
+
+    async def connect(self) -> None:
+        """Connect, open channel, and declare and bind queue and exchanges."""
+        loop = asyncio.get_running_loop()
+
+        self.closed = loop.create_future()
+        self._connection_closed = loop.create_future()
+
+        opened: "asyncio.Future[None]" = loop.create_future()
+
+        def on_open(_connection: AsyncioConnection) -> None:
+            opened.set_result(None)
+
+        def on_open_error(_connection: AsyncioConnection, error: BaseException) -> None:
+            opened.set_exception(
+                error
+                if isinstance(error, BaseException)
+                else pika.exceptions.AMQPConnectionError(error)
+            )
+
+        self.connection = AsyncioConnection(
+            self.get_connection_parameters(),
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_close,
+            custom_ioloop=loop,
+        )
+
+        await opened
+
+        self.channel = await self._call(
+            lambda callback: self._connection.channel(on_open_callback=callback)
+        )
+
+        self.channel.add_on_close_callback(self._on_close)
+
+        if self.virtual_host_config.confirm_delivery:
+            confirm_tracker = ConfirmTracker(self._count_publish)
+
+            await self._call(
+                lambda callback: self._channel.confirm_delivery(
+                    confirm_tracker.on_delivery_confirmation, callback=callback
+                )
+            )
+
+            self.channel.add_on_return_callback(confirm_tracker.on_return)
+
+            self.confirm_tracker = confirm_tracker
+
+        if self.virtual_host_config.ack_flush_interval is not None:
+            self.ack_coalescer = AckCoalescer(
+                lambda delivery_tag, multiple: self._channel.basic_ack(
+                    delivery_tag=delivery_tag, multiple=multiple
+                ),
+                loop.call_later,
+                flush_interval=self.virtual_host_config.ack_flush_interval,
+                max_completed=self.virtual_host_config.max_simultaneous_requests,
+            )
+
+        await self._declare_dead_letter_exchange()
+
+        await self._call(
+            lambda callback: self._channel.queue_declare(
+                queue=self.virtual_host_config.queue,
+                durable=True,
+                arguments=get_queue_arguments(self.virtual_host_config),
+                callback=callback,
+            )
+        )
+
+        await self._add_exchanges(self.virtual_host_config.exchanges)
+
+        await self._set_basic_qos()
+
+    async def _declare_dead_letter_exchange(self) -> None:
+        """Declare dead-letter exchange, and bind dead-letter queue, if set."""
+        dead_letter_exchange = self.virtual_host_config.dead_letter_exchange
+
+        if not dead_letter_exchange:
+            return
+
+        await self._call(
+            lambda callback: self._channel.exchange_declare(
+                exchange=dead_letter_exchange,
+                exchange_type="fanout",
+                durable=True,
+                callback=callback,
+            )
+        )
+
+        dead_letter_queue = self.virtual_host_config.dead_letter_queue
+
+        if not dead_letter_queue:
+            return
+
+        await self._call(
+            lambda callback: self._channel.queue_declare(
+                queue=dead_letter_queue, durable=True, callback=callback
+            )
+        )
+        await self._call(
+            lambda callback: self._channel.queue_bind(
+                queue=dead_letter_queue,
+                exchange=dead_letter_exchange,
+                callback=callback,
+            )
+        )
+
+    async def _add_exchanges(self, exchanges: List[Exchange]) -> None:
+        """Declare exchanges, and bind queue to them."""
+        for exchange in exchanges:
+            await self._call(
+                lambda callback: self._channel.exchange_declare(
+                    exchange=exchange.name,
+                    exchange_type=exchange.type,
+                    callback=callback,
+                )
+            )
+
+        for exchange in exchanges:
+            queue = self.virtual_host_config.queue
+
+            logger.info(
+                "Binding: exchange '%s', queue '%s', virtual host '%s'",
+                exchange.name,
+                queue,
+                self.virtual_host_name,
+            )
+
+            await self._call(
+                lambda callback: self._channel.queue_bind(
+                    queue=queue, exchange=exchange.name, callback=callback
+                )
+            )
+
+    async def _set_basic_qos(self) -> None:
+        """Set basic QoS for channel."""
+        await self._call(
+            lambda callback: self._channel.basic_qos(
+                prefetch_count=self.prefetch_count,
+                callback=callback,
+            )
+        )
+
+        if self.ack_coalescer:
+            self.ack_coalescer.max_completed = self.prefetch_count
+
+    async def set_prefetch_count(self, prefetch_count: int) -> None:
+        """Apply prefetch count to channel."""
+        self.prefetch_count = prefetch_count
+
+        await self._set_basic_qos()
+
+    async def reload(self, virtual_host_config: VirtualHost) -> None:
+        """Apply reloaded virtual host config.
+
+        Added exchanges are declared and bound, and the max amount of
+        simultaneous requests (prefetch count) is applied. Other changes
+        require reconnecting, so they're not applied.
+        """
+        added_exchanges = get_added_exchanges(
+            self.virtual_host_config, virtual_host_config
+        )
+
+        self.virtual_host_config: VirtualHost = dataclasses.replace(
+            self.virtual_host_config,
+            exchanges=self.virtual_host_config.exchanges + added_exchanges,
+            max_simultaneous_requests=virtual_host_config.max_simultaneous_requests,
+        )
+
+        await self._add_exchanges(added_exchanges)
+        await self.set_prefetch_count(virtual_host_config.max_simultaneous_requests)
+
+    @property
+    def _connection(self) -> AsyncioConnection:
+        """Get connection, which must be opened."""
+        if not self.connection:
+            raise RuntimeError("Not connected")
+
+        return self.connection
+
+    @property
+    def _channel(self) -> Channel:
+        """Get channel, which must be opened."""
+        if not self.channel:
+            raise RuntimeError("Not connected")
+
+        return self.channel
+
+    def _on_close(self, _connection_or_channel: Any, reason: BaseException) -> None:
+        """Set closed future, when connection or channel closes."""
+        if self.closed and not self.closed.done():
+            self.closed.set_result(reason)
+
+    def _on_connection_close(
+        self, connection: AsyncioConnection, reason: BaseException
+    ) -> None:
+        """Set closed futures, when connection closes."""
+        self._on_close(connection, reason)
+
+        if self._connection_closed and not self._connection_closed.done():
+            self._connection_closed.set_result(None)
+
+    async def _call(self, function: Callable[[Callable[..., None]], None]) -> Any:
+        """Call function with callback, and wait until callback is called.
+
+        Returns the first argument passed to the callback. Raises the reason if
+        the connection or channel closes while waiting.
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        def callback(*args: Any) -> None:
+            if not future.done():
+                future.set_result(args[0] if args else None)
+
+        function(callback)
+
+        if not self.closed:
+            return await future
+
+        await asyncio.wait({future, self.closed}, return_when=asyncio.FIRST_COMPLETED)
+
+        if not future.done():
+            future.cancel()
+
+            raise self.closed.result()
+
+        return future.result()
+
+    def start_consuming(
+        self,
+        on_message_callback: Callable[
+            [
+                Channel,
+                pika.spec.Basic.Deliver,
+                pika.spec.BasicProperties,
+                bytes,
+            ],
+            None,
+        ],
+    ) -> None:
+        """Consume on channel."""
+
+        def _on_message_callback(
+            channel: Channel,
+            method: pika.spec.Basic.Deliver,
+            properties: pika.spec.BasicProperties,
+            body: bytes,
+        ) -> None:
+            if self.ack_coalescer:
+                self.ack_coalescer.track(method.delivery_tag)
+
+            on_message_callback(channel, method, properties, body)
+
+        self._consumer_tag = self._channel.basic_consume(
+            queue=self.virtual_host_config.queue,
+            on_message_callback=_on_message_callback,
+        )
+
+    def publish(
+        self,
+        *,
+        exchange: str,
+        routing_key: str,
+        properties: pika.spec.BasicProperties,
+        body: bytes,
+    ) -> None:
+        """Publish message.
+
+        In confirm mode, the message is published as mandatory, and tracked
+        until the broker confirms it.
+        """
+        if not self.virtual_host_config.confirm_delivery:
+            self._channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                properties=properties,
+                body=body,
+            )
+
+            self._count_publish(published=1)
+
+            return
+
+        self._channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            properties=properties,
+            body=body,
+            mandatory=True,
+        )
+
+        if self.confirm_tracker:
+            self.confirm_tracker.track(properties.correlation_id)
+
+    def acknowledge(self, delivery_tag: int) -> None:
+        """Acknowledge message."""
+        if self.ack_coalescer:
+            self.ack_coalescer.complete(delivery_tag)
+
+            return
+
+        self._channel.basic_ack(delivery_tag=delivery_tag)
+
+    def reject(self, delivery_tag: int) -> None:
+        """Reject message.
+
+        The message is not requeued. It's dead-lettered, if a dead-letter
+        exchange is set.
+        """
+        if self.ack_coalescer:
+            self.ack_coalescer.forget(delivery_tag)
+
+        self._channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+
+    async def cancel_consumer(self) -> None:
+        """Stop receiving messages."""
+        if not self._consumer_tag or not self.channel or not self.channel.is_open:
+            return
+
+        consumer_tag = self._consumer_tag
+
+        await self._call(
+            lambda callback: self._channel.basic_cancel(consumer_tag, callback)
+        )
+
+        self._consumer_tag = None
+
+    def raise_for_exception(self) -> None:
+        """Raise reason that the connection or channel closed unexpectedly."""
+        if self._closing or not self.closed or not self.closed.done():
+            return
+
+        raise self.closed.result()
+
+    async def close(self) -> None:
+        """Close connection."""
+        self._closing = True
+
+        if not self.connection or not self._connection_closed:
+            return
+
+        if self.connection.is_open:
+            if self.ack_coalescer and self.channel and self.channel.is_open:
+                self.ack_coalescer.flush()
+
+                logger.info("Ack coalescer metrics: %s", self.ack_coalescer.metrics)
+
+            self.connection.close()
+
+        await self._connection_closed
+
+
+class AsyncioProcessor(ProcessorBase):
+    """Class to process RPC requests on the event loop, by passing to handler.
+
+    Async handlers are awaited. Sync handlers are run in the executor.
+
+    If the exchange is limited, a slot of its semaphore is taken once the lock
+    is held. So RPC requests waiting for a lock don't occupy the exchange's
+    limit, like with the keyed scheduler of the threaded engine.
+    """
+
+    def __init__(
+        self,
+        *,
+        exchange_handler: ExchangeHandler,
+        rabbitmq: AsyncioRabbitMQ,
+        method: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        lock_manager: AsyncioLockManager,
+        executor: ThreadPoolExecutor,
+        payload: Union[dict, bytes],
+        log_server_client: Optional[LogServerClient],
+        decrypted_values: List[str],
+        process_pool: Optional[HandlerProcessPool] = None,
+        timeout: Optional[float] = None,
+        timeout_tracker: Optional[TimeoutTracker] = None,
+        trace: Trace = NULL_TRACE,
+        idempotency_store: Optional[IdempotencyStore] = None,
+        single_flight: Optional[SingleFlight[ProcessorBase]] = None,
+        semaphore: Optional[AsyncioPrioritySemaphore] = None,
+    ) -> None:
+        """Set attributes."""
+        self.rabbitmq: AsyncioRabbitMQ = rabbitmq
+        self.lock_manager = lock_manager
+        self.executor = executor
+        self.semaphore = semaphore
+
+        super().__init__(
+            exchange_handler=exchange_handler,
+            rabbitmq=rabbitmq,
+            method=method,
+            properties=properties,
+            payload=payload,
+            log_server_client=log_server_client,
+            decrypted_values=decrypted_values,
+            process_pool=process_pool,
+            timeout=timeout,
+            timeout_tracker=timeout_tracker,
+            trace=trace,
+            idempotency_store=idempotency_store,
+            single_flight=single_flight,
+        )
+
+    async def __call__(self) -> None:
+        """Process message."""
+        self._start()
+
+        await self._acquire_lock()
+
+        try:
+            await self._acquire_slot()
+        except BaseException:
+            # Don't keep the lock when cancelled while waiting for a slot
+
+            self._release_lock()
+
+            raise
+
+        try:
+            if self._replay_response():
+                return
+
+            self._log_rpc_request()
+
+            if not self.mock:
+                result = self._get_cached_result()
+
+                if result is None:
+                    self.logger.info("Calling RPC handler...")
+
+                    with self._phase(PHASE_HANDLER):
+                        result = await self._call_handler()
+
+                    self.logger.info("Called RPC handler")
+
+                    self._cache_result(result)
+            else:
+                result = self._get_mock_response()
+
+            self._publish_result(result)
+        except HandlerTimeoutError:
+            self._handle_timeout()
+        except Exception:
+            self._handle_exception()
+        finally:
+            followers = self.complete_single_flight()
+
+            # Release the lock before acknowledgement, like the threaded processor
+
+            self._release_slot()
+            self._release_lock()
+
+            with self._phase(PHASE_ACKNOWLEDGE):
+                self._acknowledge()
+
+            self._finish()
+
+            for follower in followers:
+                follower._follow(self)
+
+    async def _call_handler(self) -> RPCResponseBase:
+        """Call handler, in process pool if set, with timeout if set.
+
+        On timeout, async handlers are cancelled. Sync handlers can't be, so
+        they keep occupying an executor thread until they return.
+        """
+        loop = asyncio.get_running_loop()
+
+        if self.process_pool:
+            return await loop.run_in_executor(
+                self.executor,
+                functools.partial(
+                    self.process_pool.call, self.request, timeout=self.timeout
+                ),
+            )
+
+        if self.exchange_handler.is_async:
+            awaitable = self.handler(self.request)
+        else:
+            awaitable = loop.run_in_executor(self.executor, self.handler, self.request)
+
+        if self.timeout is None:
+            return await awaitable
+
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise HandlerTimeoutError
+
+    async def _acquire_lock(self) -> None:
+        """Acquire lock."""
+        self.logger.debug("Acquiring lock...")
+
+        await self.lock_manager.acquire(self.lock_key)
+
+        wait_time = self._observe_lock_wait()
+
+        self.logger.info("Acquired lock (waited %.3fs)", wait_time)
+
+    async def _acquire_slot(self) -> None:
+        """Acquire slot of exchange's limit, if limited."""
+        if not self.semaphore:
+            return
+
+        await self.semaphore.acquire(priority=self.properties.priority or 0)
+
+    def _release_slot(self) -> None:
+        """Release slot of exchange's limit, if limited."""
+        if not self.semaphore:
+            return
+
+        self.semaphore.release()
+
+    def _release_lock(self) -> None:
+        """Release lock."""
+        self.logger.debug("Releasing lock...")
+
+        self.lock_manager.release(self.lock_key)
+
+        self.logger.debug("Released lock")
+
+    def _basic_publish(self, *, properties: pika.BasicProperties, body: bytes) -> None:
+        """Publish RPC response to reply queue.
+
+        As this runs on the event loop, no cross-thread callback is needed.
+        """
+        self.rabbitmq.publish(
+            exchange=self.method.exchange,
+            routing_key=self.properties.reply_to,
+            properties=properties,
+            body=body,
+        )
+
+    def _acknowledge(self) -> None:
+        """Acknowledge message."""
+        self.rabbitmq.acknowledge(self.method.delivery_tag)
+
+
+class AsyncioConsumer:
+    """Consume RPC requests on virtual host, using asyncio.
+
+    Every RPC request is processed in its own task. The amount of tasks is
+    limited by the max amount of simultaneous requests (prefetch count).
+    """
+
+    def __init__(
+        self,
+        virtual_host_name: str,
+        config: Config,
+        exchange_handlers: Dict[str, ExchangeHandler],
+        process_pools: Dict[str, HandlerProcessPool],
+    ) -> None:
+        """Set attributes."""
+        self.config = config
+        self.exchange_handlers = exchange_handlers
+        self.process_pools = process_pools
+
+        self.rabbitmq = AsyncioRabbitMQ(virtual_host_name, config)
+
+        self.lock_manager = AsyncioLockManager()
+
+        # Sync handlers are run in threads, so that they don't block the event
+        # loop
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.rabbitmq.virtual_host_config.max_simultaneous_requests,
+            thread_name_prefix=f"Worker-{virtual_host_name}",
+        )
+
+        self.log_server_config = config.log_server
+        self.log_server_client = get_log_server_client(config, self.rabbitmq)
+
+        self.idempotency_store = get_idempotency_store(config)
+
+        self.body_max_size = config.logging.body_max_size
+
+        self.timeout_tracker = TimeoutTracker()
+        self.timeouts = {
+            exchange.name: exchange.timeout
+            for exchange in self.rabbitmq.virtual_host_config.exchanges
+        }
+
+        # Identical RPC requests are coalesced on exchanges with single-flight
+        # enabled
+
+        self.single_flight: SingleFlight[ProcessorBase] = SingleFlight()
+        self.single_flight_exchanges = {
+            exchange.name
+            for exchange in self.rabbitmq.virtual_host_config.exchanges
+            if exchange.single_flight
+        }
+
+        # Exchanges with a max amount of simultaneous requests have a semaphore.
+        # RPC requests waiting for it are run in order of priority.
+
+        self.semaphores = {
+            exchange_name: AsyncioPrioritySemaphore(limit)
+            for exchange_name, limit in get_exchange_limits(
+                self.rabbitmq.virtual_host_config
+            ).items()
+        }
+
+        # Prefetch count is adjusted to load, if adaptive prefetch is enabled
+
+        self.adaptive_prefetch = self.rabbitmq.virtual_host_config.adaptive_prefetch
+        self.prefetch_controller = get_prefetch_controller(
+            self.adaptive_prefetch,
+            self.rabbitmq.virtual_host_config.max_simultaneous_requests,
+        )
+        self.handler_latency = HandlerLatency(
+            self.rabbitmq.virtual_host_name,
+            [exchange.name for exchange in self.rabbitmq.virtual_host_config.exchanges],
+        )
+        self._prefetch_adjuster: "Optional[asyncio.Task[None]]" = None
+
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+        REGISTRY.add_collector(self.collect_metrics)
+
+    def collect_metrics(self) -> None:
+        """Update metrics that reflect current state."""
+        labels = {"virtual_host": self.rabbitmq.virtual_host_name}
+
+        WORKERS_ACTIVE.set(len(self._tasks), **labels)
+        PREFETCH_COUNT.set(self.rabbitmq.prefetch_count, **labels)
+
+        collect_component_metrics(
+            self.rabbitmq,
+            exchange_handlers=self.exchange_handlers,
+            lock_manager=self.lock_manager,
+            timeout_tracker=self.timeout_tracker,
+            log_server_client=self.log_server_client,
+            idempotency_store=self.idempotency_store,
+        )
+
+    async def start_consuming(self) -> None:
+        """Connect, and start consuming."""
+        await self.rabbitmq.connect()
+
+        self.rabbitmq.start_consuming(self.callback)
+
+        if self.prefetch_controller:
+            self._prefetch_adjuster = asyncio.get_running_loop().create_task(
+                self._adjust_prefetch_periodically()
+            )
+
+    async def _adjust_prefetch_periodically(self) -> None:
+        """Adjust prefetch count every interval, until cancelled."""
+        assert self.adaptive_prefetch
+
+        while True:
+            await asyncio.sleep(self.adaptive_prefetch.interval)
+
+            try:
+                await self.adjust_prefetch()
+            except Exception:
+                logger.exception("Exception adjusting prefetch count")
+
+    async def adjust_prefetch(self) -> None:
+        """Adjust prefetch count to load, if adaptive prefetch is enabled."""
+        if not self.prefetch_controller:
+            return
+
+        # Like the threaded consumer, count RPC requests waiting for a lock or
+        # an exchange's limit
+
+        waiting = self.lock_manager.metrics.waiting + sum(
+            semaphore.waiting for semaphore in self.semaphores.values()
+        )
+
+        prefetch_count = self.prefetch_controller.adjust(
+            latency=self.handler_latency.sample(),
+            saturation=len(self._tasks) / self.rabbitmq.prefetch_count,
+            waiting=waiting,
+            memory=get_memory_usage(),
+        )
+
+        if prefetch_count == self.rabbitmq.prefetch_count:
+            return
+
+        logger.info(
+            "Adjusting prefetch count for virtual host '%s' from %s to %s",
+            self.rabbitmq.virtual_host_name,
+            self.rabbitmq.prefetch_count,
+            prefetch_count,
+        )
+
+        await self.rabbitmq.set_prefetch_count(prefetch_count)
+
+    async def reload(self, virtual_host_config: VirtualHost) -> None:
+        """Apply reloaded config, without interrupting RPC requests being processed.
+
+        Like the threaded consumer, applies the max amount of simultaneous
+        requests, log server config, and exchanges that were added.
+        """
+        logger.info(
+            "Applying reloaded config for virtual host '%s'...",
+            self.rabbitmq.virtual_host_name,
+        )
+
+        loop = asyncio.get_running_loop()
+
+        for exchange in get_added_exchanges(
+            self.rabbitmq.virtual_host_config, virtual_host_config
+        ):
+            self.timeouts[exchange.name] = exchange.timeout
+
+            if exchange.single_flight:
+                self.single_flight_exchanges.add(exchange.name)
+
+            if exchange.max_simultaneous_requests is not None:
+                self.semaphores[exchange.name] = AsyncioPrioritySemaphore(
+                    exchange.max_simultaneous_requests
+                )
+
+            self.handler_latency.add_exchange(exchange.name)
+
+        max_simultaneous_requests = (
+            self.rabbitmq.virtual_host_config.max_simultaneous_requests
+        )
+
+        # The prefetch count is reset to the max amount of simultaneous
+        # requests. Adaptive prefetch lowers it again, if still overloaded.
+
+        await self.rabbitmq.reload(virtual_host_config)
+
+        if self.prefetch_controller:
+            self.prefetch_controller.set_max_prefetch_count(
+                virtual_host_config.max_simultaneous_requests
+            )
+
+        # Replace the executor when its size changed. Handlers running in the
+        # old executor finish, as it's shut down without waiting.
+
+        if (
+            self.rabbitmq.virtual_host_config.max_simultaneous_requests
+            != max_simultaneous_requests
+        ):
+            executor = self.executor
+
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.rabbitmq.virtual_host_config.max_simultaneous_requests,
+                thread_name_prefix=f"Worker-{self.rabbitmq.virtual_host_name}",
+            )
+
+            executor.shutdown(wait=False)
+
+        log_server_client = self.log_server_client
+
+        self.log_server_client = reload_log_server_client(
+            log_server_client, self.log_server_config, self.config, self.rabbitmq
+        )
+        self.log_server_config = self.config.log_server
+
+        if log_server_client and log_server_client is not self.log_server_client:
+            await loop.run_in_executor(None, log_server_client.close)
+
+    async def cancel(self) -> None:
+        """Stop receiving messages."""
+        logger.info(
+            "Cancelling consumer for virtual host '%s'...",
+            self.rabbitmq.virtual_host_name,
+        )
+
+        await self.rabbitmq.cancel_consumer()
+
+    async def drain(self) -> None:
+        """Wait for RPC requests being processed, and ship log server records."""
+        logger.info(
+            "Waiting for %s RPC requests on virtual host '%s' to finish...",
+            len(self._tasks),
+            self.rabbitmq.virtual_host_name,
+        )
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        logger.info("Lock manager metrics: %s", self.lock_manager.metrics)
+        logger.info("Timeout tracker metrics: %s", self.timeout_tracker.metrics)
+
+        # Wait in the default executor, so that the event loop keeps processing
+        # I/O
+
+        loop = asyncio.get_running_loop()
+
+        await loop.run_in_executor(None, self.executor.shutdown)
+
+        if self.log_server_client:
+            await loop.run_in_executor(None, self.log_server_client.close)
+
+            logger.info("Log server client metrics: %s", self.log_server_client.metrics)
+
+    async def close(self) -> None:
+        """Close connection."""
+        logger.info(
+            "Closing connection for virtual host '%s'...",
+            self.rabbitmq.virtual_host_name,
+        )
+
+        if self._prefetch_adjuster:
+            self._prefetch_adjuster.cancel()
+
+        await self.rabbitmq.close()
+
+        self.executor.shutdown(wait=False)
+
+        REGISTRY.remove_collector(self.collect_metrics)
+
+        logger.info("Publish metrics: %s", self.rabbitmq.publish_metrics)
+
+        if self.rabbitmq.decryptor:
+            logger.info("Decryption metrics: %s", self.rabbitmq.decryptor.metrics)
+
+        if self.idempotency_store:
+            self.idempotency_store.close()
+
+            logger.info("Idempotency store metrics: %s", self.idempotency_store.metrics)
+
+        if self.prefetch_controller:
+            logger.info(
+                "Prefetch controller metrics: %s", self.prefetch_controller.metrics
+            )
+
+    def callback(
+        self,
+        channel: Channel,
+        method: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        body: bytes,
+    ) -> None:
+        """Pass RabbitMQ message to processor, in task."""
+        task = asyncio.get_running_loop().create_task(
+            self.process(channel, method, properties, body)
+        )
+
+        # Keep reference to task, so that it isn't garbage collected, and can be
+        # waited for when draining
+
+        self._tasks.add(task)
+
+        task.add_done_callback(self._tasks.discard)
+
+    def _reject(
+        self, method: pika.spec.Basic.Deliver, trace: Trace, reason: str
+    ) -> None:
+        """Reject message that can't be processed, so that it's not redelivered.
+
+        The message is dead-lettered, if a dead-letter exchange is set.
+        """
+        RPC_REQUESTS_REJECTED.inc(
+            virtual_host=self.rabbitmq.virtual_host_name,
+            exchange=method.exchange,
+            reason=reason,
+        )
+
+        trace.set_attribute("rpc.rejected", reason)
+        trace.set_error()
+        trace.finish()
+
+        self.rabbitmq.reject(method.delivery_tag)
+
+    async def process(
+        self,
+        channel: Channel,
+        method: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        body: bytes,
+    ) -> None:
+        """Process RabbitMQ message."""
+
+        request_logger = RPCRequestLoggerAdapter(
+            logger, method.exchange, properties.correlation_id
+        )
+
+        RPC_REQUESTS_RECEIVED.inc(
+            virtual_host=self.rabbitmq.virtual_host_name, exchange=method.exchange
+        )
+
+        # Trace RPC request, if sampled. The trace is finished by the processor.
+
+        trace = TRACER.start_trace(
+            properties.correlation_id,
+            {
+                "rpc.virtual_host": self.rabbitmq.virtual_host_name,
+                "rpc.exchange": method.exchange,
+                "rpc.redelivered": method.redelivered,
+            },
+        )
+
+        # Reject messages that were delivered too often, e.g. because processing
+        # them crashed the RabbitMQ consumer
+
+        max_deliveries = self.rabbitmq.virtual_host_config.max_deliveries
+
+        if (
+            max_deliveries is not None
+            and get_delivery_count(properties) >= max_deliveries
+        ):
+            request_logger.warning(
+                "Message delivered %s times or more, rejecting", max_deliveries
+            )
+
+            self._reject(method, trace, REASON_MAX_DELIVERIES)
+
+            return
+
+        # Decrypt message, log it, and run processor. Messages that can't be
+        # decoded or validated are rejected, so that they're not redelivered.
+
+        try:
+            # If Fernet key is set, decrypt values opportunistically
+
+            with (
+                PHASE_DURATION.time(
+                    virtual_host=self.rabbitmq.virtual_host_name,
+                    exchange=method.exchange,
+                    phase=PHASE_DECRYPT,
+                ),
+                trace.span(PHASE_DECRYPT),
+            ):
+                payload, decrypted_values = decrypt_body(
+                    self.rabbitmq.decryptor, body, get_loads(self.config.json_backend)
+                )
+
+            # Log message. Decrypted values are redacted, rather than logging
+            # their ciphertext.
+
+            request_logger.info(
+                "Received RPC request. Body: '%s'",
+                LogBody(
+                    payload,
+                    max_size=self.body_max_size,
+                    decrypted_values=decrypted_values,
+                ),
+            )
+
+            # Run processor
+
+            processor = AsyncioProcessor(
+                exchange_handler=self.exchange_handlers[method.exchange],
+                rabbitmq=self.rabbitmq,
+                method=method,
+                properties=properties,
+                lock_manager=self.lock_manager,
+                executor=self.executor,
+                payload=payload,
+                log_server_client=self.log_server_client,
+                decrypted_values=decrypted_values,
+                process_pool=self.process_pools.get(method.exchange),
+                timeout=self.timeouts.get(method.exchange),
+                timeout_tracker=self.timeout_tracker,
+                trace=trace,
+                idempotency_store=self.idempotency_store,
+                single_flight=(
+                    self.single_flight
+                    if method.exchange in self.single_flight_exchanges
+                    else None
+                ),
+                semaphore=self.semaphores.get(method.exchange),
+            )
+        except ValidationError:
+            # A validation error RPC response was published
+
+            request_logger.info("Request validation failed")
+
+            self.rabbitmq.acknowledge(method.delivery_tag)
+
+            trace.finish()
+
+            return
+        except MalformedBodyError:
+            request_logger.warning("Body is not a valid JSON object, rejecting")
+
+            self._reject(method, trace, REASON_MALFORMED)
+
+            return
+        except Exception:
+            request_logger.exception("Exception preparing processor, rejecting")
+
+            self._reject(method, trace, REASON_UNPROCESSABLE)
+
+            return
+
+        if processor.join_single_flight():
+            return
+
+        await processor()
+
+
+async def reload(
+    config: Config,
+    consumers: List[AsyncioConsumer],
+    exchange_handlers: Dict[str, ExchangeHandler],
+    process_pools: Dict[str, HandlerProcessPool],
+) -> None:
+    """Reload config, and apply it to consumers."""
+    try:
+        # Importing handler modules and starting process pools blocks, so do it
+        # in the default executor
+
+        snapshot = await asyncio.get_running_loop().run_in_executor(
+            None,
+            reload_config,
+            config,
+            [consumer.rabbitmq.virtual_host_name for consumer in consumers],
+            exchange_handlers,
+            process_pools,
+        )
+
+        if not snapshot:
+            return
+
+        for consumer in consumers:
+            virtual_host_config = snapshot.virtual_hosts.get(
+                consumer.rabbitmq.virtual_host_name
+            )
+
+            if virtual_host_config:
+                await consumer.reload(virtual_host_config)
+    except Exception:
+        logger.exception("Exception reloading config")
+
+
+async def consume(
+    config: Config,
+    virtual_hosts: List[VirtualHost],
+    exchange_handlers: Dict[str, ExchangeHandler],
+    process_pools: Dict[str, HandlerProcessPool],
+) -> None:
+    """Consume RPC requests on virtual hosts, until SIGTERM is received.
+
+    Config is reloaded when SIGHUP is received.
+    """
+    loop = asyncio.get_running_loop()
+
+    consumers = [
+        AsyncioConsumer(virtual_host.name, config, exchange_handlers, process_pools)
+        for virtual_host in virtual_hosts
+    ]
+
+    sigterm_received = asyncio.Event()
+
+    loop.add_signal_handler(signal.SIGTERM, sigterm_received.set)
+
+    sighup_received = asyncio.Event()
+
+    loop.add_signal_handler(signal.SIGHUP, sighup_received.set)
+
+    async def reload_on_sighup() -> None:
+        while True:
+            await sighup_received.wait()
+
+            sighup_received.clear()
+
+            logger.info("Received SIGHUP")
+
+            await reload(config, consumers, exchange_handlers, process_pools)
+
+    reloader: "Optional[asyncio.Task[None]]" = None
+
+    try:
+        # Connect to every virtual host, and start consuming
+
+        for consumer in consumers:
+            await consumer.start_consuming()
+
+        # Notify systemd at startup
+
+        sdnotify.SystemdNotifier().notify("READY=1")
+
+        reloader = loop.create_task(reload_on_sighup())
+
+        # Wait until a connection closes or SIGTERM is received
+
+        sigterm_waiter = loop.create_task(sigterm_received.wait())
+
+        waiters: "List[asyncio.Future[Any]]" = [sigterm_waiter]
+
+        for consumer in consumers:
+            if consumer.rabbitmq.closed:
+                waiters.append(consumer.rabbitmq.closed)
+
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+
+        if not sigterm_received.is_set():
+            sigterm_waiter.cancel()
+
+            for consumer in consumers:
+                consumer.rabbitmq.raise_for_exception()
+
+        logger.info("Received SIGTERM")
+
+        # Stop receiving messages. The connection keeps processing I/O, so that
+        # messages that are being processed are still acknowledged.
+
+        for consumer in consumers:
+            await consumer.cancel()
+
+        # Wait for RPC requests to finish, and ship remaining log server records
+
+        for consumer in consumers:
+            await consumer.drain()
+
+        logger.info("Exiting after SIGTERM...")
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        loop.remove_signal_handler(signal.SIGHUP)
+
+        if reloader:
+            reloader.cancel()
+
+        for consumer in consumers:
+            await consumer.close()
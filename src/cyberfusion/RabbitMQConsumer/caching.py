@@ -0,0 +1,267 @@
+"""Classes for caching RPC responses."""
+
+import collections
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Generic, Hashable, Optional, OrderedDict, Tuple, TypeVar
+
+from cyberfusion.RabbitMQConsumer.contracts import (
+    HandlerBase,
+    RPCRequestBase,
+    RPCResponseBase,
+)
+from cyberfusion.RabbitMQConsumer.metrics import RESULT_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+RESULT_HIT = "hit"
+RESULT_MISS = "miss"
+
+
+@dataclass
+class TTLCacheMetrics:
+    """TTL cache metrics."""
+
+    size: int
+    hits: int
+    misses: int
+    expired: int
+    evicted: int
+
+
+class TTLCache(Generic[K, V]):
+    """Cache with max size and TTL.
+
+    Above the max size, the least recently used items are evicted. Expired
+    items are evicted when accessed, or once they're the least recently used.
+    """
+
+    def __init__(self, *, max_size: int, ttl: float) -> None:
+        """Set attributes."""
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+
+        # Map keys to expiry time (monotonic) and value, ordered from least to
+        # most recently used
+
+        self._items: OrderedDict[K, Tuple[float, V]] = collections.OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._evicted = 0
+
+    @property
+    def metrics(self) -> TTLCacheMetrics:
+        """Get metrics."""
+        with self._lock:
+            return TTLCacheMetrics(
+                size=len(self._items),
+                hits=self._hits,
+                misses=self._misses,
+                expired=self._expired,
+                evicted=self._evicted,
+            )
+
+    def get(self, key: K) -> Optional[V]:
+        """Get value, if cached and not expired."""
+        with self._lock:
+            try:
+                expires_at, value = self._items[key]
+            except KeyError:
+                self._misses += 1
+
+                return None
+
+            if expires_at <= time.monotonic():
+                del self._items[key]
+
+                self._expired += 1
+                self._misses += 1
+
+                return None
+
+            self._items.move_to_end(key)
+
+            self._hits += 1
+
+            return value
+
+    def set(self, key: K, value: V, *, ttl: Optional[float] = None) -> None:
+        """Cache value, for the given TTL or the default TTL."""
+        now = time.monotonic()
+
+        with self._lock:
+            self._items[key] = (now + (ttl if ttl is not None else self.ttl), value)
+
+            self._items.move_to_end(key)
+
+            while self._items:
+                oldest_key, (oldest_expires_at, _) = next(iter(self._items.items()))
+
+                if oldest_expires_at > now and len(self._items) <= self.max_size:
+                    break
+
+                del self._items[oldest_key]
+
+                if oldest_expires_at <= now:
+                    self._expired += 1
+                else:
+                    self._evicted += 1
+
+    def delete(self, key: K) -> None:
+        """Remove value, if cached."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all values."""
+        with self._lock:
+            self._items.clear()
+
+
+class ResultCache:
+    """Cache RPC responses of exchange, by the handler's cache key.
+
+    Exchange handlers are shared by virtual hosts, so RPC responses are cached
+    per virtual host, to prevent RPC responses from being served to another
+    virtual host. Only successful RPC responses are cached.
+    """
+
+    def __init__(self, exchange_name: str, handler: HandlerBase) -> None:
+        """Set attributes."""
+        assert handler.cache_ttl is not None
+
+        self.exchange_name = exchange_name
+        self.handler = handler
+
+        self._lock = threading.Lock()
+
+        self.caches: Dict[str, TTLCache[Hashable, RPCResponseBase]] = {}
+
+    @property
+    def metrics(self) -> TTLCacheMetrics:
+        """Get metrics, summed for all virtual hosts."""
+        with self._lock:
+            caches = list(self.caches.values())
+
+        metrics = TTLCacheMetrics(size=0, hits=0, misses=0, expired=0, evicted=0)
+
+        for cache in caches:
+            cache_metrics = cache.metrics
+
+            metrics.size += cache_metrics.size
+            metrics.hits += cache_metrics.hits
+            metrics.misses += cache_metrics.misses
+            metrics.expired += cache_metrics.expired
+            metrics.evicted += cache_metrics.evicted
+
+        return metrics
+
+    def get_cache(self, virtual_host_name: str) -> TTLCache[Hashable, RPCResponseBase]:
+        """Get cache of virtual host, creating it if needed."""
+        with self._lock:
+            if virtual_host_name not in self.caches:
+                assert self.handler.cache_ttl is not None
+
+                self.caches[virtual_host_name] = TTLCache(
+                    max_size=self.handler.cache_max_size, ttl=self.handler.cache_ttl
+                )
+
+            return self.caches[virtual_host_name]
+
+    def get_key(self, request: RPCRequestBase) -> Hashable:
+        """Get key to cache RPC response by."""
+        return self.handler.cache_key(request)
+
+    def get(self, virtual_host_name: str, key: Hashable) -> Optional[RPCResponseBase]:
+        """Get cached RPC response."""
+        response = self.get_cache(virtual_host_name).get(key)
+
+        RESULT_CACHE_LOOKUPS.inc(
+            virtual_host=virtual_host_name,
+            exchange=self.exchange_name,
+            result=RESULT_MISS if response is None else RESULT_HIT,
+        )
+
+        return response
+
+    def set(
+        self, virtual_host_name: str, key: Hashable, response: RPCResponseBase
+    ) -> None:
+        """Cache RPC response, if successful."""
+        if not response.success:
+            return
+
+        self.get_cache(virtual_host_name).set(key, response)
+
+    def invalidate(
+        self,
+        request: Optional[RPCRequestBase] = None,
+        *,
+        virtual_host_name: Optional[str] = None,
+    ) -> None:
+        """Remove cached RPC response for request, or all if not given.
+
+        If virtual host name is given, only its cached RPC responses are removed.
+        """
+        with self._lock:
+            if virtual_host_name is None:
+                caches = list(self.caches.values())
+            elif virtual_host_name in self.caches:
+                caches = [self.caches[virtual_host_name]]
+            else:
+                caches = []
+
+        for cache in caches:
+            if request is None:
+                cache.clear()
+            else:
+                cache.delete(self.get_key(request))
+
+
+# Result caches are process-wide, like exchange handlers. Exchanges are only
+# present if their handler caches RPC responses.
+
+RESULT_CACHES: Dict[str, ResultCache] = {}
+
+
+def get_result_cache(exchange_name: str, handler: HandlerBase) -> Optional[ResultCache]:
+    """Get result cache for exchange, if its handler caches RPC responses."""
+    if handler.cache_ttl is None:
+        return None
+
+    result_cache = ResultCache(exchange_name, handler)
+
+    RESULT_CACHES[exchange_name] = result_cache
+
+    return result_cache
+
+
+def invalidate_cached_responses(
+    exchange_name: str,
+    request: Optional[RPCRequestBase] = None,
+    *,
+    virtual_host_name: Optional[str] = None,
+) -> None:
+    """Remove cached RPC responses of exchange.
+
+    Call this from handlers that change what another exchange's handler
+    returns. If request is given, only the RPC response for it is removed. If
+    virtual host name is given, only RPC responses cached for it are removed.
+    """
+    result_cache = RESULT_CACHES.get(exchange_name)
+
+    if not result_cache:
+        return
+
+    logger.info("Invalidating cached RPC responses of exchange '%s'", exchange_name)
+
+    result_cache.invalidate(request, virtual_host_name=virtual_host_name)
@@ -1,13 +1,19 @@
 """Config."""
 
-from dataclasses import dataclass
+import dataclasses
+import importlib.util
+import threading
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Optional
+from typing import Any, Collection, Dict, List, Optional, Tuple
 
+import schema
 import yaml
-from functools import cached_property
 
-from cyberfusion.RabbitMQConsumer.exceptions import VirtualHostNotExistsError
+from cyberfusion.RabbitMQConsumer.exceptions import (
+    ConfigInvalidError,
+    VirtualHostNotExistsError,
+)
 
 
 class ExchangeType(str, Enum):
@@ -16,7 +22,42 @@ class ExchangeType(str, Enum):
     DIRECT = "direct"
 
 
-@dataclass
+class ExecutionMode(str, Enum):
+    """Modes for running handlers."""
+
+    THREAD = "thread"
+    PROCESS = "process"
+
+
+class Engine(str, Enum):
+    """Engines for consuming RPC requests."""
+
+    THREADED = "threaded"
+    ASYNCIO = "asyncio"
+
+
+class QueueFullPolicy(str, Enum):
+    """Policies for when log server queue is full."""
+
+    DROP = "drop"
+    SPILL = "spill"
+
+
+class LogFormat(str, Enum):
+    """Formats for logs."""
+
+    TEXT = "text"
+    JSON = "json"
+
+
+class JSONBackend(str, Enum):
+    """Backends for deserializing JSON."""
+
+    STDLIB = "json"
+    ORJSON = "orjson"
+
+
+@dataclass(frozen=True)
 class Server:
     """Server."""
 
@@ -27,23 +68,82 @@ class Server:
     username: str
 
 
-@dataclass
+@dataclass(frozen=True)
 class LogServer:
     """Log server."""
 
     base_url: str
     api_token: str
+    queue_size: int = 1000
+    batch_size: int = 1
+    flush_interval: float = 1.0
+    queue_full_policy: QueueFullPolicy = QueueFullPolicy.DROP
+    spool_directory: Optional[str] = None
+    spool_max_size: int = 100 * 1024 * 1024
+    spool_segment_size: int = 1024 * 1024
+    spool_replay_rate: float = 100.0
+
+
+@dataclass(frozen=True)
+class Metrics:
+    """Metrics exporters."""
+
+    listen_address: str = "127.0.0.1"
+    port: Optional[int] = None
+    textfile_path: Optional[str] = None
+    textfile_interval: float = 15.0
+
+
+@dataclass(frozen=True)
+class Tracing:
+    """Tracing of RPC requests."""
+
+    path: str
+    sample_rate: float = 1.0
+
+
+@dataclass(frozen=True)
+class Idempotency:
+    """Storing RPC responses, to replay them for redelivered messages."""
+
+    max_size: int = 10000
+    ttl: float = 3600.0
+    path: Optional[str] = None
 
 
-@dataclass
+@dataclass(frozen=True)
+class Logging:
+    """Logging."""
+
+    level: str = "INFO"
+    format: LogFormat = LogFormat.TEXT
+    body_max_size: int = 1024
+
+
+@dataclass(frozen=True)
+class AdaptivePrefetch:
+    """Adjusting prefetch count to load."""
+
+    target_latency: float
+    min_prefetch_count: int = 1
+    interval: float = 5.0
+    max_memory: Optional[int] = None
+
+
+@dataclass(frozen=True)
 class Exchange:
     """Exchange."""
 
     name: str
     type: ExchangeType
+    execution_mode: ExecutionMode = ExecutionMode.THREAD
+    processes: Optional[int] = None
+    timeout: Optional[float] = None
+    single_flight: bool = False
+    max_simultaneous_requests: Optional[int] = None
 
 
-@dataclass
+@dataclass(frozen=True)
 class VirtualHost:
     """Virtual host."""
 
@@ -51,97 +151,510 @@ class VirtualHost:
     exchanges: List[Exchange]
     queue: str
     fernet_key: Optional[str] = None
+    fernet_keys: List[str] = field(default_factory=list)
     max_simultaneous_requests: int = 5
+    connections: int = 1
+    channels_per_connection: int = 1
+    confirm_delivery: bool = False
+    ack_flush_interval: Optional[float] = None
+    max_priority: Optional[int] = None
+    adaptive_prefetch: Optional[AdaptivePrefetch] = None
+    dead_letter_exchange: Optional[str] = None
+    dead_letter_queue: Optional[str] = None
+    max_deliveries: Optional[int] = None
+
+
+def is_positive_number(value: Any) -> bool:
+    """Determine if value is a positive number."""
+    return isinstance(value, (int, float)) and value > 0
+
+
+def is_positive_integer(value: Any) -> bool:
+    """Determine if value is a positive integer."""
+    return isinstance(value, int) and value > 0
+
+
+def is_fraction(value: Any) -> bool:
+    """Determine if value is a number between 0 and 1."""
+    return isinstance(value, (int, float)) and 0 <= value <= 1
+
+
+def is_available_json_backend(value: Any) -> bool:
+    """Determine if value is a JSON backend that is installed."""
+    if value == JSONBackend.ORJSON:
+        return importlib.util.find_spec("orjson") is not None
+
+    return value == JSONBackend.STDLIB
+
+
+def is_priority(value: Any) -> bool:
+    """Determine if value is a valid max priority of a RabbitMQ queue."""
+    return isinstance(value, int) and 1 <= value <= 255
+
+
+# Schema of config file. Values are validated once, when loading the config
+# file, so that invalid config is rejected with a clear error. Unknown keys
+# are ignored, at every level (nested schemas inherit ignore_extra_keys, except
+# when wrapped in schema.And, so those set it explicitly).
+
+CONFIG_SCHEMA = schema.Schema(
+    {
+        schema.Optional("mock"): bool,
+        schema.Optional("engine"): schema.Or(*[engine.value for engine in Engine]),
+        schema.Optional("json_backend"): schema.Schema(
+            is_available_json_backend,
+            error="JSON backend must be 'json', or 'orjson' if installed",
+        ),
+        "server": {
+            "host": str,
+            "username": str,
+            "password": str,
+            "port": int,
+            "ssl": bool,
+        },
+        schema.Optional("logging"): {
+            schema.Optional("level"): schema.Or(
+                "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"
+            ),
+            schema.Optional("format"): schema.Or(
+                *[log_format.value for log_format in LogFormat]
+            ),
+            schema.Optional("body_max_size"): is_positive_integer,
+        },
+        schema.Optional("log_server"): schema.And(
+            schema.Schema(
+                {
+                    "base_url": str,
+                    "api_token": str,
+                    schema.Optional("queue_size"): is_positive_integer,
+                    schema.Optional("batch_size"): is_positive_integer,
+                    schema.Optional("flush_interval"): is_positive_number,
+                    schema.Optional("queue_full_policy"): schema.Or(
+                        *[policy.value for policy in QueueFullPolicy]
+                    ),
+                    schema.Optional("spool_directory"): schema.Or(None, str),
+                    schema.Optional("spool_max_size"): is_positive_integer,
+                    schema.Optional("spool_segment_size"): is_positive_integer,
+                    schema.Optional("spool_replay_rate"): is_positive_number,
+                },
+                ignore_extra_keys=True,
+            ),
+            schema.Schema(
+                lambda log_server: (
+                    log_server.get("queue_full_policy") != QueueFullPolicy.SPILL
+                    or log_server.get("spool_directory")
+                ),
+                error="Queue full policy 'spill' requires 'spool_directory'",
+            ),
+        ),
+        schema.Optional("metrics"): {
+            schema.Optional("listen_address"): str,
+            schema.Optional("port"): schema.Or(None, int),
+            schema.Optional("textfile_path"): schema.Or(None, str),
+            schema.Optional("textfile_interval"): is_positive_number,
+        },
+        schema.Optional("idempotency"): {
+            schema.Optional("max_size"): is_positive_integer,
+            schema.Optional("ttl"): is_positive_number,
+            schema.Optional("path"): schema.Or(None, str),
+        },
+        schema.Optional("tracing"): {
+            "path": str,
+            schema.Optional("sample_rate"): is_fraction,
+        },
+        "virtual_hosts": {
+            str: schema.And(
+                schema.Schema(
+                    {
+                        "queue": str,
+                        "exchanges": {
+                            str: {
+                                "type": schema.Or(
+                                    *[
+                                        exchange_type.value
+                                        for exchange_type in ExchangeType
+                                    ]
+                                ),
+                                schema.Optional("execution_mode"): schema.Or(
+                                    *[mode.value for mode in ExecutionMode]
+                                ),
+                                schema.Optional("processes"): schema.Or(
+                                    None, is_positive_integer
+                                ),
+                                schema.Optional("timeout"): schema.Or(
+                                    None, is_positive_number
+                                ),
+                                schema.Optional("single_flight"): bool,
+                                schema.Optional("max_simultaneous_requests"): schema.Or(
+                                    None, is_positive_integer
+                                ),
+                            }
+                        },
+                        schema.Optional("fernet_key"): schema.Or(None, str),
+                        schema.Optional("fernet_keys"): [str],
+                        schema.Optional(
+                            "max_simultaneous_requests"
+                        ): is_positive_integer,
+                        schema.Optional("connections"): is_positive_integer,
+                        schema.Optional("channels_per_connection"): is_positive_integer,
+                        schema.Optional("confirm_delivery"): bool,
+                        schema.Optional("ack_flush_interval"): schema.Or(
+                            None, is_positive_number
+                        ),
+                        schema.Optional("max_priority"): schema.Or(None, is_priority),
+                        schema.Optional("adaptive_prefetch"): {
+                            "target_latency": is_positive_number,
+                            schema.Optional("min_prefetch_count"): is_positive_integer,
+                            schema.Optional("interval"): is_positive_number,
+                            schema.Optional("max_memory"): schema.Or(
+                                None, is_positive_integer
+                            ),
+                        },
+                        schema.Optional("dead_letter_exchange"): schema.Or(None, str),
+                        schema.Optional("dead_letter_queue"): schema.Or(None, str),
+                        schema.Optional("max_deliveries"): schema.Or(
+                            None, is_positive_integer
+                        ),
+                    },
+                    ignore_extra_keys=True,
+                ),
+                schema.Schema(
+                    lambda virtual_host: (
+                        not virtual_host.get("dead_letter_queue")
+                        or virtual_host.get("dead_letter_exchange")
+                    ),
+                    error="'dead_letter_queue' requires 'dead_letter_exchange'",
+                ),
+            )
+        },
+    },
+    ignore_extra_keys=True,
+)
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """Parsed and validated config. Virtual hosts are indexed by name."""
+
+    server: Server
+    virtual_hosts: Dict[str, VirtualHost]
+    engine: Engine = Engine.THREADED
+    mock: bool = False
+    json_backend: JSONBackend = JSONBackend.STDLIB
+    logging: Logging = Logging()
+    log_server: Optional[LogServer] = None
+    metrics: Optional[Metrics] = None
+    tracing: Optional[Tracing] = None
+    idempotency: Optional[Idempotency] = None
+
+
+def get_virtual_host(name: str, properties: dict) -> VirtualHost:
+    """Get virtual host config from validated contents."""
+    exchanges = [
+        Exchange(
+            name=exchange_name,
+            type=ExchangeType(exchange_properties["type"]),
+            execution_mode=ExecutionMode(
+                exchange_properties.get("execution_mode", ExecutionMode.THREAD)
+            ),
+            processes=exchange_properties.get("processes"),
+            timeout=exchange_properties.get("timeout"),
+            single_flight=exchange_properties.get("single_flight", False),
+            max_simultaneous_requests=exchange_properties.get(
+                "max_simultaneous_requests"
+            ),
+        )
+        for exchange_name, exchange_properties in properties["exchanges"].items()
+    ]
+
+    adaptive_prefetch = None
+
+    if "adaptive_prefetch" in properties:
+        adaptive_prefetch = AdaptivePrefetch(**properties["adaptive_prefetch"])
+
+    return VirtualHost(
+        name=name,
+        exchanges=exchanges,
+        adaptive_prefetch=adaptive_prefetch,
+        **{
+            key: value
+            for key, value in properties.items()
+            if key not in ("exchanges", "adaptive_prefetch")
+        },
+    )
+
+
+def get_config_snapshot(contents: Any) -> ConfigSnapshot:
+    """Validate config file contents, and get snapshot."""
+    try:
+        contents = CONFIG_SCHEMA.validate(contents)
+    except schema.SchemaError as e:
+        raise ConfigInvalidError(e.code) from e
+
+    arguments: Dict[str, Any] = {
+        "server": Server(**contents["server"]),
+        "virtual_hosts": {
+            name: get_virtual_host(name, properties)
+            for name, properties in contents["virtual_hosts"].items()
+        },
+        "engine": Engine(contents.get("engine", Engine.THREADED)),
+        "mock": contents.get("mock", False),
+        "json_backend": JSONBackend(contents.get("json_backend", JSONBackend.STDLIB)),
+        "logging": Logging(**contents.get("logging", {})),
+    }
+
+    for key, cls in (
+        ("log_server", LogServer),
+        ("metrics", Metrics),
+        ("tracing", Tracing),
+        ("idempotency", Idempotency),
+    ):
+        if key in contents:
+            arguments[key] = cls(**contents[key])
+
+    return ConfigSnapshot(**arguments)
+
+
+def get_restart_required_changes(
+    old: ConfigSnapshot, new: ConfigSnapshot, virtual_host_names: Collection[str]
+) -> List[str]:
+    """Get descriptions of changes that can't be applied by reloading.
+
+    Reloading applies the max amount of simultaneous requests (prefetch count),
+    mock mode, JSON backend, log server config, and added exchanges, to the given virtual
+    hosts. Everything else requires a restart.
+    """
+    changes = []
+
+    for key in ("server", "engine", "logging", "metrics", "tracing", "idempotency"):
+        if getattr(old, key) != getattr(new, key):
+            changes.append(f"'{key}' changed")
+
+    if old.log_server and new.log_server:
+        for key in (
+            "queue_size",
+            "spool_directory",
+            "spool_max_size",
+            "spool_segment_size",
+        ):
+            if getattr(old.log_server, key) != getattr(new.log_server, key):
+                changes.append(f"'log_server.{key}' changed")
+
+    for name in virtual_host_names:
+        old_virtual_host = old.virtual_hosts.get(name)
+        new_virtual_host = new.virtual_hosts.get(name)
+
+        if not old_virtual_host:
+            continue
+
+        if not new_virtual_host:
+            changes.append(f"Virtual host '{name}' removed")
+
+            continue
+
+        for virtual_host_field in dataclasses.fields(VirtualHost):
+            if virtual_host_field.name in ("exchanges", "max_simultaneous_requests"):
+                continue
+
+            if getattr(old_virtual_host, virtual_host_field.name) != getattr(
+                new_virtual_host, virtual_host_field.name
+            ):
+                changes.append(
+                    f"'virtual_hosts.{name}.{virtual_host_field.name}' changed"
+                )
+
+        new_exchanges = {
+            exchange.name: exchange for exchange in new_virtual_host.exchanges
+        }
+
+        for exchange in old_virtual_host.exchanges:
+            if exchange.name not in new_exchanges:
+                changes.append(
+                    f"Exchange '{exchange.name}' removed from virtual host '{name}'"
+                )
+            elif new_exchanges[exchange.name] != exchange:
+                changes.append(
+                    f"Exchange '{exchange.name}' changed on virtual host '{name}'"
+                )
+
+    return changes
+
+
+def get_applied_snapshot(old: ConfigSnapshot, new: ConfigSnapshot) -> ConfigSnapshot:
+    """Get snapshot with changes that can be applied by reloading.
+
+    Changes that require a restart (see `get_restart_required_changes`) are
+    left out, so that the snapshot describes the config the running process
+    uses.
+    """
+    log_server = new.log_server
+
+    if old.log_server and new.log_server:
+        log_server = dataclasses.replace(
+            new.log_server,
+            queue_size=old.log_server.queue_size,
+            spool_directory=old.log_server.spool_directory,
+            spool_max_size=old.log_server.spool_max_size,
+            spool_segment_size=old.log_server.spool_segment_size,
+        )
+
+    virtual_hosts = dict(new.virtual_hosts)
+
+    for name, old_virtual_host in old.virtual_hosts.items():
+        new_virtual_host = new.virtual_hosts.get(name)
+
+        if not new_virtual_host:
+            virtual_hosts[name] = old_virtual_host
+
+            continue
+
+        virtual_hosts[name] = dataclasses.replace(
+            old_virtual_host,
+            exchanges=old_virtual_host.exchanges
+            + get_added_exchanges(old_virtual_host, new_virtual_host),
+            max_simultaneous_requests=new_virtual_host.max_simultaneous_requests,
+        )
+
+    return dataclasses.replace(
+        old,
+        virtual_hosts=virtual_hosts,
+        mock=new.mock,
+        json_backend=new.json_backend,
+        log_server=log_server,
+    )
+
+
+def get_added_exchanges(old: VirtualHost, new: VirtualHost) -> List[Exchange]:
+    """Get exchanges that were added to virtual host."""
+    exchange_names = {exchange.name for exchange in old.exchanges}
+
+    return [
+        exchange for exchange in new.exchanges if exchange.name not in exchange_names
+    ]
+
+
+def get_queue_arguments(virtual_host: VirtualHost) -> Optional[Dict[str, Any]]:
+    """Get arguments to declare queue of virtual host with."""
+    arguments: Dict[str, Any] = {}
+
+    if virtual_host.max_priority is not None:
+        arguments["x-max-priority"] = virtual_host.max_priority
+
+    if virtual_host.dead_letter_exchange is not None:
+        arguments["x-dead-letter-exchange"] = virtual_host.dead_letter_exchange
+
+    return arguments or None
+
+
+def get_exchange_limits(virtual_host: VirtualHost) -> Dict[str, int]:
+    """Get max amount of simultaneous requests per exchange, if limited."""
+    return {
+        exchange.name: exchange.max_simultaneous_requests
+        for exchange in virtual_host.exchanges
+        if exchange.max_simultaneous_requests is not None
+    }
 
 
 class Config:
-    """Base config."""
+    """Base config.
 
-    KEY_NAME = "name"
-    KEY_QUEUE = "queue"
-    KEY_FERNET_KEY = "fernet_key"
-    KEY_EXCHANGES = "exchanges"
-    KEY_MAX_SIMULTANEOUS_REQUESTS = "max_simultaneous_requests"
+    The config file is parsed and validated once, into a snapshot. Reloading
+    replaces the snapshot, so objects that hold on to a snapshot see consistent
+    config. Changes that require a restart are not applied to the snapshot.
+    """
 
     def __init__(self, path: str) -> None:
         """Path to config file."""
         self.path = path
 
-    @cached_property
-    def _contents(self) -> dict:
-        """Set config from YAML file."""
-        with open(self.path, "rb") as fh:
-            return yaml.load(fh.read(), Loader=yaml.SafeLoader)
+        self._lock = threading.Lock()
+
+        self.snapshot = self._load()
+
+    def _load(self) -> ConfigSnapshot:
+        """Load config from YAML file."""
+        try:
+            with open(self.path, "rb") as fh:
+                contents = yaml.load(fh.read(), Loader=yaml.SafeLoader)
+        except yaml.YAMLError as e:
+            raise ConfigInvalidError(str(e)) from e
+
+        return get_config_snapshot(contents)
+
+    def reload(self) -> Tuple[ConfigSnapshot, ConfigSnapshot]:
+        """Reload config from YAML file, and return old and new snapshot.
+
+        The new snapshot is the config file as loaded. The current snapshot only
+        takes changes that can be applied by reloading; others keep their old
+        values until restarting.
+
+        If the config file is invalid, ConfigInvalidError is raised, and the
+        current snapshot is kept.
+        """
+        with self._lock:
+            old = self.snapshot
+
+            new = self._load()
+
+            self.snapshot = get_applied_snapshot(old, new)
+
+            return old, new
 
     @property
     def server(self) -> Server:
         """Get server config."""
-        return Server(**self._contents["server"])
+        return self.snapshot.server
 
     @property
-    def mock(self) -> bool:
-        return self._contents.get("mock", False)
+    def engine(self) -> Engine:
+        """Get engine."""
+        return self.snapshot.engine
 
     @property
-    def log_server(self) -> Optional[LogServer]:
-        """Get log server config."""
-        if "log_server" not in self._contents:
-            return None
-
-        return LogServer(**self._contents["log_server"])
+    def mock(self) -> bool:
+        return self.snapshot.mock
 
     @property
-    def virtual_hosts(self) -> List[VirtualHost]:
-        """Get virtual host configs."""
-        virtual_hosts = []
-
-        for virtual_host_name, virtual_host_properties in self._contents[
-            "virtual_hosts"
-        ].items():
-            # Get exchanges
-
-            exchanges = []
-
-            for exchange_name, exchange_properties in virtual_host_properties[
-                "exchanges"
-            ].items():
-                exchanges.append(
-                    Exchange(name=exchange_name, type=exchange_properties["type"])
-                )
+    def json_backend(self) -> JSONBackend:
+        """Get JSON backend."""
+        return self.snapshot.json_backend
 
-            # Get arguments
+    @property
+    def logging(self) -> Logging:
+        """Get logging config."""
+        return self.snapshot.logging
 
-            arguments = {
-                self.KEY_NAME: virtual_host_name,
-                self.KEY_QUEUE: virtual_host_properties[self.KEY_QUEUE],
-                self.KEY_FERNET_KEY: virtual_host_properties[self.KEY_FERNET_KEY],
-                self.KEY_EXCHANGES: exchanges,
-            }
+    @property
+    def log_server(self) -> Optional[LogServer]:
+        """Get log server config."""
+        return self.snapshot.log_server
 
-            if self.KEY_MAX_SIMULTANEOUS_REQUESTS in virtual_host_properties:
-                arguments[self.KEY_MAX_SIMULTANEOUS_REQUESTS] = virtual_host_properties[
-                    self.KEY_MAX_SIMULTANEOUS_REQUESTS
-                ]
+    @property
+    def metrics(self) -> Optional[Metrics]:
+        """Get metrics config."""
+        return self.snapshot.metrics
 
-            # Add virtual host
+    @property
+    def tracing(self) -> Optional[Tracing]:
+        """Get tracing config."""
+        return self.snapshot.tracing
 
-            virtual_hosts.append(
-                VirtualHost(
-                    **arguments,
-                )
-            )
+    @property
+    def idempotency(self) -> Optional[Idempotency]:
+        """Get idempotency config."""
+        return self.snapshot.idempotency
 
-        return virtual_hosts
+    @property
+    def virtual_hosts(self) -> List[VirtualHost]:
+        """Get virtual host configs."""
+        return list(self.snapshot.virtual_hosts.values())
 
     def get_virtual_host(self, name: str) -> VirtualHost:
         """Get virtual host config by name."""
-        for virtual_host in self.virtual_hosts:
-            if virtual_host.name != name:
-                continue
-
-            return virtual_host
-
-        raise VirtualHostNotExistsError
+        try:
+            return self.snapshot.virtual_hosts[name]
+        except KeyError:
+            raise VirtualHostNotExistsError
 
     def get_all_exchanges(self) -> List[Exchange]:
         """Get exchanges for all virtual hosts."""
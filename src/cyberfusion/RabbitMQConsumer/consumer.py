@@ -0,0 +1,655 @@
+"""Classes for consuming RPC requests on virtual host."""
+
+import functools
+import logging
+import os
+import time
+from typing import Dict, Optional, Union
+
+import pika
+from pydantic import ValidationError
+
+from cyberfusion.RabbitMQConsumer.config import (
+    Config,
+    LogServer,
+    VirtualHost,
+    get_added_exchanges,
+    get_exchange_limits,
+)
+from cyberfusion.RabbitMQConsumer.dead_lettering import get_delivery_count
+from cyberfusion.RabbitMQConsumer.decryption import decrypt_body
+from cyberfusion.RabbitMQConsumer.exceptions import MalformedBodyError
+from cyberfusion.RabbitMQConsumer.idempotency import IdempotencyStore
+from cyberfusion.RabbitMQConsumer.locking import AsyncioLockManager, LockManager
+from cyberfusion.RabbitMQConsumer.log_server_client import LogServerClient
+from cyberfusion.RabbitMQConsumer.metrics import (
+    DECRYPTION_VALUES,
+    HANDLER_TIMEOUTS,
+    IDEMPOTENCY_LOOKUPS,
+    IDEMPOTENCY_STORE_SIZE,
+    LOCK_ACQUISITIONS,
+    LOCK_CONTENTIONS,
+    LOCK_WAIT_TIME,
+    LOCKS_HELD,
+    LOG_SERVER_QUEUE_DEPTH,
+    LOG_SERVER_RECORDS,
+    PHASE_DECRYPT,
+    PHASE_DURATION,
+    PREFETCH_COUNT,
+    QUARANTINED_THREADS,
+    REASON_MALFORMED,
+    REASON_MAX_DELIVERIES,
+    REASON_UNPROCESSABLE,
+    REGISTRY,
+    RESULT_CACHE_SIZE,
+    RPC_REQUESTS_RECEIVED,
+    RPC_REQUESTS_REJECTED,
+    SPOOL_RECORDS,
+    SPOOL_SIZE,
+    WORKERS_ACTIVE,
+)
+from cyberfusion.RabbitMQConsumer.prefetch import (
+    HandlerLatency,
+    get_memory_usage,
+    get_prefetch_controller,
+)
+from cyberfusion.RabbitMQConsumer.process_pool import HandlerProcessPool
+from cyberfusion.RabbitMQConsumer.processor import Processor, ProcessorBase
+from cyberfusion.RabbitMQConsumer.rabbitmq import RabbitMQ, RabbitMQBase
+from cyberfusion.RabbitMQConsumer.registry import ExchangeHandler
+from cyberfusion.RabbitMQConsumer.rpc_logging import LogBody, RPCRequestLoggerAdapter
+from cyberfusion.RabbitMQConsumer.scheduler import KeyedScheduler
+from cyberfusion.RabbitMQConsumer.serialization import get_loads
+from cyberfusion.RabbitMQConsumer.single_flight import SingleFlight
+from cyberfusion.RabbitMQConsumer.spool import Spool
+from cyberfusion.RabbitMQConsumer.timeouts import TimeoutTracker
+from cyberfusion.RabbitMQConsumer.tracing import TRACER, Trace
+from cyberfusion.RabbitMQConsumer.worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+def get_log_server_client(
+    config: Config, rabbitmq: RabbitMQBase
+) -> Optional[LogServerClient]:
+    """Get log server client for virtual host, if log server is configured."""
+    if not config.log_server:
+        return None
+
+    # Spool per virtual host, so that every virtual host's records can be
+    # replayed independently
+
+    spool = None
+
+    if config.log_server.spool_directory:
+        spool = Spool(
+            os.path.join(
+                config.log_server.spool_directory,
+                rabbitmq.virtual_host_name,
+            ),
+            max_size=config.log_server.spool_max_size,
+            max_segment_size=config.log_server.spool_segment_size,
+        )
+
+    return LogServerClient(
+        config.log_server.base_url,
+        config.log_server.api_token,
+        rabbitmq,
+        queue_size=config.log_server.queue_size,
+        batch_size=config.log_server.batch_size,
+        flush_interval=config.log_server.flush_interval,
+        queue_full_policy=config.log_server.queue_full_policy,
+        spool=spool,
+        spool_replay_rate=config.log_server.spool_replay_rate,
+    )
+
+
+def get_idempotency_store(config: Config) -> Optional[IdempotencyStore]:
+    """Get idempotency store for virtual host, if configured."""
+    if not config.idempotency:
+        return None
+
+    return IdempotencyStore(
+        max_size=config.idempotency.max_size,
+        ttl=config.idempotency.ttl,
+        path=config.idempotency.path,
+    )
+
+
+def collect_component_metrics(
+    rabbitmq: RabbitMQBase,
+    *,
+    exchange_handlers: Dict[str, ExchangeHandler],
+    lock_manager: Union[LockManager, AsyncioLockManager],
+    timeout_tracker: TimeoutTracker,
+    log_server_client: Optional[LogServerClient],
+    idempotency_store: Optional[IdempotencyStore],
+) -> None:
+    """Update metrics from totals counted by components of virtual host."""
+    labels = {"virtual_host": rabbitmq.virtual_host_name}
+
+    lock_manager_metrics = lock_manager.metrics
+
+    LOCKS_HELD.set(lock_manager_metrics.locks, **labels)
+    LOCK_ACQUISITIONS.set_total(lock_manager_metrics.acquisitions, **labels)
+    LOCK_CONTENTIONS.set_total(lock_manager_metrics.contentions, **labels)
+    LOCK_WAIT_TIME.set_total(lock_manager_metrics.wait_time, **labels)
+
+    timeout_tracker_metrics = timeout_tracker.metrics
+
+    QUARANTINED_THREADS.set(timeout_tracker_metrics.quarantined, **labels)
+
+    for exchange_name, timeouts in timeout_tracker_metrics.timeouts.items():
+        HANDLER_TIMEOUTS.set_total(timeouts, exchange=exchange_name, **labels)
+
+    for exchange in rabbitmq.virtual_host_config.exchanges:
+        exchange_handler = exchange_handlers.get(exchange.name)
+
+        if not exchange_handler or not exchange_handler.result_cache:
+            continue
+
+        RESULT_CACHE_SIZE.set(
+            exchange_handler.result_cache.get_cache(
+                rabbitmq.virtual_host_name
+            ).metrics.size,
+            exchange=exchange.name,
+            **labels,
+        )
+
+    if rabbitmq.decryptor:
+        decryption_metrics = rabbitmq.decryptor.metrics
+
+        for result, total in (
+            ("decrypted", decryption_metrics.decrypted),
+            ("skipped", decryption_metrics.skipped),
+            ("invalid", decryption_metrics.invalid),
+        ):
+            DECRYPTION_VALUES.set_total(total, result=result, **labels)
+
+    if log_server_client:
+        log_server_client_metrics = log_server_client.metrics
+
+        LOG_SERVER_QUEUE_DEPTH.set(log_server_client_metrics.queued, **labels)
+
+        for result, total in (
+            ("shipped", log_server_client_metrics.shipped),
+            ("dropped", log_server_client_metrics.dropped),
+            ("failed", log_server_client_metrics.failed),
+        ):
+            LOG_SERVER_RECORDS.set_total(total, result=result, **labels)
+
+        if log_server_client.spool:
+            spool_metrics = log_server_client.spool.metrics
+
+            SPOOL_SIZE.set(spool_metrics.size, **labels)
+            SPOOL_RECORDS.set_total(spool_metrics.spooled, result="spooled", **labels)
+            SPOOL_RECORDS.set_total(spool_metrics.dropped, result="dropped", **labels)
+
+    if idempotency_store:
+        idempotency_store_metrics = idempotency_store.metrics
+
+        IDEMPOTENCY_STORE_SIZE.set(idempotency_store_metrics.size, **labels)
+        IDEMPOTENCY_LOOKUPS.set_total(
+            idempotency_store_metrics.hits, result="hit", **labels
+        )
+        IDEMPOTENCY_LOOKUPS.set_total(
+            idempotency_store_metrics.misses, result="miss", **labels
+        )
+
+
+def reload_log_server_client(
+    log_server_client: Optional[LogServerClient],
+    log_server_config: Optional[LogServer],
+    config: Config,
+    rabbitmq: RabbitMQBase,
+) -> Optional[LogServerClient]:
+    """Get log server client for reloaded config.
+
+    If the log server was added, a client is created. If it was changed, the
+    current client is reconfigured. The queue and spool are kept, as changing
+    them requires a restart (this is logged when reloading). If it was removed,
+    None is returned; the caller should close the current client.
+    """
+    new_log_server_config = config.log_server
+
+    if new_log_server_config == log_server_config:
+        return log_server_client
+
+    if not new_log_server_config or not log_server_client or not log_server_config:
+        return get_log_server_client(config, rabbitmq)
+
+    log_server_client.reconfigure(
+        base_url=new_log_server_config.base_url,
+        api_token=new_log_server_config.api_token,
+        batch_size=new_log_server_config.batch_size,
+        flush_interval=new_log_server_config.flush_interval,
+        queue_full_policy=new_log_server_config.queue_full_policy,
+        spool_replay_rate=new_log_server_config.spool_replay_rate,
+    )
+
+    return log_server_client
+
+
+class Consumer:
+    """Consume RPC requests on virtual host.
+
+    Every virtual host has its own connections, worker pool, locks and log
+    server client. Exchange handlers and process pools may be shared between
+    virtual hosts.
+    """
+
+    def __init__(
+        self,
+        virtual_host_name: str,
+        config: Config,
+        exchange_handlers: Dict[str, ExchangeHandler],
+        process_pools: Dict[str, HandlerProcessPool],
+    ) -> None:
+        """Set attributes, and connect to RabbitMQ."""
+        self.config = config
+        self.exchange_handlers = exchange_handlers
+        self.process_pools = process_pools
+
+        self.rabbitmq = RabbitMQ(virtual_host_name, config)
+
+        self.lock_manager = LockManager()
+
+        # Create worker pool. As the amount of unacknowledged messages per channel
+        # is limited to the max amount of simultaneous requests (prefetch count),
+        # work items never queue for long.
+        #
+        # Processors are scheduled per lock key, so that processors waiting for
+        # a lock don't occupy a worker. As the scheduler is shared by all channels,
+        # this applies across channels, as do limits per exchange.
+
+        self.worker_pool = WorkerPool(
+            self.rabbitmq.virtual_host_config.max_simultaneous_requests
+            * len(self.rabbitmq.channels),
+            name=f"Worker-{virtual_host_name}",
+        )
+        self.scheduler = KeyedScheduler(
+            self.worker_pool,
+            limits=get_exchange_limits(self.rabbitmq.virtual_host_config),
+        )
+
+        # Prefetch count is adjusted to load, if adaptive prefetch is enabled
+
+        self.adaptive_prefetch = self.rabbitmq.virtual_host_config.adaptive_prefetch
+        self.prefetch_controller = get_prefetch_controller(
+            self.adaptive_prefetch,
+            self.rabbitmq.virtual_host_config.max_simultaneous_requests,
+        )
+        self.handler_latency = HandlerLatency(
+            self.rabbitmq.virtual_host_name,
+            [exchange.name for exchange in self.rabbitmq.virtual_host_config.exchanges],
+        )
+        self._prefetch_adjusted_at = time.monotonic()
+
+        self.timeout_tracker = TimeoutTracker()
+        self.timeouts = {
+            exchange.name: exchange.timeout
+            for exchange in self.rabbitmq.virtual_host_config.exchanges
+        }
+
+        # Identical RPC requests are coalesced on exchanges with single-flight
+        # enabled
+
+        self.single_flight: SingleFlight[ProcessorBase] = SingleFlight()
+        self.single_flight_exchanges = {
+            exchange.name
+            for exchange in self.rabbitmq.virtual_host_config.exchanges
+            if exchange.single_flight
+        }
+
+        self.log_server_config = config.log_server
+        self.log_server_client = get_log_server_client(config, self.rabbitmq)
+
+        self.idempotency_store = get_idempotency_store(config)
+
+        self.body_max_size = config.logging.body_max_size
+
+        REGISTRY.add_collector(self.collect_metrics)
+
+    def collect_metrics(self) -> None:
+        """Update metrics that reflect current state."""
+        labels = {"virtual_host": self.rabbitmq.virtual_host_name}
+
+        WORKERS_ACTIVE.set(self.worker_pool.metrics.active, **labels)
+        PREFETCH_COUNT.set(self.rabbitmq.prefetch_count, **labels)
+
+        collect_component_metrics(
+            self.rabbitmq,
+            exchange_handlers=self.exchange_handlers,
+            lock_manager=self.lock_manager,
+            timeout_tracker=self.timeout_tracker,
+            log_server_client=self.log_server_client,
+            idempotency_store=self.idempotency_store,
+        )
+
+    def adjust_prefetch(self) -> None:
+        """Adjust prefetch count to load, if adaptive prefetch is enabled.
+
+        Called periodically; adjusts once per interval.
+        """
+        if not self.prefetch_controller or not self.adaptive_prefetch:
+            return
+
+        now = time.monotonic()
+
+        if now - self._prefetch_adjusted_at < self.adaptive_prefetch.interval:
+            return
+
+        self._prefetch_adjusted_at = now
+
+        worker_pool_metrics = self.worker_pool.metrics
+        scheduler_metrics = self.scheduler.metrics
+
+        channels = len(self.rabbitmq.channels)
+
+        waiting = (
+            scheduler_metrics.waiting
+            + scheduler_metrics.limited
+            + self.lock_manager.metrics.waiting
+        )
+
+        prefetch_count = self.prefetch_controller.adjust(
+            latency=self.handler_latency.sample(),
+            saturation=worker_pool_metrics.active
+            / (self.rabbitmq.prefetch_count * channels),
+            waiting=waiting / channels,
+            memory=get_memory_usage(),
+        )
+
+        if prefetch_count == self.rabbitmq.prefetch_count:
+            return
+
+        logger.info(
+            "Adjusting prefetch count for virtual host '%s' from %s to %s",
+            self.rabbitmq.virtual_host_name,
+            self.rabbitmq.prefetch_count,
+            prefetch_count,
+        )
+
+        self.rabbitmq.set_prefetch_count(prefetch_count)
+
+    def reload(self, virtual_host_config: VirtualHost) -> None:
+        """Apply reloaded config, without interrupting RPC requests being processed.
+
+        Applies the max amount of simultaneous requests, log server config (mock
+        mode is read by processors), and exchanges that were added.
+        """
+        logger.info(
+            "Applying reloaded config for virtual host '%s'...",
+            self.rabbitmq.virtual_host_name,
+        )
+
+        for exchange in get_added_exchanges(
+            self.rabbitmq.virtual_host_config, virtual_host_config
+        ):
+            self.timeouts[exchange.name] = exchange.timeout
+
+            if exchange.single_flight:
+                self.single_flight_exchanges.add(exchange.name)
+
+            if exchange.max_simultaneous_requests is not None:
+                self.scheduler.set_limit(
+                    exchange.name, exchange.max_simultaneous_requests
+                )
+
+            self.handler_latency.add_exchange(exchange.name)
+
+        # The prefetch count is reset to the max amount of simultaneous
+        # requests. Adaptive prefetch lowers it again, if still overloaded.
+
+        self.rabbitmq.reload(virtual_host_config)
+
+        if self.prefetch_controller:
+            self.prefetch_controller.set_max_prefetch_count(
+                virtual_host_config.max_simultaneous_requests
+            )
+
+        self.worker_pool.resize(
+            self.rabbitmq.virtual_host_config.max_simultaneous_requests
+            * len(self.rabbitmq.channels)
+        )
+
+        # Processors keep using the client they were created with. So when the
+        # log server was removed, records of RPC requests being processed are
+        # dropped.
+
+        log_server_client = self.log_server_client
+
+        self.log_server_client = reload_log_server_client(
+            log_server_client, self.log_server_config, self.config, self.rabbitmq
+        )
+        self.log_server_config = self.config.log_server
+
+        if log_server_client and log_server_client is not self.log_server_client:
+            log_server_client.close()
+
+    def start_consuming(self) -> None:
+        """Start consuming on every channel."""
+        self.rabbitmq.start_consuming(self.callback)
+
+    def cancel(self) -> None:
+        """Stop receiving messages."""
+        logger.info(
+            "Cancelling consumers for virtual host '%s'...",
+            self.rabbitmq.virtual_host_name,
+        )
+
+        self.rabbitmq.cancel_consumers()
+
+    def drain(self) -> None:
+        """Wait for RPC requests being processed, and ship log server records."""
+        self.worker_pool.shutdown(wait=True)
+        self.timeout_tracker.close()
+
+        logger.info("Worker pool metrics: %s", self.worker_pool.metrics)
+        logger.info("Lock manager metrics: %s", self.lock_manager.metrics)
+        logger.info("Timeout tracker metrics: %s", self.timeout_tracker.metrics)
+
+        # Ship remaining log server records, which includes responses to RPC
+        # requests that were processed while draining the worker pool
+
+        if self.log_server_client:
+            self.log_server_client.close()
+
+            logger.info("Log server client metrics: %s", self.log_server_client.metrics)
+
+    def close(self) -> None:
+        """Close connections."""
+        logger.info(
+            "Closing connections for virtual host '%s'...",
+            self.rabbitmq.virtual_host_name,
+        )
+
+        self.rabbitmq.close()
+
+        REGISTRY.remove_collector(self.collect_metrics)
+
+        logger.info("Publish metrics: %s", self.rabbitmq.publish_metrics)
+
+        if self.rabbitmq.decryptor:
+            logger.info("Decryption metrics: %s", self.rabbitmq.decryptor.metrics)
+
+        if self.idempotency_store:
+            self.idempotency_store.close()
+
+            logger.info("Idempotency store metrics: %s", self.idempotency_store.metrics)
+
+        if self.prefetch_controller:
+            logger.info(
+                "Prefetch controller metrics: %s", self.prefetch_controller.metrics
+            )
+
+    def _reject(
+        self,
+        channel: pika.adapters.blocking_connection.BlockingChannel,
+        method: pika.spec.Basic.Deliver,
+        trace: Trace,
+        reason: str,
+    ) -> None:
+        """Reject message that can't be processed, so that it's not redelivered.
+
+        Called from the connection's thread. The message is dead-lettered, if a
+        dead-letter exchange is set.
+        """
+        RPC_REQUESTS_REJECTED.inc(
+            virtual_host=self.rabbitmq.virtual_host_name,
+            exchange=method.exchange,
+            reason=reason,
+        )
+
+        trace.set_attribute("rpc.rejected", reason)
+        trace.set_error()
+        trace.finish()
+
+        self.rabbitmq.reject(channel, method.delivery_tag)
+
+    def callback(
+        self,
+        channel: pika.adapters.blocking_connection.BlockingChannel,
+        method: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        body: bytes,
+    ) -> None:
+        """Pass RabbitMQ message to processor."""
+
+        request_logger = RPCRequestLoggerAdapter(
+            logger, method.exchange, properties.correlation_id
+        )
+
+        RPC_REQUESTS_RECEIVED.inc(
+            virtual_host=self.rabbitmq.virtual_host_name, exchange=method.exchange
+        )
+
+        # Trace RPC request, if sampled. The trace is finished by the processor.
+
+        trace = TRACER.start_trace(
+            properties.correlation_id,
+            {
+                "rpc.virtual_host": self.rabbitmq.virtual_host_name,
+                "rpc.exchange": method.exchange,
+                "rpc.redelivered": method.redelivered,
+            },
+        )
+
+        # Reject messages that were delivered too often, e.g. because processing
+        # them crashed the RabbitMQ consumer
+
+        max_deliveries = self.rabbitmq.virtual_host_config.max_deliveries
+
+        if (
+            max_deliveries is not None
+            and get_delivery_count(properties) >= max_deliveries
+        ):
+            request_logger.warning(
+                "Message delivered %s times or more, rejecting", max_deliveries
+            )
+
+            self._reject(channel, method, trace, REASON_MAX_DELIVERIES)
+
+            return
+
+        # Decrypt message, log it, and run processor. Messages that can't be
+        # decoded or validated are rejected, so that they're not redelivered.
+
+        try:
+            # If Fernet key is set, decrypt values opportunistically
+
+            with (
+                PHASE_DURATION.time(
+                    virtual_host=self.rabbitmq.virtual_host_name,
+                    exchange=method.exchange,
+                    phase=PHASE_DECRYPT,
+                ),
+                trace.span(PHASE_DECRYPT),
+            ):
+                payload, decrypted_values = decrypt_body(
+                    self.rabbitmq.decryptor, body, get_loads(self.config.json_backend)
+                )
+
+            # Log message. Decrypted values are redacted, rather than logging
+            # their ciphertext.
+
+            request_logger.info(
+                "Received RPC request. Body: '%s'",
+                LogBody(
+                    payload,
+                    max_size=self.body_max_size,
+                    decrypted_values=decrypted_values,
+                ),
+            )
+
+            # Run processor
+
+            processor = Processor(
+                exchange_handler=self.exchange_handlers[method.exchange],
+                rabbitmq=self.rabbitmq,
+                channel=channel,
+                method=method,
+                properties=properties,
+                lock_manager=self.lock_manager,
+                payload=payload,
+                log_server_client=self.log_server_client,
+                decrypted_values=decrypted_values,
+                process_pool=self.process_pools.get(method.exchange),
+                timeout=self.timeouts.get(method.exchange),
+                timeout_tracker=self.timeout_tracker,
+                trace=trace,
+                idempotency_store=self.idempotency_store,
+                single_flight=(
+                    self.single_flight
+                    if method.exchange in self.single_flight_exchanges
+                    else None
+                ),
+            )
+        except ValidationError:
+            # A validation error RPC response was published. Acknowledge after
+            # it, in the connection's thread.
+
+            request_logger.info("Request validation failed")
+
+            channel.connection.add_callback_threadsafe(
+                functools.partial(
+                    self.rabbitmq.acknowledge, channel, method.delivery_tag
+                )
+            )
+
+            trace.finish()
+
+            return
+        except MalformedBodyError:
+            request_logger.warning("Body is not a valid JSON object, rejecting")
+
+            self._reject(channel, method, trace, REASON_MALFORMED)
+
+            return
+        except Exception:
+            request_logger.exception("Exception preparing processor, rejecting")
+
+            self._reject(channel, method, trace, REASON_UNPROCESSABLE)
+
+            return
+
+        if processor.join_single_flight():
+            return
+
+        # Run processor in worker pool, once no other processor with the same lock
+        # key is running, and the exchange's limit allows. Messages with a higher
+        # priority run first. If the worker pool is shut down, the message is not
+        # acknowledged, so it will be redelivered. The same goes for identical
+        # RPC requests that joined it.
+
+        if not self.scheduler.submit(
+            processor.lock_key, processor, priority=properties.priority or 0
+        ):
+            request_logger.warning(
+                "Worker pool not accepting RPC requests, not processing"
+            )
+
+            processor.complete_single_flight()
+
+            trace.set_error()
+            trace.finish()
@@ -1,6 +1,6 @@
 """Contracts."""
 
-from typing import Optional
+from typing import Hashable, Optional
 
 from pydantic import BaseModel
 
@@ -40,6 +40,38 @@ class HandlerBase:
         """
         return None
 
+    @property
+    def cache_ttl(self) -> Optional[float]:
+        """Seconds to cache successful RPC responses. None disables caching.
+
+        Only cache RPC responses of handlers that don't change anything, and
+        whose RPC response depends only on the RPC request.
+        """
+        return None
+
+    @property
+    def cache_max_size(self) -> int:
+        """Max amount of cached RPC responses."""
+        return 1000
+
+    def cache_key(self, request: RPCRequestBase) -> Hashable:
+        """Get key to cache RPC response by. Defaults to the entire RPC request."""
+        return request.model_dump_json()
+
     def __call__(self, request: RPCRequestBase) -> RPCResponseBase:
         """Handle message."""
         raise NotImplementedError
+
+
+class AsyncHandlerBase(HandlerBase):
+    """Class to handle RPC requests, using asyncio.
+
+    With the asyncio engine, the handler runs on the event loop. Otherwise, it
+    runs to completion in a worker thread.
+    """
+
+    async def __call__(  # type: ignore[override]
+        self, request: RPCRequestBase
+    ) -> RPCResponseBase:
+        """Handle message."""
+        raise NotImplementedError
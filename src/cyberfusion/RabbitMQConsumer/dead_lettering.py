@@ -0,0 +1,30 @@
+"""Functions for dead-lettering messages."""
+
+import pika
+
+
+def get_delivery_count(properties: pika.spec.BasicProperties) -> int:
+    """Get amount of previous deliveries of message.
+
+    Quorum queues count deliveries in the `x-delivery-count` header. Otherwise,
+    deliveries are only counted when the message was dead-lettered before (and
+    routed back to the queue), in the `x-death` header. Without either header,
+    0 is returned.
+    """
+    headers = properties.headers or {}
+
+    delivery_count = headers.get("x-delivery-count")
+
+    if isinstance(delivery_count, int):
+        return delivery_count
+
+    deaths = headers.get("x-death")
+
+    if not isinstance(deaths, list):
+        return 0
+
+    return sum(
+        death["count"]
+        for death in deaths
+        if isinstance(death, dict) and isinstance(death.get("count"), int)
+    )
@@ -0,0 +1,138 @@
+"""Classes for decrypting RPC request values."""
+
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+
+from cyberfusion.RabbitMQConsumer.exceptions import MalformedBodyError
+from cyberfusion.RabbitMQConsumer.serialization import Loads
+
+# Fernet tokens start with the version byte (0x80), followed by the first bytes
+# of the timestamp, which are zero for the foreseeable future. Base64-encoded,
+# that's the following prefix.
+
+FERNET_TOKEN_PREFIX = "gAAAAA"
+
+# Fernet tokens consist of version (1 byte), timestamp (8 bytes), IV (16 bytes),
+# ciphertext (at least one 16 bytes block) and HMAC (32 bytes). That's at least
+# 73 bytes, which is 100 characters when base64-encoded.
+
+FERNET_TOKEN_MIN_LENGTH = 100
+
+
+@dataclass
+class DecryptionMetrics:
+    """Decryption metrics."""
+
+    decrypted: int
+    skipped: int
+    invalid: int
+
+
+def is_possible_fernet_token(value: str) -> bool:
+    """Determine if value may be a Fernet token, without doing any crypto."""
+    return len(value) >= FERNET_TOKEN_MIN_LENGTH and value.startswith(
+        FERNET_TOKEN_PREFIX
+    )
+
+
+def may_contain_fernet_token(body: bytes) -> bool:
+    """Determine if JSON body may contain a Fernet token, without parsing it.
+
+    Fernet tokens are URL-safe base64, so JSON encoders don't escape them.
+    """
+    return FERNET_TOKEN_PREFIX.encode() in body
+
+
+class Decryptor:
+    """Decrypt RPC request values using Fernet.
+
+    Multiple keys may be specified, to allow for key rotation. Values are
+    decrypted with the first key that is valid for them.
+    """
+
+    def __init__(self, keys: List[str]) -> None:
+        """Set attributes."""
+        if not keys:
+            raise ValueError("At least one Fernet key must be specified")
+
+        self.fernet = MultiFernet([Fernet(key) for key in keys])
+
+        self._lock = threading.Lock()
+
+        self._decrypted = 0
+        self._skipped = 0
+        self._invalid = 0
+
+    @property
+    def metrics(self) -> DecryptionMetrics:
+        """Get metrics."""
+        with self._lock:
+            return DecryptionMetrics(
+                decrypted=self._decrypted,
+                skipped=self._skipped,
+                invalid=self._invalid,
+            )
+
+    def decrypt_payload(self, payload: Dict[str, Any]) -> Tuple[dict, List[str]]:
+        """Decrypt values opportunistically.
+
+        Returns the payload with decrypted values, and the keys of those values.
+        """
+        decrypted_values = []
+
+        decrypted_payload = {}
+
+        decrypted = skipped = invalid = 0
+
+        for key, value in payload.items():
+            if isinstance(value, str):
+                if not is_possible_fernet_token(value):
+                    skipped += 1
+                else:
+                    try:
+                        value = self.fernet.decrypt(value.encode()).decode()
+
+                        decrypted_values.append(key)
+
+                        decrypted += 1
+                    except InvalidToken:
+                        # Not Fernet-encrypted, or not with any of our keys
+
+                        invalid += 1
+
+            decrypted_payload[key] = value
+
+        with self._lock:
+            self._decrypted += decrypted
+            self._skipped += skipped
+            self._invalid += invalid
+
+        return decrypted_payload, decrypted_values
+
+
+def decrypt_body(
+    decryptor: Optional[Decryptor], body: bytes, loads: Loads
+) -> Tuple[Union[dict, bytes], List[str]]:
+    """Decrypt values in JSON body opportunistically.
+
+    The body is only decoded if it may contain encrypted values. Otherwise, it's
+    returned as is, to be validated by Pydantic directly. Returns the payload,
+    and the keys of decrypted values.
+
+    Raises MalformedBodyError if the decoded body is not a JSON object.
+    """
+    if not decryptor or not may_contain_fernet_token(body):
+        return body, []
+
+    try:
+        decoded_body = loads(body)
+    except ValueError as e:
+        raise MalformedBodyError from e
+
+    if not isinstance(decoded_body, dict):
+        raise MalformedBodyError
+
+    return decryptor.decrypt_payload(decoded_body)
@@ -5,3 +5,21 @@ class VirtualHostNotExistsError(Exception):
     """Virtual host doesn't exist."""
 
     pass
+
+
+class HandlerTimeoutError(Exception):
+    """Handler didn't return within timeout."""
+
+    pass
+
+
+class ConfigInvalidError(Exception):
+    """Config file is invalid."""
+
+    pass
+
+
+class MalformedBodyError(Exception):
+    """Message body is not valid JSON, or not a JSON object."""
+
+    pass
@@ -0,0 +1,196 @@
+"""Classes for storing RPC responses, to replay them for redelivered messages."""
+
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from cyberfusion.RabbitMQConsumer.caching import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# RPC responses are stored per virtual host, exchange and correlation ID
+
+IdempotencyKey = Tuple[str, str, str]
+
+
+@dataclass
+class IdempotencyStoreMetrics:
+    """Idempotency store metrics."""
+
+    size: int
+    stored: int
+    hits: int
+    misses: int
+    expired: int
+
+
+class IdempotencyStore:
+    """Store published RPC responses, so they can be replayed.
+
+    When a message is redelivered after its RPC response was published (e.g.
+    because the acknowledgement never reached the broker), the stored response
+    is published again, rather than calling the handler again.
+
+    Responses are kept in memory, evicting the least recently used ones above
+    the max size, and expired ones after the TTL. If a path is set, responses
+    are also stored in an SQLite database, so they survive restarts.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_size: int = 10000,
+        ttl: float = 3600.0,
+        path: Optional[str] = None,
+    ) -> None:
+        """Set attributes, and open database if path is set."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+
+        self._lock = threading.Lock()
+
+        self._responses: TTLCache[IdempotencyKey, bytes] = TTLCache(
+            max_size=max_size, ttl=ttl
+        )
+
+        self._stored = 0
+        self._hits = 0
+        self._misses = 0
+
+        self._connection: Optional[sqlite3.Connection] = None
+
+        if path:
+            self._connection = self._open_database(path)
+
+    @staticmethod
+    def _open_database(path: str) -> sqlite3.Connection:
+        """Open database, and create table if needed.
+
+        In WAL mode with normal synchronisation, commits don't wait for fsync.
+        A power loss may lose the last responses, which are then processed
+        again, as without this store.
+        """
+        connection = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "virtual_host TEXT NOT NULL, "
+            "exchange TEXT NOT NULL, "
+            "correlation_id TEXT NOT NULL, "
+            "body BLOB NOT NULL, "
+            "expires_at REAL NOT NULL, "
+            "PRIMARY KEY (virtual_host, exchange, correlation_id))"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)"
+        )
+
+        connection.commit()
+
+        return connection
+
+    @property
+    def metrics(self) -> IdempotencyStoreMetrics:
+        """Get metrics."""
+        with self._lock:
+            cache_metrics = self._responses.metrics
+
+            return IdempotencyStoreMetrics(
+                size=cache_metrics.size,
+                stored=self._stored,
+                hits=self._hits,
+                misses=self._misses,
+                expired=cache_metrics.expired,
+            )
+
+    def get(self, key: IdempotencyKey) -> Optional[bytes]:
+        """Get stored response, if any and not expired."""
+        with self._lock:
+            body = self._responses.get(key)
+
+            if body is None and self._connection:
+                body = self._get_from_database(key)
+
+            if body is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+
+            return body
+
+    def _get_from_database(self, key: IdempotencyKey) -> Optional[bytes]:
+        """Get response from database, and keep it in memory.
+
+        Must be called with lock held. The database stores expiry times by wall
+        clock, so that they're kept across restarts.
+        """
+        assert self._connection
+
+        now = time.time()
+
+        try:
+            row = self._connection.execute(
+                "SELECT body, expires_at FROM responses "
+                "WHERE virtual_host = ? AND exchange = ? AND correlation_id = ? "
+                "AND expires_at > ?",
+                (*key, now),
+            ).fetchone()
+        except sqlite3.Error:
+            logger.exception("Failed to get RPC response from database")
+
+            return None
+
+        if not row:
+            return None
+
+        body, expires_at = row
+
+        self._responses.set(key, body, ttl=expires_at - now)
+
+        return body
+
+    def set(self, key: IdempotencyKey, body: bytes) -> None:
+        """Store response."""
+        with self._lock:
+            self._responses.set(key, body)
+
+            self._stored += 1
+
+            if not self._connection:
+                return
+
+            # Expired responses are deleted when storing, so that the database
+            # doesn't grow beyond the responses stored within the TTL
+
+            now = time.time()
+
+            try:
+                with self._connection:
+                    self._connection.execute(
+                        "DELETE FROM responses WHERE expires_at <= ?", (now,)
+                    )
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO responses "
+                        "(virtual_host, exchange, correlation_id, body, expires_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (*key, body, now + self.ttl),
+                    )
+            except sqlite3.Error:
+                logger.exception("Failed to store RPC response in database")
+
+    def close(self) -> None:
+        """Close database, if opened."""
+        with self._lock:
+            if not self._connection:
+                return
+
+            self._connection.close()
+
+            self._connection = None
@@ -0,0 +1,225 @@
+"""Classes for locking objects that RPC requests operate on."""
+
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List
+
+from cyberfusion.RabbitMQConsumer.types import LockKey
+
+
+@dataclass
+class LockManagerMetrics:
+    """Lock manager metrics."""
+
+    locks: int
+    waiting: int
+    acquisitions: int
+    contentions: int
+    wait_time: float
+
+
+class _LockEntry:
+    """Lock, with the amount of holders and waiters referencing it."""
+
+    __slots__ = ("lock", "references")
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        self.lock = threading.Lock()
+        self.references = 0
+
+
+class _Shard:
+    """Part of lock table, with its own mutex."""
+
+    __slots__ = ("mutex", "entries")
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        self.mutex = threading.Lock()
+        self.entries: Dict[LockKey, _LockEntry] = {}
+
+
+class LockManager:
+    """Manage locks per key.
+
+    Locks are created when first acquired, and removed when no longer held or
+    waited for. Therefore, the amount of locks is bounded by the amount of RPC
+    requests in progress, rather than the amount of distinct keys ever seen.
+
+    The lock table is split into shards, each with its own mutex, so that
+    threads operating on different keys rarely contend.
+    """
+
+    def __init__(self, shards: int = 16) -> None:
+        """Set attributes."""
+        self._shards: List[_Shard] = [_Shard() for _ in range(shards)]
+
+        self._metrics_lock = threading.Lock()
+
+        self._acquisitions = 0
+        self._contentions = 0
+        self._wait_time = 0.0
+
+    @property
+    def metrics(self) -> LockManagerMetrics:
+        """Get metrics."""
+        locks = 0
+        references = 0
+
+        for shard in self._shards:
+            with shard.mutex:
+                locks += len(shard.entries)
+                references += sum(entry.references for entry in shard.entries.values())
+
+        with self._metrics_lock:
+            return LockManagerMetrics(
+                locks=locks,
+                waiting=references - locks,
+                acquisitions=self._acquisitions,
+                contentions=self._contentions,
+                wait_time=self._wait_time,
+            )
+
+    def _get_shard(self, key: LockKey) -> _Shard:
+        """Get shard that key belongs to."""
+        return self._shards[hash(key) % len(self._shards)]
+
+    def acquire(self, key: LockKey) -> float:
+        """Acquire lock for key, and return seconds waited for it."""
+        shard = self._get_shard(key)
+
+        # Get or create lock, and reference it, so that it isn't removed while
+        # waiting for it
+
+        with shard.mutex:
+            entry = shard.entries.get(key)
+
+            if entry is None:
+                entry = shard.entries[key] = _LockEntry()
+
+            entry.references += 1
+
+        wait_time = 0.0
+
+        contended = not entry.lock.acquire(blocking=False)
+
+        if contended:
+            start_time = time.monotonic()
+
+            entry.lock.acquire()
+
+            wait_time = time.monotonic() - start_time
+
+        with self._metrics_lock:
+            self._acquisitions += 1
+            self._wait_time += wait_time
+
+            if contended:
+                self._contentions += 1
+
+        return wait_time
+
+    def release(self, key: LockKey) -> None:
+        """Release lock for key, and remove it if it's no longer referenced."""
+        shard = self._get_shard(key)
+
+        with shard.mutex:
+            entry = shard.entries[key]
+
+            entry.lock.release()
+
+            entry.references -= 1
+
+            if not entry.references:
+                del shard.entries[key]
+
+
+class _AsyncioLockEntry:
+    """Asyncio lock, with the amount of holders and waiters referencing it."""
+
+    __slots__ = ("lock", "references")
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        self.lock = asyncio.Lock()
+        self.references = 0
+
+
+class AsyncioLockManager:
+    """Manage asyncio locks per key.
+
+    Like the lock manager, but for tasks on a single event loop. As all tasks
+    run on the same thread, the lock table needs no mutex.
+    """
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        self._entries: Dict[LockKey, _AsyncioLockEntry] = {}
+
+        self._acquisitions = 0
+        self._contentions = 0
+        self._wait_time = 0.0
+
+    @property
+    def metrics(self) -> LockManagerMetrics:
+        """Get metrics."""
+        return LockManagerMetrics(
+            locks=len(self._entries),
+            waiting=sum(entry.references for entry in self._entries.values())
+            - len(self._entries),
+            acquisitions=self._acquisitions,
+            contentions=self._contentions,
+            wait_time=self._wait_time,
+        )
+
+    async def acquire(self, key: LockKey) -> float:
+        """Acquire lock for key, and return seconds waited for it."""
+        entry = self._entries.get(key)
+
+        if entry is None:
+            entry = self._entries[key] = _AsyncioLockEntry()
+
+        entry.references += 1
+
+        wait_time = 0.0
+
+        contended = entry.lock.locked()
+
+        try:
+            start_time = time.monotonic()
+
+            await entry.lock.acquire()
+
+            wait_time = time.monotonic() - start_time
+        except BaseException:
+            # Don't leak the reference when cancelled while waiting
+
+            self._dereference(key, entry)
+
+            raise
+
+        self._acquisitions += 1
+        self._wait_time += wait_time
+
+        if contended:
+            self._contentions += 1
+
+        return wait_time
+
+    def release(self, key: LockKey) -> None:
+        """Release lock for key, and remove it if it's no longer referenced."""
+        entry = self._entries[key]
+
+        entry.lock.release()
+
+        self._dereference(key, entry)
+
+    def _dereference(self, key: LockKey, entry: _AsyncioLockEntry) -> None:
+        """Remove reference to lock, and remove lock if it's unreferenced."""
+        entry.references -= 1
+
+        if not entry.references:
+            del self._entries[key]
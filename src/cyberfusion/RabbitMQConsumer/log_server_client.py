@@ -1,8 +1,16 @@
+import queue
+import threading
+import time
+from dataclasses import asdict, dataclass
+
 import requests
 import logging
 from cyberfusion.Common import get_hostname
 from typing import List
-from cyberfusion.RabbitMQConsumer.rabbitmq import RabbitMQ
+from cyberfusion.RabbitMQConsumer.config import QueueFullPolicy
+from cyberfusion.RabbitMQConsumer.metrics import LOG_SERVER_SHIP_DURATION
+from cyberfusion.RabbitMQConsumer.rabbitmq import RabbitMQBase
+from cyberfusion.RabbitMQConsumer.spool import Spool
 from cyberfusion.RabbitMQConsumer.utilities import join_url_parts
 from typing import Optional
 from requests.adapters import HTTPAdapter, Retry
@@ -10,15 +18,94 @@ from functools import cached_property
 
 logger = logging.getLogger(__name__)
 
+PATH_RPC_REQUESTS = "rpc-requests"
+PATH_RPC_RESPONSES = "rpc-responses"
+PATH_BATCH = "batch"
+
+SPOOL_RETRY_INTERVAL = 10.0
+
+# When closing with a spool, records still queued after this many seconds are
+# spooled, rather than shipped
+
+DRAIN_TIMEOUT = 10.0
+
+
+@dataclass
+class LogRecord:
+    """Record to ship to log server."""
+
+    path: str
+    payload: dict
+
+
+@dataclass
+class LogServerClientMetrics:
+    """Log server client metrics."""
+
+    queued: int
+    shipped: int
+    dropped: int
+    failed: int
+
 
 class LogServerClient:
-    """Log server client."""
+    """Log server client.
+
+    Records are queued, and shipped by a background thread. Therefore, RPC
+    requests don't wait for the log server.
 
-    def __init__(self, base_url: str, api_token: str, rabbitmq: RabbitMQ) -> None:
-        """Set attributes."""
+    If a spool is passed, records that can't be shipped are spooled to disk,
+    and replayed at the replay rate once the log server is reachable again.
+    Replayed records are shipped at least once.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_token: str,
+        rabbitmq: RabbitMQBase,
+        *,
+        queue_size: int = 1000,
+        batch_size: int = 1,
+        flush_interval: float = 1.0,
+        queue_full_policy: QueueFullPolicy = QueueFullPolicy.DROP,
+        spool: Optional[Spool] = None,
+        spool_replay_rate: float = 100.0,
+    ) -> None:
+        """Set attributes and start shipping thread."""
         self.base_url = base_url
         self.api_token = api_token
         self.rabbitmq = rabbitmq
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_full_policy = queue_full_policy
+        self.spool = spool
+        self.spool_replay_rate = spool_replay_rate
+
+        if self.queue_full_policy == QueueFullPolicy.SPILL and not self.spool:
+            raise ValueError("Queue full policy 'spill' requires spool")
+
+        self._queue: "queue.Queue[Optional[LogRecord]]" = queue.Queue(
+            maxsize=queue_size
+        )
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopping = False
+        self._drain_deadline = 0.0
+
+        self._shipped = 0
+        self._dropped = 0
+        self._failed = 0
+
+        self._replay_path: Optional[str] = None
+        self._replay_records: List[LogRecord] = []
+        self._next_replay = 0.0
+
+        self._thread = threading.Thread(
+            target=self._ship, name="LogServerClient", daemon=True
+        )
+
+        self._thread.start()
 
     @cached_property
     def session(self) -> requests.sessions.Session:
@@ -38,17 +125,69 @@ class LogServerClient:
 
         return session
 
+    def reconfigure(
+        self,
+        *,
+        base_url: str,
+        api_token: str,
+        batch_size: int,
+        flush_interval: float,
+        queue_full_policy: QueueFullPolicy,
+        spool_replay_rate: float,
+    ) -> None:
+        """Apply reloaded config. Takes effect for the next batch.
+
+        The queue and spool can't be changed, as they may contain records.
+        """
+        if queue_full_policy == QueueFullPolicy.SPILL and not self.spool:
+            raise ValueError("Queue full policy 'spill' requires spool")
+
+        self.base_url = base_url
+        self.api_token = api_token
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_full_policy = queue_full_policy
+        self.spool_replay_rate = spool_replay_rate
+
+        # The session is bound to the base URL and API token, so create a new
+        # one on next use
+
+        self.__dict__.pop("session", None)
+
+    @cached_property
+    def hostname(self) -> str:
+        """Get hostname."""
+        return get_hostname()
+
+    @property
+    def metrics(self) -> LogServerClientMetrics:
+        """Get metrics."""
+        with self._lock:
+            return LogServerClientMetrics(
+                queued=self._queue.qsize(),
+                shipped=self._shipped,
+                dropped=self._dropped,
+                failed=self._failed,
+            )
+
     @staticmethod
-    def handle_request(request: requests.models.Response) -> None:
+    def handle_request(request: requests.models.Response) -> bool:
+        """Log result of request, and return whether it succeeded."""
         try:
             request.raise_for_status()
         except requests.exceptions.HTTPError as e:
             logger.warning(
                 "HTTP %s error on %s: %s",
-                (e.response.status_code, e.request.url, e.response.text),
+                e.response.status_code,
+                e.request.url,
+                e.response.text,
             )
 
-        logger.debug("HTTP request on %s succeeded: %s", (request.url, request.text))
+            return False
+
+        logger.debug("HTTP request on %s succeeded: %s", request.url, request.text)
+
+        return True
 
     def log_rpc_request(
         self,
@@ -59,35 +198,280 @@ class LogServerClient:
         exchange_name: str,
     ) -> None:
         """Log RPC request."""
-        for decrypted_value in decrypted_values:
-            request_payload[decrypted_value] = "*****"
-
-        request = self.session.post(
-            join_url_parts(self.base_url, "rpc-requests"),
-            json={
-                "correlation_id": correlation_id,
-                "request_payload": request_payload,
-                "virtual_host_name": self.rabbitmq.virtual_host_name,
-                "queue_name": self.rabbitmq.virtual_host_config.queue,
-                "rabbitmq_username": self.rabbitmq.config.server.username,
-                "hostname": get_hostname(),
-                "exchange_name": exchange_name,
-            },
-        )
+        # Don't modify the passed payload, as the caller may still use it
+
+        request_payload = {
+            key: "*****" if key in decrypted_values else value
+            for key, value in request_payload.items()
+        }
 
-        self.handle_request(request)
+        self._enqueue(
+            LogRecord(
+                path=PATH_RPC_REQUESTS,
+                payload={
+                    "correlation_id": correlation_id,
+                    "request_payload": request_payload,
+                    "virtual_host_name": self.rabbitmq.virtual_host_name,
+                    "queue_name": self.rabbitmq.virtual_host_config.queue,
+                    "rabbitmq_username": self.rabbitmq.config.server.username,
+                    "hostname": self.hostname,
+                    "exchange_name": exchange_name,
+                },
+            )
+        )
 
     def log_rpc_response(
         self, *, correlation_id: str, response_payload: dict, traceback: Optional[str]
     ) -> None:
         """Log RPC response."""
-        request = self.session.post(
-            join_url_parts(self.base_url, "rpc-responses"),
-            json={
-                "correlation_id": correlation_id,
-                "response_payload": response_payload,
-                "traceback": traceback,
-            },
+        self._enqueue(
+            LogRecord(
+                path=PATH_RPC_RESPONSES,
+                payload={
+                    "correlation_id": correlation_id,
+                    "response_payload": response_payload,
+                    "traceback": traceback,
+                },
+            )
         )
 
-        self.handle_request(request)
+    def close(self) -> None:
+        """Stop accepting records, and ship queued ones."""
+        with self._lock:
+            if self._closed:
+                return
+
+            self._closed = True
+
+        # Wake up shipping thread. Block if the queue is full, as the shipping
+        # thread is still emptying it.
+
+        self._queue.put(None)
+
+        logger.info("Waiting for log server records to be shipped...")
+
+        self._thread.join()
+
+    def _enqueue(self, record: LogRecord) -> None:
+        """Queue record for shipping, or apply queue full policy."""
+        if self._closed:
+            logger.warning(
+                "Log server client closed, dropping record for '%s'", record.path
+            )
+
+            with self._lock:
+                self._dropped += 1
+
+            return
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.spool and self.queue_full_policy == QueueFullPolicy.SPILL:
+                logger.warning(
+                    "Log server queue full, spooling record for '%s'", record.path
+                )
+
+                self.spool.append([asdict(record)])
+
+                return
+
+            logger.warning(
+                "Log server queue full, dropping record for '%s'", record.path
+            )
+
+            with self._lock:
+                self._dropped += 1
+
+    @property
+    def _is_replaying(self) -> bool:
+        """Determine if there are spooled records that weren't replayed yet."""
+        if not self.spool:
+            return False
+
+        return bool(self._replay_records) or not self.spool.is_empty
+
+    def _get_batch(self) -> List[LogRecord]:
+        """Get records to ship.
+
+        Waits until the batch size is reached, or the flush interval passed. When
+        closing, doesn't wait. When replaying, doesn't wait past the next replay.
+        """
+        batch: List[LogRecord] = []
+
+        deadline = time.monotonic() + self.flush_interval
+
+        if self._is_replaying:
+            deadline = min(deadline, self._next_replay)
+
+        while len(batch) < self.batch_size:
+            timeout = 0.0 if self._stopping else max(deadline - time.monotonic(), 0)
+
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if record is None:
+                self._stopping = True
+                self._drain_deadline = time.monotonic() + DRAIN_TIMEOUT
+
+                continue
+
+            batch.append(record)
+
+        return batch
+
+    def _ship(self) -> None:
+        """Ship queued records until closed, and all queued records are shipped."""
+        while True:
+            batch = self._get_batch()
+
+            try:
+                if batch:
+                    self._ship_batch(batch)
+
+                if self._stopping and self._queue.empty():
+                    return
+
+                self._replay()
+            except Exception:
+                logger.exception("Unhandled exception shipping log server records")
+
+    def _ship_batch(self, records: List[LogRecord]) -> None:
+        """Ship records, or spool them if they can't be shipped.
+
+        While spooled records weren't replayed yet, records are spooled directly,
+        to keep them in order. When closing, records are still shipped; only once
+        shipping failed (so records are being replayed) or the drain timeout
+        passed, they're spooled directly, to exit quickly.
+        """
+        is_drain_expired = self._stopping and time.monotonic() >= self._drain_deadline
+
+        if self.spool and (self._is_replaying or is_drain_expired):
+            self.spool.append([asdict(record) for record in records])
+
+            return
+
+        failed_records = self._send(records)
+
+        if not failed_records:
+            return
+
+        if not self.spool:
+            logger.warning(
+                "Failed to ship %s records to log server, dropping",
+                len(failed_records),
+            )
+
+            return
+
+        logger.warning(
+            "Failed to ship %s records to log server, spooling", len(failed_records)
+        )
+
+        self.spool.append([asdict(record) for record in failed_records])
+
+        self._next_replay = time.monotonic() + SPOOL_RETRY_INTERVAL
+
+    def _replay(self) -> None:
+        """Ship spooled records, at the replay rate.
+
+        Records are read from the spool one segment at a time. Every call ships
+        at most one batch. A segment is removed once all its records are shipped.
+        When shipping fails, replaying is retried after the retry interval.
+        """
+        if not self.spool or time.monotonic() < self._next_replay:
+            return
+
+        if not self._replay_records:
+            segment = self.spool.read_oldest_segment()
+
+            if not segment:
+                return
+
+            self._replay_path, records = segment
+
+            self._replay_records = [LogRecord(**record) for record in records]
+
+            logger.info(
+                "Replaying %s spooled records from '%s'...",
+                len(self._replay_records),
+                self._replay_path,
+            )
+
+        records = self._replay_records[: self.batch_size]
+
+        failed_records = self._send(records)
+
+        # Retry failed records first, so that they stay in order. Don't retry
+        # records that succeeded.
+
+        self._replay_records = failed_records + self._replay_records[len(records) :]
+
+        if failed_records:
+            logger.warning(
+                "Failed to replay spooled records, retrying in %s seconds",
+                SPOOL_RETRY_INTERVAL,
+            )
+
+            self._next_replay = time.monotonic() + SPOOL_RETRY_INTERVAL
+
+            return
+
+        self._next_replay = time.monotonic() + len(records) / self.spool_replay_rate
+
+        if not self._replay_records and self._replay_path:
+            self.spool.remove_segment(self._replay_path)
+
+            logger.info("Replayed spooled records from '%s'", self._replay_path)
+
+            self._replay_path = None
+
+    def _send(self, records: List[LogRecord]) -> List[LogRecord]:
+        """Send records to log server, and return the records that failed.
+
+        If the batch size is larger than one, records are sent to the batch
+        endpoints. Records are sent in order, per path. As responses are always
+        queued after their requests, requests are sent first.
+        """
+        failed_records = []
+
+        with LOG_SERVER_SHIP_DURATION.time():
+            for path in (PATH_RPC_REQUESTS, PATH_RPC_RESPONSES):
+                path_records = [record for record in records if record.path == path]
+
+                if not path_records:
+                    continue
+
+                if self.batch_size > 1:
+                    if not self._post(
+                        join_url_parts(self.base_url, path, PATH_BATCH),
+                        [record.payload for record in path_records],
+                    ):
+                        failed_records.extend(path_records)
+
+                    continue
+
+                for record in path_records:
+                    if not self._post(
+                        join_url_parts(self.base_url, path), record.payload
+                    ):
+                        failed_records.append(record)
+
+        with self._lock:
+            self._shipped += len(records) - len(failed_records)
+            self._failed += len(failed_records)
+
+        return failed_records
+
+    def _post(self, url: str, json: object) -> bool:
+        """Send POST request to log server, and return whether it succeeded."""
+        try:
+            request = self.session.post(url, json=json)
+        except requests.exceptions.RequestException as e:
+            logger.warning("HTTP request on %s failed: %s", url, e)
+
+            return False
+
+        return self.handle_request(request)
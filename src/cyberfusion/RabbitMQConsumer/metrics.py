@@ -0,0 +1,647 @@
+"""Classes for exposing metrics in the Prometheus text format."""
+
+import bisect
+import contextlib
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, Union
+
+from cyberfusion.RabbitMQConsumer.config import Metrics
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PATH_METRICS = "/metrics"
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+LabelValues = Tuple[str, ...]
+Collector = Callable[[], None]
+
+
+def _format_value(value: float) -> str:
+    """Format sample value."""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value))
+
+
+def _escape_label_value(value: str) -> str:
+    """Escape label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str]) -> str:
+    """Format labels, including braces. Returns empty string if no labels."""
+    if not label_names:
+        return ""
+
+    return (
+        "{"
+        + ",".join(
+            f'{name}="{_escape_label_value(value)}"'
+            for name, value in zip(label_names, label_values)
+        )
+        + "}"
+    )
+
+
+class _Metric:
+    """Metric with samples per combination of label values."""
+
+    TYPE = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, label_names: Sequence[str] = ()
+    ) -> None:
+        """Set attributes."""
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+        self._lock = threading.Lock()
+
+    def _get_label_values(self, labels: Dict[str, str]) -> LabelValues:
+        """Get label values in order of label names."""
+        if set(labels) != set(self.label_names):
+            raise ValueError(
+                f"Metric '{self.name}' requires labels {list(self.label_names)}"
+            )
+
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _collect_samples(self) -> List[str]:
+        """Get sample lines."""
+        raise NotImplementedError
+
+    def collect(self) -> List[str]:
+        """Get lines, including help and type."""
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ] + self._collect_samples()
+
+
+class Counter(_Metric):
+    """Counter, which only increases."""
+
+    TYPE = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, label_names: Sequence[str] = ()
+    ) -> None:
+        """Set attributes."""
+        super().__init__(name, documentation, label_names)
+
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """Increase counter."""
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+
+        label_values = self._get_label_values(labels)
+
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        """Get value."""
+        with self._lock:
+            return self._values.get(self._get_label_values(labels), 0.0)
+
+    def set_total(self, value: float, **labels: str) -> None:
+        """Set value to total counted by a component, for collectors.
+
+        The total only decreases when the component is replaced, which
+        Prometheus handles as a counter reset.
+        """
+        label_values = self._get_label_values(labels)
+
+        with self._lock:
+            self._values[label_values] = value
+
+    def _collect_samples(self) -> List[str]:
+        """Get sample lines."""
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}"
+                for label_values, value in self._values.items()
+            ]
+
+
+class Gauge(Counter):
+    """Gauge, which can increase and decrease."""
+
+    TYPE = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """Increase gauge."""
+        label_values = self._get_label_values(labels)
+
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        """Decrease gauge."""
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set gauge."""
+        label_values = self._get_label_values(labels)
+
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    """Histogram, counting observations in cumulative buckets."""
+
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        *,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Set attributes."""
+        super().__init__(name, documentation, label_names)
+
+        self.buckets = tuple(sorted(buckets))
+
+        # Map label values to counts per bucket (including '+Inf'), and sum.
+        # Counts per bucket are not cumulative; they're summed when collecting.
+
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Observe value."""
+        label_values = self._get_label_values(labels)
+
+        # Index of first bucket that value fits in. Values larger than the
+        # largest bucket only count towards '+Inf'.
+
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            if label_values not in self._values:
+                self._values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+
+            bucket_counts, total = self._values[label_values]
+
+            bucket_counts[index] += 1
+            total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe duration of block, in seconds."""
+        start_time = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time, **labels)
+
+    def get_count(self, **labels: str) -> int:
+        """Get amount of observations."""
+        with self._lock:
+            values = self._values.get(self._get_label_values(labels))
+
+            if not values:
+                return 0
+
+            return sum(values[0])
+
+    def get_sum(self, **labels: str) -> float:
+        """Get sum of observations."""
+        with self._lock:
+            values = self._values.get(self._get_label_values(labels))
+
+            if not values:
+                return 0.0
+
+            return values[1][0]
+
+    def _collect_samples(self) -> List[str]:
+        """Get sample lines."""
+        lines = []
+
+        label_names = self.label_names + ("le",)
+
+        with self._lock:
+            for label_values, (bucket_counts, total) in self._values.items():
+                cumulative_count = 0
+
+                for bucket, bucket_count in zip(
+                    self.buckets + (math.inf,), bucket_counts
+                ):
+                    cumulative_count += bucket_count
+
+                    lines.append(
+                        f"{self.name}_bucket{_format_labels(label_names, label_values + (_format_value(bucket),))} {cumulative_count}"
+                    )
+
+                labels = _format_labels(self.label_names, label_values)
+
+                lines.append(f"{self.name}_sum{labels} {_format_value(total[0])}")
+                lines.append(f"{self.name}_count{labels} {cumulative_count}")
+
+        return lines
+
+
+class MetricsRegistry:
+    """Registry of metrics.
+
+    Collectors are called before rendering, so that gauges that reflect
+    current state (such as queue depths) are updated on demand, rather than on
+    the hot path.
+    """
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        self._lock = threading.Lock()
+
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Collector] = []
+
+    def _register(self, metric: _Metric) -> None:
+        """Add metric."""
+        with self._lock:
+            self._metrics.append(metric)
+
+    def counter(
+        self, name: str, documentation: str, label_names: Sequence[str] = ()
+    ) -> Counter:
+        """Add counter."""
+        counter = Counter(name, documentation, label_names)
+
+        self._register(counter)
+
+        return counter
+
+    def gauge(
+        self, name: str, documentation: str, label_names: Sequence[str] = ()
+    ) -> Gauge:
+        """Add gauge."""
+        gauge = Gauge(name, documentation, label_names)
+
+        self._register(gauge)
+
+        return gauge
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        *,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Add histogram."""
+        histogram = Histogram(name, documentation, label_names, buckets=buckets)
+
+        self._register(histogram)
+
+        return histogram
+
+    def add_collector(self, collector: Collector) -> None:
+        """Add function that updates metrics before rendering."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector: Collector) -> None:
+        """Remove collector."""
+        with self._lock:
+            self._collectors.remove(collector)
+
+    def render(self) -> str:
+        """Get metrics in Prometheus text format."""
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics)
+
+        for collector in collectors:
+            try:
+                collector()
+            except Exception:
+                logger.exception("Unhandled exception in metrics collector")
+
+        lines = []
+
+        for metric in metrics:
+            lines.extend(metric.collect())
+
+        return "\n".join(lines) + "\n"
+
+
+# Metrics are process-wide, like exchange handlers
+
+REGISTRY = MetricsRegistry()
+
+RPC_REQUESTS_RECEIVED = REGISTRY.counter(
+    "rabbitmq_consumer_rpc_requests_received_total",
+    "RPC requests received.",
+    ["virtual_host", "exchange"],
+)
+RPC_REQUESTS_PROCESSED = REGISTRY.counter(
+    "rabbitmq_consumer_rpc_requests_processed_total",
+    "RPC requests processed, by outcome.",
+    ["virtual_host", "exchange", "outcome"],
+)
+RPC_REQUESTS_COALESCED = REGISTRY.counter(
+    "rabbitmq_consumer_rpc_requests_coalesced_total",
+    "RPC requests that got the RPC response of an identical RPC request.",
+    ["virtual_host", "exchange"],
+)
+RPC_REQUESTS_REJECTED = REGISTRY.counter(
+    "rabbitmq_consumer_rpc_requests_rejected_total",
+    "RPC requests rejected without processing, by reason.",
+    ["virtual_host", "exchange", "reason"],
+)
+RPC_REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "rabbitmq_consumer_rpc_requests_in_flight",
+    "RPC requests being processed, including those waiting for a lock.",
+    ["virtual_host", "exchange"],
+)
+PHASE_DURATION = REGISTRY.histogram(
+    "rabbitmq_consumer_phase_duration_seconds",
+    "Duration of phases of processing RPC requests.",
+    ["virtual_host", "exchange", "phase"],
+)
+LOG_SERVER_QUEUE_DEPTH = REGISTRY.gauge(
+    "rabbitmq_consumer_log_server_queue_depth",
+    "Log server records waiting to be shipped.",
+    ["virtual_host"],
+)
+LOG_SERVER_SHIP_DURATION = REGISTRY.histogram(
+    "rabbitmq_consumer_log_server_ship_duration_seconds",
+    "Duration of shipping batches of records to log server.",
+)
+WORKERS_ACTIVE = REGISTRY.gauge(
+    "rabbitmq_consumer_workers_active",
+    "Workers processing RPC requests.",
+    ["virtual_host"],
+)
+RESULT_CACHE_LOOKUPS = REGISTRY.counter(
+    "rabbitmq_consumer_result_cache_lookups_total",
+    "Lookups of cached RPC responses, by result (hit or miss).",
+    ["virtual_host", "exchange", "result"],
+)
+PREFETCH_COUNT = REGISTRY.gauge(
+    "rabbitmq_consumer_prefetch_count",
+    "Prefetch count per channel.",
+    ["virtual_host"],
+)
+LOCKS_HELD = REGISTRY.gauge(
+    "rabbitmq_consumer_locks",
+    "Locks held or waited for.",
+    ["virtual_host"],
+)
+LOCK_ACQUISITIONS = REGISTRY.counter(
+    "rabbitmq_consumer_lock_acquisitions_total",
+    "Locks acquired.",
+    ["virtual_host"],
+)
+LOCK_CONTENTIONS = REGISTRY.counter(
+    "rabbitmq_consumer_lock_contentions_total",
+    "Locks acquired after waiting for them.",
+    ["virtual_host"],
+)
+LOCK_WAIT_TIME = REGISTRY.counter(
+    "rabbitmq_consumer_lock_wait_seconds_total",
+    "Time spent waiting for locks.",
+    ["virtual_host"],
+)
+DECRYPTION_VALUES = REGISTRY.counter(
+    "rabbitmq_consumer_decryption_values_total",
+    "RPC request values checked for encryption, by result (decrypted, skipped or invalid).",
+    ["virtual_host", "result"],
+)
+HANDLER_TIMEOUTS = REGISTRY.counter(
+    "rabbitmq_consumer_handler_timeouts_total",
+    "Handler calls that timed out.",
+    ["virtual_host", "exchange"],
+)
+QUARANTINED_THREADS = REGISTRY.gauge(
+    "rabbitmq_consumer_quarantined_threads",
+    "Threads of handler calls that timed out, and are still running.",
+    ["virtual_host"],
+)
+LOG_SERVER_RECORDS = REGISTRY.counter(
+    "rabbitmq_consumer_log_server_records_total",
+    "Log server records, by result (shipped, dropped or failed).",
+    ["virtual_host", "result"],
+)
+SPOOL_SIZE = REGISTRY.gauge(
+    "rabbitmq_consumer_spool_size_bytes",
+    "Size of log server records spooled to disk.",
+    ["virtual_host"],
+)
+SPOOL_RECORDS = REGISTRY.counter(
+    "rabbitmq_consumer_spool_records_total",
+    "Log server records spooled to disk, by result (spooled or dropped).",
+    ["virtual_host", "result"],
+)
+IDEMPOTENCY_LOOKUPS = REGISTRY.counter(
+    "rabbitmq_consumer_idempotency_lookups_total",
+    "Lookups of stored RPC responses, by result (hit or miss).",
+    ["virtual_host", "result"],
+)
+IDEMPOTENCY_STORE_SIZE = REGISTRY.gauge(
+    "rabbitmq_consumer_idempotency_store_size",
+    "RPC responses stored for idempotency.",
+    ["virtual_host"],
+)
+RESULT_CACHE_SIZE = REGISTRY.gauge(
+    "rabbitmq_consumer_result_cache_size",
+    "Cached RPC responses.",
+    ["virtual_host", "exchange"],
+)
+
+OUTCOME_SUCCEEDED = "succeeded"
+OUTCOME_FAILED = "failed"
+OUTCOME_VALIDATION_FAILED = "validation_failed"
+OUTCOME_MOCKED = "mocked"
+OUTCOME_TIMED_OUT = "timed_out"
+OUTCOME_REPLAYED = "replayed"
+
+REASON_MALFORMED = "malformed"
+REASON_MAX_DELIVERIES = "max_deliveries"
+REASON_UNPROCESSABLE = "unprocessable"
+
+PHASE_DECRYPT = "decrypt"
+PHASE_VALIDATE = "validate"
+PHASE_LOCK_WAIT = "lock_wait"
+PHASE_HANDLER = "handler"
+PHASE_PUBLISH = "publish"
+PHASE_LOG_SHIPPING = "log_shipping"
+PHASE_ACKNOWLEDGE = "acknowledge"
+
+
+class MetricsServer:
+    """Serve metrics over HTTP, in a background thread."""
+
+    def __init__(
+        self, registry: MetricsRegistry, listen_address: str, port: int
+    ) -> None:
+        """Set attributes and start serving."""
+        self.registry = registry
+
+        registry_ = registry
+
+        class _RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != PATH_METRICS:
+                    self.send_error(404)
+
+                    return
+
+                body = registry_.render().encode("utf-8")
+
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((listen_address, port), _RequestHandler)
+        self._server.daemon_threads = True
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="MetricsServer", daemon=True
+        )
+
+        self._thread.start()
+
+        logger.info(
+            "Serving metrics on http://%s:%s%s",
+            listen_address,
+            self._server.server_port,
+            PATH_METRICS,
+        )
+
+    @property
+    def port(self) -> int:
+        """Get port that is listened on."""
+        return self._server.server_port
+
+    def close(self) -> None:
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+
+        self._thread.join()
+
+
+class MetricsTextfileWriter:
+    """Write metrics to file periodically, e.g. for node_exporter's textfile
+    collector.
+
+    The file is replaced atomically, so that it's never read partially.
+    """
+
+    def __init__(
+        self, registry: MetricsRegistry, path: str, *, interval: float = 15.0
+    ) -> None:
+        """Set attributes and start writing."""
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+
+        self._stop_event = threading.Event()
+
+        self._thread = threading.Thread(
+            target=self._write_periodically, name="MetricsTextfileWriter", daemon=True
+        )
+
+        self._thread.start()
+
+    def write(self) -> None:
+        """Write metrics to file."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.registry.render())
+
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.unlink(temporary_path)
+
+            raise
+
+    def _write_periodically(self) -> None:
+        """Write metrics every interval, until closed."""
+        while True:
+            try:
+                self.write()
+            except Exception:
+                logger.exception("Unhandled exception writing metrics")
+
+            if self._stop_event.wait(self.interval):
+                return
+
+    def close(self) -> None:
+        """Stop writing, after writing once more."""
+        self._stop_event.set()
+
+        self._thread.join()
+
+        self.write()
+
+
+def get_metrics_exporters(
+    registry: MetricsRegistry, metrics_config: Metrics
+) -> List[Union[MetricsServer, MetricsTextfileWriter]]:
+    """Start configured metrics exporters."""
+    exporters: List[Union[MetricsServer, MetricsTextfileWriter]] = []
+
+    if metrics_config.port is not None:
+        exporters.append(
+            MetricsServer(registry, metrics_config.listen_address, metrics_config.port)
+        )
+
+    if metrics_config.textfile_path:
+        exporters.append(
+            MetricsTextfileWriter(
+                registry,
+                metrics_config.textfile_path,
+                interval=metrics_config.textfile_interval,
+            )
+        )
+
+    return exporters
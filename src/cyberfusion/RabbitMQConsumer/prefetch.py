@@ -0,0 +1,203 @@
+"""Classes for adjusting the prefetch count to load."""
+
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from cyberfusion.RabbitMQConsumer.config import AdaptivePrefetch
+from cyberfusion.RabbitMQConsumer.metrics import PHASE_DURATION, PHASE_HANDLER
+
+
+@dataclass
+class PrefetchControllerMetrics:
+    """Prefetch controller metrics."""
+
+    prefetch_count: int
+    increases: int
+    decreases: int
+
+
+class PrefetchController:
+    """Adjust prefetch count by additive increase, multiplicative decrease.
+
+    When overloaded, the prefetch count is halved, so that remaining messages
+    stay available to other consumers of the queue. Otherwise, it's increased by
+    one, until the max prefetch count is reached.
+
+    The consumer is overloaded when:
+
+    - The mean handler latency exceeds the target latency.
+    - No handler finished, while the prefetch count is fully used.
+    - At least as many messages as the prefetch count wait for a lock or limit.
+    - Memory use exceeds the max memory.
+    """
+
+    def __init__(
+        self,
+        *,
+        target_latency: float,
+        min_prefetch_count: int,
+        max_prefetch_count: int,
+        max_memory: Optional[int] = None,
+    ) -> None:
+        """Set attributes."""
+        self.target_latency = target_latency
+        self.min_prefetch_count = min_prefetch_count
+        self.max_memory = max_memory
+
+        self.set_max_prefetch_count(max_prefetch_count)
+
+        self._increases = 0
+        self._decreases = 0
+
+    @property
+    def metrics(self) -> PrefetchControllerMetrics:
+        """Get metrics."""
+        return PrefetchControllerMetrics(
+            prefetch_count=self.prefetch_count,
+            increases=self._increases,
+            decreases=self._decreases,
+        )
+
+    def set_max_prefetch_count(self, max_prefetch_count: int) -> None:
+        """Set max prefetch count, and start at it."""
+        self.max_prefetch_count = max_prefetch_count
+        self.prefetch_count = max_prefetch_count
+
+    def is_overloaded(
+        self,
+        *,
+        latency: Optional[float],
+        saturation: float,
+        waiting: float,
+        memory: Optional[int],
+    ) -> bool:
+        """Determine if consumer is overloaded."""
+        if latency is None:
+            if saturation >= 1:
+                return True
+        elif latency > self.target_latency:
+            return True
+
+        if waiting >= self.prefetch_count:
+            return True
+
+        if self.max_memory is not None and memory is not None:
+            return memory > self.max_memory
+
+        return False
+
+    def adjust(
+        self,
+        *,
+        latency: Optional[float],
+        saturation: float,
+        waiting: float,
+        memory: Optional[int],
+    ) -> int:
+        """Adjust prefetch count to observed load, and return it.
+
+        Latency is the mean handler latency since the last adjustment (None if
+        no handler finished). Saturation is the fraction of the prefetch count
+        used by messages being processed. Waiting is the amount of messages per
+        channel waiting for a lock or limit. Memory is the memory use in bytes
+        (None if unknown).
+        """
+        if self.is_overloaded(
+            latency=latency, saturation=saturation, waiting=waiting, memory=memory
+        ):
+            prefetch_count = max(
+                min(self.min_prefetch_count, self.max_prefetch_count),
+                self.prefetch_count // 2,
+            )
+
+            if prefetch_count < self.prefetch_count:
+                self._decreases += 1
+        else:
+            prefetch_count = min(self.max_prefetch_count, self.prefetch_count + 1)
+
+            if prefetch_count > self.prefetch_count:
+                self._increases += 1
+
+        self.prefetch_count = prefetch_count
+
+        return prefetch_count
+
+
+class HandlerLatency:
+    """Get mean handler latency of exchanges of virtual host, between calls."""
+
+    def __init__(self, virtual_host_name: str, exchange_names: List[str]) -> None:
+        """Set attributes."""
+        self.virtual_host_name = virtual_host_name
+        self.exchange_names = list(exchange_names)
+
+        self._totals: Dict[str, Tuple[float, int]] = {}
+
+        self.sample()
+
+    def add_exchange(self, exchange_name: str) -> None:
+        """Include handler latency of added exchange."""
+        self.exchange_names.append(exchange_name)
+
+        self._totals[exchange_name] = self._get_totals(exchange_name)
+
+    def _get_totals(self, exchange_name: str) -> Tuple[float, int]:
+        """Get sum and amount of handler durations of exchange."""
+        labels = {
+            "virtual_host": self.virtual_host_name,
+            "exchange": exchange_name,
+            "phase": PHASE_HANDLER,
+        }
+
+        return PHASE_DURATION.get_sum(**labels), PHASE_DURATION.get_count(**labels)
+
+    def sample(self) -> Optional[float]:
+        """Get mean handler latency since last call, if any handler finished."""
+        duration = 0.0
+        count = 0
+
+        for exchange_name in self.exchange_names:
+            totals = self._get_totals(exchange_name)
+
+            previous_sum, previous_count = self._totals.get(exchange_name, (0.0, 0))
+
+            duration += totals[0] - previous_sum
+            count += totals[1] - previous_count
+
+            self._totals[exchange_name] = totals
+
+        if not count:
+            return None
+
+        return duration / count
+
+
+def get_memory_usage() -> Optional[int]:
+    """Get resident memory of process in bytes, if known (only on Linux)."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_prefetch_controller(
+    adaptive_prefetch: Optional[AdaptivePrefetch], max_prefetch_count: int
+) -> Optional[PrefetchController]:
+    """Get prefetch controller, if adaptive prefetch is enabled."""
+    if not adaptive_prefetch:
+        return None
+
+    return PrefetchController(
+        target_latency=adaptive_prefetch.target_latency,
+        min_prefetch_count=adaptive_prefetch.min_prefetch_count,
+        max_prefetch_count=max_prefetch_count,
+        max_memory=(
+            adaptive_prefetch.max_memory * 1024 * 1024
+            if adaptive_prefetch.max_memory is not None
+            else None
+        ),
+    )
@@ -0,0 +1,248 @@
+"""Classes for running handlers in processes."""
+
+import asyncio
+import importlib
+import inspect
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from cyberfusion.RabbitMQConsumer.config import Exchange, ExecutionMode
+from cyberfusion.RabbitMQConsumer.contracts import RPCRequestBase, RPCResponseBase
+from cyberfusion.RabbitMQConsumer.exceptions import HandlerTimeoutError
+from cyberfusion.RabbitMQConsumer.registry import (
+    ExchangeHandler,
+    get_exchange_handler,
+)
+
+logger = logging.getLogger(__name__)
+
+# Exchange handler in worker process, set by initialiser
+
+_exchange_handler: Optional[ExchangeHandler] = None
+
+
+def _initialise(exchange_name: str, module_name: str) -> None:
+    """Import handler module, and instantiate handler, in worker process."""
+    global _exchange_handler
+
+    _exchange_handler = get_exchange_handler(
+        exchange_name, importlib.import_module(module_name)
+    )
+
+
+def _warm_up() -> None:
+    """Do nothing. Used to start worker processes."""
+
+
+def _call(request_json: str) -> str:
+    """Call handler in worker process.
+
+    The request and response are passed as JSON, as models may not be picklable.
+    """
+    if not _exchange_handler:
+        raise RuntimeError("Worker process not initialised")
+
+    request = _exchange_handler.request_model.model_validate_json(request_json)
+
+    result = _exchange_handler.handler(request)
+
+    if inspect.iscoroutine(result):
+        result = asyncio.run(result)
+
+    if not isinstance(result, RPCResponseBase):
+        raise ValueError("RPC response must be of type RPCResponse")
+
+    return result.model_dump_json()
+
+
+@dataclass
+class HandlerProcessPoolMetrics:
+    """Handler process pool metrics."""
+
+    calls: int
+    crashes: int
+    timeouts: int
+
+
+class HandlerProcessPool:
+    """Pool of processes, calling an exchange's handler.
+
+    Worker processes are started using 'spawn', so they don't inherit the
+    parent's connections and threads. They import the handler module once,
+    when started.
+
+    If a worker process crashes, the pool is broken: RPC requests in progress
+    in the pool fail, and the pool is replaced.
+
+    If a call times out, the worker processes are killed, as it's unknown which
+    worker process runs the call. Therefore, this breaks the pool as well. To
+    bound the calls affected, and to not count waiting for a worker process
+    towards the timeout, calls are only submitted once a worker process is
+    free. Therefore, only calls in progress fail (at most the pool size).
+    """
+
+    def __init__(
+        self, exchange_handler: ExchangeHandler, size: Optional[int] = None
+    ) -> None:
+        """Set attributes, and start worker processes.
+
+        If the size is not set, a worker process is started per CPU.
+        """
+        self.exchange_handler = exchange_handler
+        self.size = size or os.cpu_count() or 1
+
+        self._lock = threading.Lock()
+
+        # Free worker processes
+
+        self._free = threading.Semaphore(self.size)
+
+        self._calls = 0
+        self._crashes = 0
+        self._timeouts = 0
+
+        self._executor = self._get_executor()
+
+    @property
+    def metrics(self) -> HandlerProcessPoolMetrics:
+        """Get metrics."""
+        with self._lock:
+            return HandlerProcessPoolMetrics(
+                calls=self._calls, crashes=self._crashes, timeouts=self._timeouts
+            )
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Get executor, with started worker processes."""
+        executor = ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_initialise,
+            initargs=(
+                self.exchange_handler.exchange_name,
+                self.exchange_handler.module.__name__,
+            ),
+        )
+
+        # Start all worker processes now, rather than on the first RPC requests
+
+        wait([executor.submit(_warm_up) for _ in range(self.size)])
+
+        logger.info(
+            "Started process pool for exchange '%s'",
+            self.exchange_handler.exchange_name,
+        )
+
+        return executor
+
+    def call(
+        self, request: RPCRequestBase, *, timeout: Optional[float] = None
+    ) -> RPCResponseBase:
+        """Call handler in worker process, and wait for its response.
+
+        Waits for a free worker process first. If the handler doesn't return
+        within the timeout (from when the call was submitted to the free worker
+        process), HandlerTimeoutError is raised.
+        """
+        self._free.acquire()
+
+        with self._lock:
+            executor = self._executor
+
+            self._calls += 1
+
+        try:
+            future = executor.submit(_call, request.model_dump_json())
+        except BaseException:
+            self._free.release()
+
+            raise
+
+        future.add_done_callback(lambda _: self._free.release())
+
+        try:
+            response_json = future.result(timeout=timeout)
+        except BrokenProcessPool:
+            if self._replace_executor(executor):
+                with self._lock:
+                    self._crashes += 1
+
+            raise
+        except TimeoutError:
+            with self._lock:
+                self._timeouts += 1
+
+            self._kill(executor)
+            self._replace_executor(executor)
+
+            raise HandlerTimeoutError
+
+        return self.exchange_handler.response_model.model_validate_json(response_json)
+
+    def _kill(self, executor: ProcessPoolExecutor) -> None:
+        """Kill worker processes of executor."""
+        logger.warning(
+            "Killing worker processes for exchange '%s'...",
+            self.exchange_handler.exchange_name,
+        )
+
+        # ProcessPoolExecutor has no public API for this (before Python 3.14)
+
+        processes = executor._processes or {}
+
+        for process in list(processes.values()):
+            process.kill()
+
+    def _replace_executor(self, broken_executor: ProcessPoolExecutor) -> bool:
+        """Replace broken executor, unless another thread already did.
+
+        Returns whether the executor was replaced.
+        """
+        with self._lock:
+            if self._executor is not broken_executor:
+                return False
+
+            logger.warning(
+                "Process pool for exchange '%s' broken, replacing...",
+                self.exchange_handler.exchange_name,
+            )
+
+            broken_executor.shutdown(wait=False, cancel_futures=True)
+
+            self._executor = self._get_executor()
+
+            return True
+
+    def shutdown(self) -> None:
+        """Stop worker processes, after RPC requests in progress finish."""
+        with self._lock:
+            executor = self._executor
+
+        executor.shutdown(wait=True)
+
+
+def get_handler_process_pools(
+    exchanges: List[Exchange], exchange_handlers: Dict[str, ExchangeHandler]
+) -> Dict[str, HandlerProcessPool]:
+    """Start process pools for exchanges with the process execution mode."""
+    process_pools: Dict[str, HandlerProcessPool] = {}
+
+    for exchange in exchanges:
+        if exchange.execution_mode != ExecutionMode.PROCESS:
+            continue
+
+        # Exchange handlers are shared by virtual hosts, and so are process pools
+
+        if exchange.name in process_pools or exchange.name not in exchange_handlers:
+            continue
+
+        process_pools[exchange.name] = HandlerProcessPool(
+            exchange_handlers[exchange.name], exchange.processes
+        )
+
+    return process_pools
@@ -1,11 +1,13 @@
 """Classes for processing RPC requests."""
 
-from typing import List
+import asyncio
+import contextlib
 import functools
+import inspect
 import logging
-import threading
+import time
 import traceback
-from typing import Any, Optional
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple, Type, Union
 
 import pika
 from pydantic import ValidationError
@@ -14,17 +16,44 @@ from cyberfusion.RabbitMQConsumer.contracts import (
     RPCRequestBase,
     RPCResponseBase,
 )
+from cyberfusion.RabbitMQConsumer.exceptions import (
+    HandlerTimeoutError,
+    MalformedBodyError,
+)
+from cyberfusion.RabbitMQConsumer.idempotency import IdempotencyKey, IdempotencyStore
+from cyberfusion.RabbitMQConsumer.locking import LockManager
 from cyberfusion.RabbitMQConsumer.log_server_client import LogServerClient
+from cyberfusion.RabbitMQConsumer.metrics import (
+    OUTCOME_FAILED,
+    OUTCOME_MOCKED,
+    OUTCOME_REPLAYED,
+    OUTCOME_SUCCEEDED,
+    OUTCOME_TIMED_OUT,
+    OUTCOME_VALIDATION_FAILED,
+    PHASE_ACKNOWLEDGE,
+    PHASE_DURATION,
+    PHASE_HANDLER,
+    PHASE_LOCK_WAIT,
+    PHASE_LOG_SHIPPING,
+    PHASE_PUBLISH,
+    PHASE_VALIDATE,
+    RPC_REQUESTS_COALESCED,
+    RPC_REQUESTS_IN_FLIGHT,
+    RPC_REQUESTS_PROCESSED,
+)
 from cyberfusion.RabbitMQConsumer.models import (
-    RPCResponseDataValidationErrors,
     RPCResponseDataValidationError,
+    RPCResponseDataValidationErrors,
 )
-from cyberfusion.RabbitMQConsumer.rabbitmq import RabbitMQ
-from cyberfusion.RabbitMQConsumer.types import Locks
-from cyberfusion.RabbitMQConsumer.utilities import (
-    get_exchange_handler_class_request_model,
-    get_exchange_handler_class_response_model,
-)
+from cyberfusion.RabbitMQConsumer.process_pool import HandlerProcessPool
+from cyberfusion.RabbitMQConsumer.rabbitmq import RabbitMQ, RabbitMQBase
+from cyberfusion.RabbitMQConsumer.registry import ExchangeHandler
+from cyberfusion.RabbitMQConsumer.rpc_logging import LogBody, RPCRequestLoggerAdapter
+from cyberfusion.RabbitMQConsumer.serialization import get_loads, serialize_model
+from cyberfusion.RabbitMQConsumer.single_flight import SingleFlight
+from cyberfusion.RabbitMQConsumer.timeouts import TimeoutTracker
+from cyberfusion.RabbitMQConsumer.tracing import NULL_TRACE, Trace
+from cyberfusion.RabbitMQConsumer.types import LockKey
 
 logger = logging.getLogger(__name__)
 
@@ -32,225 +61,659 @@ MESSAGE_UNEXPECTED_ERROR = "An unexpected error occurred"
 
 MESSAGE_VALIDATION_ERROR = "Request validation failed"
 
+MESSAGE_TIMEOUT = "Request timed out"
+
 RESPONSE_UNEXPECTED_ERROR = RPCResponseBase(
     success=False,
     message=MESSAGE_UNEXPECTED_ERROR,
     data=None,
 )
 
+RESPONSE_TIMEOUT = RPCResponseBase(
+    success=False,
+    message=MESSAGE_TIMEOUT,
+    data=None,
+)
+
+
+def get_validation_error_response(e: ValidationError) -> RPCResponseBase:
+    """Get RPC response for request that failed validation."""
+    custom_errors = []
+
+    pydantic_errors = e.errors()
+
+    for pydantic_error in pydantic_errors:
+        custom_errors.append(
+            RPCResponseDataValidationError(
+                location=pydantic_error["loc"],
+                message=pydantic_error["msg"],
+                type=pydantic_error["type"],
+            )
+        )
+
+    return RPCResponseBase(
+        success=False,
+        message=MESSAGE_VALIDATION_ERROR,
+        data=RPCResponseDataValidationErrors(errors=custom_errors),
+    )
+
+
+def is_malformed(e: ValidationError) -> bool:
+    """Determine if validation failed because the body is not valid JSON."""
+    return any(error["type"] == "json_invalid" for error in e.errors())
+
+
+def get_mock_response(response_model: Type[RPCResponseBase]) -> RPCResponseBase:
+    """Get RPC response with random data, for mock mode."""
+    try:
+        from cyberfusion.RabbitMQConsumer.polyfactory import PydanticFactory
+    except ImportError:
+        raise RuntimeError("Polyfactory not installed, can't mock RPC response")
+
+    factory = PydanticFactory.create_factory(response_model)
+
+    return factory.build()
+
+
+def get_lock_key(
+    exchange_handler: ExchangeHandler, exchange_name: str, request: RPCRequestBase
+) -> LockKey:
+    """Get lock key by value of lock attribute.
+
+    This prevents conflicts. I.e. the same handler operating on the same object
+    (identified by the lock attribute) simultaneously.
+
+    If the lock attribute is None, the handler for the exchange not run
+    simultaneously in any case, regardless of the object it operates on
+    (by using the key 'dummy', which would apply to all messages).
+    """
+    lock_attribute = exchange_handler.lock_attribute
 
-class Processor:
-    """Class to process RPC requests, by passing to handler."""
+    if lock_attribute is not None:
+        lock_value = getattr(request, lock_attribute)
+    else:
+        lock_value = "dummy"
+
+    return (exchange_name, lock_value)
+
+
+class ProcessorBase:
+    """Base class to process RPC requests, regardless of engine.
+
+    Subclasses implement calling the handler, locking, and sending to RabbitMQ.
+
+    The payload is either the decoded (and decrypted) body, or the raw body, if
+    it didn't have to be decoded for decryption. The raw body is validated by
+    Pydantic directly.
+    """
 
     def __init__(
         self,
         *,
-        module: Any,
-        rabbitmq: RabbitMQ,
-        channel: pika.adapters.blocking_connection.BlockingChannel,
+        exchange_handler: ExchangeHandler,
+        rabbitmq: RabbitMQBase,
         method: pika.spec.Basic.Deliver,
         properties: pika.spec.BasicProperties,
-        locks: Locks,
-        payload: dict,
+        payload: Union[dict, bytes],
         log_server_client: Optional[LogServerClient],
         decrypted_values: List[str],
+        process_pool: Optional[HandlerProcessPool] = None,
+        timeout: Optional[float] = None,
+        timeout_tracker: Optional[TimeoutTracker] = None,
+        trace: Trace = NULL_TRACE,
+        idempotency_store: Optional[IdempotencyStore] = None,
+        single_flight: Optional[SingleFlight["ProcessorBase"]] = None,
     ) -> None:
         """Set attributes."""
-        self.module = module
+        self.exchange_handler = exchange_handler
         self.rabbitmq = rabbitmq
-        self.channel = channel
         self.method = method
         self.properties = properties
         self.payload = payload
         self.log_server_client = log_server_client
         self.decrypted_values = decrypted_values
+        self.process_pool = process_pool
+        self.timeout = timeout
+        self.timeout_tracker = timeout_tracker or TimeoutTracker()
+        self.trace = trace
+        self.idempotency_store = idempotency_store
 
-        self.handler = module.Handler()
+        # Redelivered messages are not coalesced, as they may have to replay
+        # their own stored RPC response
 
-        # Add value of lock attribute to locks
-        #
-        # This prevents conflicts. I.e. the same handler operating on the same object
-        # (identified by the lock attribute) simultaneously.
-        #
-        # If the lock attribute is None, the handler for the exchange not run
-        # simultaneously in any case, regardless of the object it operates on
-        # (by using the key 'dummy', which would apply to all messages).
+        self.single_flight = single_flight if not method.redelivered else None
 
-        lock_key = self.handler.lock_attribute
+        self.handler = exchange_handler.handler
 
-        if lock_key is not None:
-            lock_value = getattr(self.request, lock_key)
-        else:
-            lock_value = "dummy"
+        # Published RPC response, with traceback, and outcome. Identical RPC
+        # requests that were coalesced get these. The result is set if the RPC
+        # response was returned by the handler (or mocked).
+
+        self.response: Optional[Tuple[RPCResponseBase, Optional[str]]] = None
+        self.outcome: Optional[str] = None
+        self.result: Optional[RPCResponseBase] = None
 
-        if method.exchange not in locks:
-            locks[method.exchange] = {}
+        self.logger = RPCRequestLoggerAdapter(
+            logger, method.exchange, properties.correlation_id
+        )
+        self.body_max_size = rabbitmq.config.logging.body_max_size
 
-        if lock_value not in locks[method.exchange]:
-            locks[method.exchange][lock_value] = threading.Lock()
+        # Config may be reloaded while processing. Use the same mock mode and
+        # JSON backend for the entire RPC request.
 
-        self.lock = locks[method.exchange][lock_value]
+        self.mock = rabbitmq.config.mock
+        self.loads = get_loads(rabbitmq.config.json_backend)
 
-    @property
-    def request(self) -> RPCRequestBase:
-        """Cast JSON body to Pydantic model."""
-        request_class = get_exchange_handler_class_request_model(self.handler)
+        self.metrics_labels: Dict[str, str] = {
+            "virtual_host": rabbitmq.virtual_host_name,
+            "exchange": method.exchange,
+        }
+
+        # Validate request once. The model is used for the rest of the request
+        # lifecycle.
+
+        with self._phase(PHASE_VALIDATE):
+            self.request = self._validate_request()
+
+        self.lock_key = get_lock_key(exchange_handler, method.exchange, self.request)
+
+        # Time from now until the lock is acquired. This includes waiting for
+        # a worker.
+
+        self.queued_time = time.monotonic()
+
+    def _validate_request(self) -> RPCRequestBase:
+        """Cast JSON body to Pydantic model.
+
+        If validation fails, a validation error response is published. If the
+        body is not valid JSON, MalformedBodyError is raised, without publishing.
+        """
+        request_model = self.exchange_handler.request_model
 
         try:
-            return request_class(**self.payload)
+            if isinstance(self.payload, bytes):
+                return request_model.model_validate_json(self.payload)
+
+            return request_model.model_validate(self.payload)
         except ValidationError as e:
-            custom_errors = []
+            if is_malformed(e):
+                raise MalformedBodyError from e
 
-            pydantic_errors = e.errors()
+            self._count(OUTCOME_VALIDATION_FAILED)
 
-            for pydantic_error in pydantic_errors:
-                custom_errors.append(
-                    RPCResponseDataValidationError(
-                        location=pydantic_error["loc"],
-                        message=pydantic_error["msg"],
-                        type=pydantic_error["type"],
-                    )
-                )
+            self._publish(body=get_validation_error_response(e))
 
-            body = RPCResponseBase(
-                success=False,
-                message=MESSAGE_VALIDATION_ERROR,
-                data=RPCResponseDataValidationErrors(errors=custom_errors),
-            )
+            raise
+
+    @contextlib.contextmanager
+    def _phase(self, phase: str) -> Iterator[None]:
+        """Measure and trace duration of phase of processing RPC request."""
+        with (
+            PHASE_DURATION.time(
+                virtual_host=self.rabbitmq.virtual_host_name,
+                exchange=self.method.exchange,
+                phase=phase,
+            ),
+            self.trace.span(phase),
+        ):
+            yield
 
-            self._publish(body=body)
+    def _count(self, outcome: str) -> None:
+        """Count processed RPC request by outcome."""
+        self.outcome = outcome
 
-            raise
+        RPC_REQUESTS_PROCESSED.inc(outcome=outcome, **self.metrics_labels)
 
-    def __call__(self) -> None:
-        """Process message."""
-        self._acquire_lock()
+        self.trace.set_attribute("rpc.outcome", outcome)
+
+        if outcome not in (OUTCOME_SUCCEEDED, OUTCOME_MOCKED):
+            self.trace.set_error()
+
+    def _start(self) -> None:
+        """Start processing RPC request."""
+        RPC_REQUESTS_IN_FLIGHT.inc(**self.metrics_labels)
+
+    def _finish(self) -> None:
+        """Finish processing RPC request."""
+        RPC_REQUESTS_IN_FLIGHT.dec(**self.metrics_labels)
+
+        self.trace.finish()
+
+    def join_single_flight(self) -> bool:
+        """Join identical RPC request being processed, if single-flight is enabled.
+
+        Returns whether the RPC request joined. If so, it must not be processed:
+        once the identical RPC request is processed, its RPC response is
+        published for this RPC request too, and this message is acknowledged.
+        """
+        if not self.single_flight:
+            return False
+
+        if not self.single_flight.join(self.single_flight_key, self):
+            return False
+
+        self._start()
 
+        self.logger.info("Identical RPC request being processed, waiting for it")
+
+        self.trace.set_attribute("rpc.coalesced", True)
+
+        RPC_REQUESTS_COALESCED.inc(**self.metrics_labels)
+
+        return True
+
+    def complete_single_flight(self) -> List["ProcessorBase"]:
+        """Get RPC requests that joined this one, if single-flight is enabled.
+
+        From now on, identical RPC requests are processed separately.
+        """
+        if not self.single_flight:
+            return []
+
+        return self.single_flight.complete(self.single_flight_key)
+
+    def _follow(self, leader: "ProcessorBase") -> None:
+        """Publish RPC response of identical RPC request, and acknowledge message."""
         try:
-            if self.log_server_client:
-                logger.info(
-                    self._prefix_message("Shipping RPC request to log server...")
-                )
+            if leader.result is not None:
+                self._publish_result(leader.result)
+            elif leader.response and leader.outcome:
+                body, traceback = leader.response
+
+                self._publish(body=body, traceback=traceback)
+
+                self._count(leader.outcome)
+            else:
+                raise RuntimeError("Identical RPC request published no RPC response")
+        except Exception:
+            self._handle_exception()
+        finally:
+            with self._phase(PHASE_ACKNOWLEDGE):
+                self._acknowledge()
+
+            self._finish()
+
+    def _observe_lock_wait(self) -> float:
+        """Observe and return time between queueing and acquiring lock."""
+        wait_time = time.monotonic() - self.queued_time
+
+        PHASE_DURATION.observe(
+            wait_time,
+            virtual_host=self.rabbitmq.virtual_host_name,
+            exchange=self.method.exchange,
+            phase=PHASE_LOCK_WAIT,
+        )
+
+        self.trace.add_span(PHASE_LOCK_WAIT, self.queued_time)
+
+        return wait_time
+
+    def _log_rpc_request(self) -> None:
+        """Queue RPC request for log server, if configured."""
+        if not self.log_server_client:
+            return
+
+        with self._phase(PHASE_LOG_SHIPPING):
+            self.logger.debug("Queueing RPC request for log server...")
+
+            self.log_server_client.log_rpc_request(
+                correlation_id=self.properties.correlation_id,
+                request_payload=self.request.model_dump(mode="json"),
+                decrypted_values=self.decrypted_values,
+                exchange_name=self.method.exchange,
+            )
+
+            self.logger.debug("Queued RPC request for log server")
+
+    def _get_cached_result(self) -> Optional[RPCResponseBase]:
+        """Get cached result, if the handler caches RPC responses."""
+        result_cache = self.exchange_handler.result_cache
+
+        if not result_cache:
+            return None
+
+        self.result_cache_key = result_cache.get_key(self.request)
+
+        result = result_cache.get(
+            self.rabbitmq.virtual_host_name, self.result_cache_key
+        )
+
+        if result is not None:
+            self.logger.info("Using cached RPC response")
+
+        return result
+
+    def _cache_result(self, result: RPCResponseBase) -> None:
+        """Cache result returned by handler, if the handler caches RPC responses."""
+        result_cache = self.exchange_handler.result_cache
+
+        if not result_cache or not isinstance(result, RPCResponseBase):
+            return
+
+        result_cache.set(self.rabbitmq.virtual_host_name, self.result_cache_key, result)
+
+    def _get_mock_response(self) -> RPCResponseBase:
+        """Get RPC response with random data."""
+        self.logger.info("Mocking RPC response...")
+
+        result = get_mock_response(self.exchange_handler.response_model)
+
+        self.logger.info("Mocked RPC response")
 
-                self.log_server_client.log_rpc_request(
+        return result
+
+    def _publish_result(self, result: RPCResponseBase) -> None:
+        """Publish result returned by handler."""
+        if not isinstance(result, RPCResponseBase):
+            raise ValueError("RPC response must be of type RPCResponse")
+
+        self.result = result
+
+        json_body = self._publish(body=result)
+
+        # Mocked responses are not stored, so that redelivered messages are
+        # processed for real when mock mode was disabled in the meantime
+
+        if not self.mock:
+            self._store_response(json_body)
+
+        if self.mock:
+            self._count(OUTCOME_MOCKED)
+        elif result.success:
+            self._count(OUTCOME_SUCCEEDED)
+        else:
+            self._count(OUTCOME_FAILED)
+
+    def _handle_timeout(self) -> None:
+        """Publish timeout response."""
+        self.logger.warning(
+            "RPC handler timed out after %s seconds",
+            self.timeout,
+        )
+
+        self.timeout_tracker.count(self.method.exchange)
+
+        self._count(OUTCOME_TIMED_OUT)
+
+        self._publish(body=RESPONSE_TIMEOUT)
+
+    def _handle_exception(self) -> None:
+        """Publish unexpected error response, for exception being handled."""
+
+        # Uncaught exceptions raised in threads are not propagated, so they
+        # are not visible to the main thread. Therefore, any unhandled exception
+        # is logged here.
+
+        self.logger.exception("Unhandled exception occurred")
+
+        self._count(OUTCOME_FAILED)
+
+        # Send RPC response
+
+        self._publish(
+            body=RESPONSE_UNEXPECTED_ERROR,
+            traceback=traceback.format_exc(),
+        )
+
+    @functools.cached_property
+    def single_flight_key(self) -> Hashable:
+        """Get key to coalesce identical RPC requests by.
+
+        Only used if single-flight is enabled, so it's only serialized then.
+        """
+        return (self.method.exchange, self.request.model_dump_json())
+
+    @property
+    def idempotency_key(self) -> Optional[IdempotencyKey]:
+        """Get key to store RPC response by, if it has a correlation ID."""
+        if not self.properties.correlation_id:
+            return None
+
+        return (
+            self.rabbitmq.virtual_host_name,
+            self.method.exchange,
+            self.properties.correlation_id,
+        )
+
+    def _store_response(self, json_body: bytes) -> None:
+        """Store published RPC response, if idempotency store is set."""
+        if not self.idempotency_store or not self.idempotency_key:
+            return
+
+        self.idempotency_store.set(self.idempotency_key, json_body)
+
+    def _replay_response(self) -> bool:
+        """Publish stored RPC response, if redelivered message was processed.
+
+        Returns whether a stored RPC response was published. Only redelivered
+        messages are looked up. This is done with the lock held, so that a
+        message redelivered while it's still being processed finds the RPC
+        response once it's stored.
+        """
+        if (
+            not self.idempotency_store
+            or not self.idempotency_key
+            or not self.method.redelivered
+        ):
+            return False
+
+        json_body = self.idempotency_store.get(self.idempotency_key)
+
+        if json_body is None:
+            return False
+
+        self.logger.info("RPC request already processed, replaying stored response")
+
+        with self._phase(PHASE_PUBLISH):
+            self._send(json_body)
+
+        self._count(OUTCOME_REPLAYED)
+
+        return True
+
+    def _publish(
+        self, *, body: RPCResponseBase, traceback: Optional[str] = None
+    ) -> bytes:
+        """Publish result, and return it serialized.
+
+        The result is serialized once. The log server gets it deserialized from
+        the published JSON.
+        """
+        self.response = (body, traceback)
+
+        with self._phase(PHASE_PUBLISH):
+            json_body = serialize_model(body)
+
+            self._send(json_body)
+
+        if self.log_server_client:
+            with self._phase(PHASE_LOG_SHIPPING):
+                self.logger.debug("Queueing RPC response for log server...")
+
+                self.log_server_client.log_rpc_response(
                     correlation_id=self.properties.correlation_id,
-                    request_payload=self.request.model_dump(mode="json"),
-                    decrypted_values=self.decrypted_values,
-                    exchange_name=self.method.exchange,
+                    response_payload=self.loads(json_body),
+                    traceback=traceback,
                 )
 
-                logger.info(self._prefix_message("Shipped RPC request to log server"))
+                self.logger.debug("Queued RPC response for log server")
 
-            if not self.rabbitmq.config.mock:
-                logger.info(self._prefix_message("Calling RPC handler..."))
+        return json_body
 
-                result = self.handler(self.request)
+    def _send(self, json_body: bytes) -> None:
+        """Send serialized RPC response to reply queue."""
+        self.logger.info(
+            "Sending RPC response. Body: '%s'",
+            LogBody(json_body, max_size=self.body_max_size),
+        )
 
-                logger.info(self._prefix_message("Called RPC handler"))
-            else:
-                logger.info(self._prefix_message("Mocking RPC response..."))
+        self._basic_publish(
+            properties=pika.BasicProperties(
+                correlation_id=self.properties.correlation_id,
+                content_type="application/json",
+            ),
+            body=json_body,
+        )
+
+    def _basic_publish(self, *, properties: pika.BasicProperties, body: bytes) -> None:
+        """Publish RPC response to reply queue."""
+        raise NotImplementedError
+
+    def _acknowledge(self) -> None:
+        """Acknowledge message."""
+        raise NotImplementedError
+
+
+class Processor(ProcessorBase):
+    """Class to process RPC requests in worker thread, by passing to handler."""
+
+    def __init__(
+        self,
+        *,
+        exchange_handler: ExchangeHandler,
+        rabbitmq: RabbitMQ,
+        channel: pika.adapters.blocking_connection.BlockingChannel,
+        method: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        lock_manager: LockManager,
+        payload: Union[dict, bytes],
+        log_server_client: Optional[LogServerClient],
+        decrypted_values: List[str],
+        process_pool: Optional[HandlerProcessPool] = None,
+        timeout: Optional[float] = None,
+        timeout_tracker: Optional[TimeoutTracker] = None,
+        trace: Trace = NULL_TRACE,
+        idempotency_store: Optional[IdempotencyStore] = None,
+        single_flight: Optional[SingleFlight[ProcessorBase]] = None,
+    ) -> None:
+        """Set attributes."""
+        self.rabbitmq: RabbitMQ = rabbitmq
+        self.channel = channel
+        self.lock_manager = lock_manager
+
+        super().__init__(
+            exchange_handler=exchange_handler,
+            rabbitmq=rabbitmq,
+            method=method,
+            properties=properties,
+            payload=payload,
+            log_server_client=log_server_client,
+            decrypted_values=decrypted_values,
+            process_pool=process_pool,
+            timeout=timeout,
+            timeout_tracker=timeout_tracker,
+            trace=trace,
+            idempotency_store=idempotency_store,
+            single_flight=single_flight,
+        )
 
-                response_model = get_exchange_handler_class_response_model(self.handler)
+    def __call__(self) -> None:
+        """Process message."""
+        self._start()
 
-                try:
-                    from cyberfusion.RabbitMQConsumer.polyfactory import PydanticFactory
-                except ImportError:
-                    raise RuntimeError(
-                        "Polyfactory not installed, can't mock RPC response"
-                    )
+        self._acquire_lock()
 
-                factory = PydanticFactory.create_factory(response_model)
+        try:
+            if self._replay_response():
+                return
 
-                result = factory.build()
+            self._log_rpc_request()
 
-                logger.info(self._prefix_message("Mocked RPC response"))
+            if not self.mock:
+                result = self._get_cached_result()
 
-            if not isinstance(result, RPCResponseBase):
-                raise ValueError("RPC response must be of type RPCResponse")
+                if result is None:
+                    self.logger.info("Calling RPC handler...")
 
-            self._publish(body=result)
-        except Exception:
-            # Uncaught exceptions raised in threads are not propagated, so they
-            # are not visible to the main thread. Therefore, any unhandled exception
-            # is logged here.
+                    with self._phase(PHASE_HANDLER):
+                        result = self._call_handler()
 
-            logger.exception("Unhandled exception occurred")
+                    self.logger.info("Called RPC handler")
 
-            # Send RPC response
+                    self._cache_result(result)
+            else:
+                result = self._get_mock_response()
 
-            self._publish(
-                body=RESPONSE_UNEXPECTED_ERROR,
-                traceback=traceback.format_exc(),
-            )
+            self._publish_result(result)
+        except HandlerTimeoutError:
+            self._handle_timeout()
+        except Exception:
+            self._handle_exception()
         finally:
+            followers = self.complete_single_flight()
+
             # Release the lock before acknowledgement. If acknowledgement fails and
             # the message is redelivered, the lock is already released, preventing
             # race conditions.
 
             self._release_lock()
-            self._acknowledge()
 
-    def _prefix_message(self, message: str) -> str:
-        """Get prefix for logs about the RPC request being processed."""
-        return f"[{self.method.exchange}] [{self.properties.correlation_id}] {message}"
+            with self._phase(PHASE_ACKNOWLEDGE):
+                self._acknowledge()
+
+            self._finish()
+
+            for follower in followers:
+                follower._follow(self)
+
+    def _call_handler(self) -> RPCResponseBase:
+        """Call handler, in process pool if set, with timeout if set."""
+        if self.process_pool:
+            return self.process_pool.call(self.request, timeout=self.timeout)
+
+        if self.timeout is None:
+            return self._run_handler()
+
+        return self.timeout_tracker.call(
+            self._run_handler,
+            self.timeout,
+            name=f"Handler-{self.method.exchange}-{self.properties.correlation_id}",
+        )
+
+    def _run_handler(self) -> RPCResponseBase:
+        """Run handler. Async handlers are run to completion in this thread."""
+        result = self.handler(self.request)
+
+        if inspect.iscoroutine(result):
+            result = asyncio.run(result)
+
+        return result
 
     def _acquire_lock(self) -> None:
         """Acquire lock."""
-        logger.info(self._prefix_message("Acquiring lock..."))
+        self.logger.debug("Acquiring lock...")
+
+        self.lock_manager.acquire(self.lock_key)
 
-        self.lock.acquire()
+        wait_time = self._observe_lock_wait()
 
-        logger.info(self._prefix_message("Acquired lock"))
+        self.logger.info("Acquired lock (waited %.3fs)", wait_time)
 
     def _release_lock(self) -> None:
         """Release lock."""
-        logger.info(self._prefix_message("Releasing lock..."))
+        self.logger.debug("Releasing lock...")
 
-        self.lock.release()
+        self.lock_manager.release(self.lock_key)
 
-        logger.info(self._prefix_message("Released lock"))
+        self.logger.debug("Released lock")
 
-    def _publish(
-        self, *, body: RPCResponseBase, traceback: Optional[str] = None
-    ) -> None:
-        """Publish result."""
-        json_body = body.model_dump_json()
-
-        logger.info(
-            self._prefix_message(
-                "Sending RPC response. Body: '%s'",
-            ),
-            json_body,
-        )
-
-        self.rabbitmq.connection.add_callback_threadsafe(
+    def _basic_publish(self, *, properties: pika.BasicProperties, body: bytes) -> None:
+        """Publish RPC response to reply queue, in the connection's thread."""
+        self.channel.connection.add_callback_threadsafe(
             functools.partial(
-                self.channel.basic_publish,
+                self.rabbitmq.publish,
+                self.channel,
                 exchange=self.method.exchange,
                 routing_key=self.properties.reply_to,
-                properties=pika.BasicProperties(
-                    correlation_id=self.properties.correlation_id,
-                    content_type="application/json",
-                ),
-                body=json_body,
+                properties=properties,
+                body=body,
             )
         )
 
-        if self.log_server_client:
-            logger.info(self._prefix_message("Shipping RPC response to log server..."))
-
-            self.log_server_client.log_rpc_response(
-                correlation_id=self.properties.correlation_id,
-                response_payload=body.model_dump(mode="json"),
-                traceback=traceback,
-            )
-
-            logger.info(self._prefix_message("Shipped RPC response to log server"))
-
     def _acknowledge(self) -> None:
-        """Acknowledge message."""
-        self.rabbitmq.connection.add_callback_threadsafe(
+        """Acknowledge message, in the connection's thread."""
+        self.channel.connection.add_callback_threadsafe(
             functools.partial(
-                self.channel.basic_ack, delivery_tag=self.method.delivery_tag
+                self.rabbitmq.acknowledge, self.channel, self.method.delivery_tag
             )
         )
@@ -1,32 +1,177 @@
 """Program to interact with RabbitMQ."""
 
+import dataclasses
+import functools
 import logging
-from typing import Optional
+import threading
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Callable, Dict, List, Optional, Set
 
 import pika
+from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
 
-from cyberfusion.RabbitMQConsumer.config import Config
+from cyberfusion.RabbitMQConsumer.acknowledgement import AckCoalescer
+from cyberfusion.RabbitMQConsumer.config import (
+    Config,
+    Exchange,
+    VirtualHost,
+    get_added_exchanges,
+    get_queue_arguments,
+)
+from cyberfusion.RabbitMQConsumer.decryption import Decryptor
 from cyberfusion.RabbitMQConsumer.utilities import get_pika_ssl_options
 
 logger = logging.getLogger(__name__)
 
+# Max seconds that connection threads process I/O before checking whether to stop
 
-class RabbitMQ:
-    """Class to interact with RabbitMQ."""
+TIME_LIMIT_PROCESS_DATA_EVENTS = 1.0
+
+OnMessageCallback = Callable[
+    [BlockingChannel, pika.spec.Basic.Deliver, pika.spec.BasicProperties, bytes],
+    None,
+]
+
+
+def get_channel_impl(channel: BlockingChannel) -> pika.channel.Channel:
+    """Get underlying channel of blocking channel.
+
+    BlockingChannel only offers a confirm mode in which every publish waits for
+    its confirmation, and no way to handle returned messages without consuming.
+    Therefore, confirmations and returns are handled on the underlying channel.
+    It's not part of pika's public API, so check that it's there.
+    """
+    channel_impl = getattr(channel, "_impl", None)
+
+    if not isinstance(channel_impl, pika.channel.Channel):
+        raise RuntimeError(
+            "Confirm mode requires BlockingChannel._impl, which pika "
+            f"{pika.__version__} doesn't have"
+        )
+
+    return channel_impl
+
+
+@dataclass
+class PublishMetrics:
+    """Publish metrics."""
+
+    published: int
+    unroutable: int
+    nacked: int
+
+
+class ConfirmTracker:
+    """Track messages published in confirm mode on a channel, until confirmed.
+
+    Confirmations are handled as they arrive, rather than waited for by the
+    publisher. Messages that can't be routed, or are not confirmed by the
+    broker, are logged and counted.
+    """
+
+    def __init__(self, count_publish: Callable[..., None]) -> None:
+        """Set attributes."""
+        self.count_publish = count_publish
+
+        # Map publish delivery tags to correlation IDs, until confirmed.
+        # Correlation IDs of returned messages are kept, so that they're not
+        # counted as published when confirmed.
+
+        self._delivery_tag = 0
+        self._unconfirmed: Dict[int, Optional[str]] = {}
+        self._returned: Set[Optional[str]] = set()
+
+    @property
+    def unconfirmed(self) -> int:
+        """Get amount of messages that weren't confirmed yet."""
+        return len(self._unconfirmed)
+
+    def track(self, correlation_id: Optional[str]) -> None:
+        """Track published message. Publish delivery tags count from 1."""
+        self._delivery_tag += 1
+
+        self._unconfirmed[self._delivery_tag] = correlation_id
+
+    def on_return(
+        self,
+        _channel: pika.channel.Channel,
+        _method: pika.spec.Basic.Return,
+        properties: pika.spec.BasicProperties,
+        _body: bytes,
+    ) -> None:
+        """Count message that could not be routed."""
+        logger.warning(
+            "RPC response (%s) could not be routed",
+            properties.correlation_id,
+        )
+
+        self._returned.add(properties.correlation_id)
+
+        self.count_publish(unroutable=1)
+
+    def on_delivery_confirmation(self, method_frame: pika.frame.Method) -> None:
+        """Count messages confirmed (acked or nacked) by broker."""
+        method = method_frame.method
+
+        if method.multiple:
+            delivery_tags = [
+                delivery_tag
+                for delivery_tag in self._unconfirmed
+                if delivery_tag <= method.delivery_tag
+            ]
+        else:
+            delivery_tags = [method.delivery_tag]
+
+        for delivery_tag in delivery_tags:
+            correlation_id = self._unconfirmed.pop(delivery_tag, None)
+
+            if isinstance(method, pika.spec.Basic.Nack):
+                logger.warning(
+                    "RPC response (%s) was not confirmed by broker", correlation_id
+                )
+
+                self.count_publish(nacked=1)
+            elif correlation_id in self._returned:
+                self._returned.discard(correlation_id)
+            else:
+                self.count_publish(published=1)
+
+
+class RabbitMQBase:
+    """Virtual host-specific attributes, regardless of connection type."""
 
     def __init__(self, virtual_host_name: str, config: Config) -> None:
-        """Set attributes and call functions."""
+        """Set attributes."""
         self.virtual_host_name = virtual_host_name
         self.config = config
 
         self.virtual_host_config = self.config.get_virtual_host(self.virtual_host_name)
 
-        self.set_connection()
-        self.set_channel()
-        self.declare_queue()
-        self.declare_exchanges()
-        self.bind_queue()
-        self.set_basic_qos()
+        self._publish_metrics_lock = threading.Lock()
+
+        self._published = 0
+        self._unroutable = 0
+        self._nacked = 0
+
+    @property
+    def publish_metrics(self) -> PublishMetrics:
+        """Get publish metrics."""
+        with self._publish_metrics_lock:
+            return PublishMetrics(
+                published=self._published,
+                unroutable=self._unroutable,
+                nacked=self._nacked,
+            )
+
+    def _count_publish(
+        self, *, published: int = 0, unroutable: int = 0, nacked: int = 0
+    ) -> None:
+        """Update publish metrics."""
+        with self._publish_metrics_lock:
+            self._published += published
+            self._unroutable += unroutable
+            self._nacked += nacked
 
     @property
     def fernet_key(self) -> Optional[str]:
@@ -36,8 +181,35 @@ class RabbitMQ:
 
         return self.virtual_host_config.fernet_key
 
-    def set_connection(self) -> None:
-        """Set RabbitMQ connection."""
+    @property
+    def fernet_keys(self) -> List[str]:
+        """Get Fernet keys, in order of preference.
+
+        The Fernet key is preferred over additional keys (used for key rotation).
+        """
+        keys = []
+
+        if self.fernet_key:
+            keys.append(self.fernet_key)
+
+        for key in self.virtual_host_config.fernet_keys:
+            if key in keys:
+                continue
+
+            keys.append(key)
+
+        return keys
+
+    @cached_property
+    def decryptor(self) -> Optional[Decryptor]:
+        """Get decryptor, if any Fernet key is set."""
+        if not self.fernet_keys:
+            return None
+
+        return Decryptor(self.fernet_keys)
+
+    def get_connection_parameters(self) -> pika.ConnectionParameters:
+        """Get RabbitMQ connection parameters."""
         arguments = {
             "host": self.config.server.host,
             "port": self.config.server.port,
@@ -50,33 +222,146 @@ class RabbitMQ:
         if self.config.server.ssl:
             arguments["ssl_options"] = get_pika_ssl_options(self.config.server.host)
 
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                **arguments,
-            )
+        return pika.ConnectionParameters(
+            **arguments,
         )
 
-    def set_channel(self) -> None:
-        """Set RabbitMQ channel."""
-        self.channel = self.connection.channel()
+
+class RabbitMQ(RabbitMQBase):
+    """Class to interact with RabbitMQ.
+
+    Multiple connections, each with multiple channels, may be opened. Every
+    channel has its own consumer and prefetch count. Every connection processes
+    I/O in its own thread.
+    """
+
+    def __init__(self, virtual_host_name: str, config: Config) -> None:
+        """Set attributes and call functions."""
+        super().__init__(virtual_host_name, config)
+
+        self._stop_event = threading.Event()
+        self._stopped_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._exception: Optional[BaseException] = None
+
+        self.ack_coalescers: Dict[BlockingChannel, AckCoalescer] = {}
+        self.confirm_trackers: Dict[BlockingChannel, ConfirmTracker] = {}
+
+        # Starts at the max amount of simultaneous requests. May be lowered by
+        # adaptive prefetch.
+
+        self.prefetch_count = self.virtual_host_config.max_simultaneous_requests
+
+        self.set_connections()
+        self.set_channels()
+        self.declare_dead_letter_exchange()
+        self.declare_queue()
+        self.declare_exchanges()
+        self.bind_queue()
+        self.set_basic_qos()
+
+    @property
+    def connection(self) -> BlockingConnection:
+        """Get first RabbitMQ connection."""
+        return self.connections[0]
+
+    @property
+    def channel(self) -> BlockingChannel:
+        """Get first RabbitMQ channel."""
+        return self.channels[0]
+
+    def get_connection(self) -> BlockingConnection:
+        """Get RabbitMQ connection."""
+        return pika.BlockingConnection(self.get_connection_parameters())
+
+    def set_connections(self) -> None:
+        """Set RabbitMQ connections."""
+        self.connections = [
+            self.get_connection() for _ in range(self.virtual_host_config.connections)
+        ]
+
+    def set_channels(self) -> None:
+        """Set RabbitMQ channels, for every connection.
+
+        If configured, confirm mode is enabled, and acknowledgements are
+        coalesced, per channel.
+
+        BlockingChannel's confirm mode makes every publish wait for its
+        confirmation, blocking the connection's thread. Therefore, confirm mode
+        is enabled on the underlying channel instead (see `get_channel_impl`),
+        so that confirmations are handled as they arrive, in the connection's
+        thread.
+        """
+        self.channels = [
+            connection.channel()
+            for connection in self.connections
+            for _ in range(self.virtual_host_config.channels_per_connection)
+        ]
+
+        for channel in self.channels:
+            if self.virtual_host_config.confirm_delivery:
+                confirm_tracker = ConfirmTracker(self._count_publish)
+
+                channel_impl = get_channel_impl(channel)
+
+                channel_impl.confirm_delivery(confirm_tracker.on_delivery_confirmation)
+                channel_impl.add_on_return_callback(confirm_tracker.on_return)
+
+                self.confirm_trackers[channel] = confirm_tracker
+
+            if self.virtual_host_config.ack_flush_interval is not None:
+                self.ack_coalescers[channel] = AckCoalescer(
+                    lambda delivery_tag, multiple, channel=channel: channel.basic_ack(
+                        delivery_tag=delivery_tag, multiple=multiple
+                    ),
+                    channel.connection.call_later,
+                    flush_interval=self.virtual_host_config.ack_flush_interval,
+                    max_completed=self.virtual_host_config.max_simultaneous_requests,
+                )
+
+    def declare_dead_letter_exchange(self) -> None:
+        """Declare dead-letter exchange, and bind dead-letter queue, if set."""
+        dead_letter_exchange = self.virtual_host_config.dead_letter_exchange
+
+        if not dead_letter_exchange:
+            return
+
+        self.channel.exchange_declare(
+            exchange=dead_letter_exchange, exchange_type="fanout", durable=True
+        )
+
+        dead_letter_queue = self.virtual_host_config.dead_letter_queue
+
+        if not dead_letter_queue:
+            return
+
+        self.channel.queue_declare(queue=dead_letter_queue, durable=True)
+        self.channel.queue_bind(exchange=dead_letter_exchange, queue=dead_letter_queue)
 
     def declare_queue(self) -> None:
         """Declare RabbitMQ queue."""
         self.channel.queue_declare(
             queue=self.virtual_host_config.queue,
             durable=True,
+            arguments=get_queue_arguments(self.virtual_host_config),
         )
 
-    def declare_exchanges(self) -> None:
-        """Declare RabbitMQ exchanges."""
-        for exchange in self.virtual_host_config.exchanges:
+    def declare_exchanges(self, exchanges: Optional[List[Exchange]] = None) -> None:
+        """Declare RabbitMQ exchanges, all by default."""
+        if exchanges is None:
+            exchanges = self.virtual_host_config.exchanges
+
+        for exchange in exchanges:
             self.channel.exchange_declare(
                 exchange=exchange.name, exchange_type=exchange.type
             )
 
-    def bind_queue(self) -> None:
-        """Bind to RabbitMQ queue at each exchange."""
-        for exchange in self.virtual_host_config.exchanges:
+    def bind_queue(self, exchanges: Optional[List[Exchange]] = None) -> None:
+        """Bind to RabbitMQ queue at each exchange, all by default."""
+        if exchanges is None:
+            exchanges = self.virtual_host_config.exchanges
+
+        for exchange in exchanges:
             queue = self.virtual_host_config.queue
 
             logger.info(
@@ -89,7 +374,219 @@ class RabbitMQ:
             self.channel.queue_bind(exchange=exchange.name, queue=queue)
 
     def set_basic_qos(self) -> None:
+        """Set basic QoS for channels."""
+        for channel in self.channels:
+            self._set_basic_qos(channel)
+
+    def _set_basic_qos(self, channel: BlockingChannel) -> None:
         """Set basic QoS for channel."""
-        self.channel.basic_qos(
-            prefetch_count=self.virtual_host_config.max_simultaneous_requests
+        channel.basic_qos(prefetch_count=self.prefetch_count)
+
+        if channel in self.ack_coalescers:
+            self.ack_coalescers[channel].max_completed = self.prefetch_count
+
+    def set_prefetch_count(self, prefetch_count: int) -> None:
+        """Apply prefetch count to every channel.
+
+        As channels aren't thread-safe, this is done in the connections'
+        threads.
+        """
+        self.prefetch_count = prefetch_count
+
+        for channel in self.channels:
+            channel.connection.add_callback_threadsafe(
+                functools.partial(self._set_basic_qos, channel)
+            )
+
+    def _add_exchanges(self, exchanges: List[Exchange]) -> None:
+        """Declare exchanges, and bind queue to them."""
+        self.declare_exchanges(exchanges)
+        self.bind_queue(exchanges)
+
+    def reload(self, virtual_host_config: VirtualHost) -> None:
+        """Apply reloaded virtual host config.
+
+        Added exchanges are declared and bound, and the max amount of
+        simultaneous requests (prefetch count) is applied to every channel.
+        Other changes require reconnecting, so they're not applied.
+
+        As channels aren't thread-safe, this is done in the connections'
+        threads.
+        """
+        added_exchanges = get_added_exchanges(
+            self.virtual_host_config, virtual_host_config
+        )
+
+        self.virtual_host_config = dataclasses.replace(
+            self.virtual_host_config,
+            exchanges=self.virtual_host_config.exchanges + added_exchanges,
+            max_simultaneous_requests=virtual_host_config.max_simultaneous_requests,
+        )
+
+        if added_exchanges:
+            self.connection.add_callback_threadsafe(
+                functools.partial(self._add_exchanges, added_exchanges)
+            )
+
+        self.set_prefetch_count(virtual_host_config.max_simultaneous_requests)
+
+    @property
+    def is_stopped(self) -> bool:
+        """Determine if any connection stopped processing I/O."""
+        return self._stopped_event.is_set()
+
+    def start_consuming(self, on_message_callback: OnMessageCallback) -> None:
+        """Consume on every channel, and process I/O for every connection."""
+
+        def _on_message_callback(
+            channel: BlockingChannel,
+            method: pika.spec.Basic.Deliver,
+            properties: pika.spec.BasicProperties,
+            body: bytes,
+        ) -> None:
+            if channel in self.ack_coalescers:
+                self.ack_coalescers[channel].track(method.delivery_tag)
+
+            on_message_callback(channel, method, properties, body)
+
+        for channel in self.channels:
+            channel.basic_consume(
+                queue=self.virtual_host_config.queue,
+                on_message_callback=_on_message_callback,
+            )
+
+        for number, connection in enumerate(self.connections):
+            thread = threading.Thread(
+                target=self._process_data_events,
+                args=(connection,),
+                name=f"Connection-{self.virtual_host_name}-{number}",
+                daemon=True,
+            )
+
+            thread.start()
+
+            self._threads.append(thread)
+
+    def publish(
+        self,
+        channel: BlockingChannel,
+        *,
+        exchange: str,
+        routing_key: str,
+        properties: pika.spec.BasicProperties,
+        body: bytes,
+    ) -> None:
+        """Publish message. Must be called from the connection's thread.
+
+        In confirm mode, the message is published as mandatory, so that the
+        broker returns it when it can't be routed (e.g. when the reply queue no
+        longer exists), and tracked until the broker confirms it.
+        """
+        if not self.virtual_host_config.confirm_delivery:
+            channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                properties=properties,
+                body=body,
+            )
+
+            self._count_publish(published=1)
+
+            return
+
+        channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            properties=properties,
+            body=body,
+            mandatory=True,
         )
+
+        self.confirm_trackers[channel].track(properties.correlation_id)
+
+    def acknowledge(self, channel: BlockingChannel, delivery_tag: int) -> None:
+        """Acknowledge message. Must be called from the connection's thread."""
+        if channel in self.ack_coalescers:
+            self.ack_coalescers[channel].complete(delivery_tag)
+
+            return
+
+        channel.basic_ack(delivery_tag=delivery_tag)
+
+    def reject(self, channel: BlockingChannel, delivery_tag: int) -> None:
+        """Reject message. Must be called from the connection's thread.
+
+        The message is not requeued. It's dead-lettered, if a dead-letter
+        exchange is set.
+        """
+        if channel in self.ack_coalescers:
+            self.ack_coalescers[channel].forget(delivery_tag)
+
+        channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+
+    def raise_for_exception(self) -> None:
+        """Raise exception that stopped a connection, if any."""
+        if self._exception:
+            raise self._exception
+
+    def cancel_consumers(self) -> None:
+        """Stop receiving messages on every channel.
+
+        Messages that were received, but not yet passed to the callback, are
+        rejected, so that they are redelivered. Acknowledgements and publishes
+        are still processed.
+        """
+        for channel in self.channels:
+            channel.connection.add_callback_threadsafe(channel.stop_consuming)
+
+    def close(self) -> None:
+        """Stop processing I/O, and close connections."""
+        self._stop_event.set()
+
+        for thread in self._threads:
+            thread.join()
+
+        # Close connections that never processed I/O in a thread
+
+        for connection in self.connections:
+            if connection.is_open:
+                connection.close()
+
+    def _process_data_events(self, connection: BlockingConnection) -> None:
+        """Process I/O for connection, until stopped.
+
+        As connections aren't thread-safe, connections are closed in the same
+        thread.
+        """
+        try:
+            while not self._stop_event.is_set():
+                connection.process_data_events(
+                    time_limit=TIME_LIMIT_PROCESS_DATA_EVENTS
+                )
+        except BaseException as e:
+            logger.exception("Exception processing I/O")
+
+            if not self._exception:
+                self._exception = e
+        finally:
+            self._stopped_event.set()
+
+            if connection.is_open:
+                self._flush(connection)
+
+                connection.close()
+
+    def _flush(self, connection: BlockingConnection) -> None:
+        """Process scheduled callbacks, and send coalesced acknowledgements."""
+        try:
+            connection.process_data_events(time_limit=0)
+
+            for channel, ack_coalescer in self.ack_coalescers.items():
+                if channel.connection is not connection or not channel.is_open:
+                    continue
+
+                ack_coalescer.flush()
+
+                logger.info("Ack coalescer metrics: %s", ack_coalescer.metrics)
+        except Exception:
+            logger.exception("Exception flushing connection")
@@ -1,45 +1,53 @@
 """Program to consume RPC requests.
 
 Usage:
-  rabbitmq-consumer --virtual-host-name=<virtual-host-name> --config-file-path=<config-file-path>
+  rabbitmq-consumer (--virtual-host-name=<virtual-host-name>... | --all-virtual-hosts) --config-file-path=<config-file-path>
 
 Options:
   -h --help                                      Show this screen.
-  --virtual-host-name=<virtual-host-name>        Name of virtual host. Must be in config.
+  --virtual-host-name=<virtual-host-name>        Name of virtual host. Must be in config. May be specified multiple times.
+  --all-virtual-hosts                            Consume all virtual hosts in config.
   --config-file-path=<config-file-path>          Path to config file.
 """
 
-import json
+import asyncio
 import logging
 import os
 import signal
 import sys
 import threading
-from types import ModuleType
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 
-
-import pika
 import sdnotify
-from cryptography.fernet import Fernet, InvalidToken
 from docopt import docopt
 from schema import And, Schema
 
-from cyberfusion.RabbitMQConsumer.config import Config
-from cyberfusion.RabbitMQConsumer.log_server_client import LogServerClient
-from cyberfusion.RabbitMQConsumer.processor import Processor
-from cyberfusion.RabbitMQConsumer.rabbitmq import RabbitMQ
-from cyberfusion.RabbitMQConsumer.types import Locks
-from cyberfusion.RabbitMQConsumer.utilities import (
-    _prefix_message,
-    import_exchange_handler_modules,
+from cyberfusion.RabbitMQConsumer.asyncio_consumer import consume
+from cyberfusion.RabbitMQConsumer.config import Config, Engine, LogFormat, VirtualHost
+from cyberfusion.RabbitMQConsumer.consumer import Consumer
+from cyberfusion.RabbitMQConsumer.metrics import (
+    REGISTRY,
+    MetricsServer,
+    MetricsTextfileWriter,
+    get_metrics_exporters,
+)
+from cyberfusion.RabbitMQConsumer.process_pool import (
+    HandlerProcessPool,
+    get_handler_process_pools,
 )
+from cyberfusion.RabbitMQConsumer.registry import (
+    ExchangeHandler,
+    get_exchange_handlers,
+)
+from cyberfusion.RabbitMQConsumer.reloading import reload_config
+from cyberfusion.RabbitMQConsumer.rpc_logging import JSONFormatter
+from cyberfusion.RabbitMQConsumer.tracing import TRACER
 
 # Configure logging
 
 root_logger = logging.getLogger()
 root_logger.propagate = False
-root_logger.setLevel(logging.DEBUG)
+root_logger.setLevel(logging.INFO)
 
 handler = logging.StreamHandler(sys.stdout)
 handler.setLevel(logging.INFO)
@@ -51,10 +59,16 @@ root_logger.addHandler(handler)
 
 logger = logging.getLogger(__name__)
 
+# Seconds between checks whether any connection stopped
+
+INTERVAL_CHECK_CONNECTIONS = 1.0
+
 # Set default variables
 
-locks = Locks({})
-threads: List[threading.Thread] = []
+consumers: List[Consumer] = []
+process_pools: Dict[str, HandlerProcessPool] = {}
+metrics_exporters: List[Union[MetricsServer, MetricsTextfileWriter]] = []
+reload_requested = threading.Event()
 
 
 def handle_sigterm(  # type: ignore[no-untyped-def]
@@ -64,178 +78,209 @@ def handle_sigterm(  # type: ignore[no-untyped-def]
     """Handle SIGTERM."""
     logger.info("Received SIGTERM")
 
-    # Wait for threads to finish. Note that the thread-safe callbacks, which
-    # usually includes message acknowledgement, are not executed when exiting,
-    # as this happens in the main thread. Therefore, this logic just ensures
-    # that the message handle method finished cleanly, but as the message will
-    # not be acknowledged, it will likely be called again.
-
-    global threads
+    # Stop receiving messages. Connections keep processing I/O, so that messages
+    # that are being processed are still acknowledged.
 
-    for thread in threads:
-        if not thread.is_alive():
-            continue
+    for consumer in consumers:
+        consumer.cancel()
 
-        logger.info("Waiting for thread '%s' to finish before exiting...", thread.name)
+    # Wait for worker pools to drain, and ship remaining log server records
 
-        thread.join()
+    for consumer in consumers:
+        consumer.drain()
 
-    # Exit after all threads finished
+    # Exit after worker pools drained, and log server records shipped
 
     logger.info("Exiting after SIGTERM...")
 
     sys.exit(0)
 
 
-def callback(
-    rabbitmq: RabbitMQ,
-    channel: pika.adapters.blocking_connection.BlockingChannel,
-    method: pika.spec.Basic.Deliver,
-    properties: pika.spec.BasicProperties,
-    modules: Dict[str, ModuleType],
-    log_server_client: Optional[LogServerClient],
-    body: bytes,
+def handle_sighup(  # type: ignore[no-untyped-def]
+    _signal_number: int,
+    _frame,
 ) -> None:
-    """Pass RabbitMQ message to processor."""
-
-    # Log message
-
-    logger.info(
-        _prefix_message(
-            method.exchange,
-            "Received RPC request (%s). Body: '%s'",
-        ),
-        properties.correlation_id,
-        body,
-    )
-
-    # Decrypt message
-
-    decrypted_values = []
-
-    payload = {}
-
-    for key, value in json.loads(body).items():
-        # If Fernet key is set, decrypt messages opportunistically
-
-        if isinstance(value, str) and rabbitmq.fernet_key:
-            try:
-                value = Fernet(rabbitmq.fernet_key).decrypt(value.encode()).decode()
+    """Handle SIGHUP.
 
-                decrypted_values.append(key)
-            except InvalidToken:
-                # Not Fernet-encrypted
+    Config is reloaded by the main loop, rather than in the signal handler.
+    """
+    logger.info("Received SIGHUP")
 
-                pass
+    reload_requested.set()
 
-        payload[key] = value
-
-    # Run processor
 
+def reload(config: Config, exchange_handlers: Dict[str, ExchangeHandler]) -> None:
+    """Reload config, and apply it to consumers."""
     try:
-        processor = Processor(
-            module=modules[method.exchange],
-            rabbitmq=rabbitmq,
-            channel=channel,
-            method=method,
-            properties=properties,
-            locks=locks,
-            payload=payload,
-            log_server_client=log_server_client,
-            decrypted_values=decrypted_values,
+        snapshot = reload_config(
+            config,
+            [consumer.rabbitmq.virtual_host_name for consumer in consumers],
+            exchange_handlers,
+            process_pools,
         )
-    except Exception:
-        logger.exception("Exception initialising processor")
 
-        return
-
-    thread = threading.Thread(
-        target=processor,
-    )
+        if not snapshot:
+            return
 
-    thread.start()
+        for consumer in consumers:
+            virtual_host_config = snapshot.virtual_hosts.get(
+                consumer.rabbitmq.virtual_host_name
+            )
 
-    global threads
+            if virtual_host_config:
+                consumer.reload(virtual_host_config)
+    except Exception:
+        logger.exception("Exception reloading config")
 
-    threads.append(thread)
 
-
-def main() -> None:
-    """Start RabbitMQ consumer."""
-    args = docopt(__doc__)
+def get_args(argv: Optional[List[str]] = None) -> dict:
+    """Parse and validate command line arguments."""
+    args = docopt(__doc__, argv=argv)
 
     schema = Schema(
         {
-            "--virtual-host-name": str,
+            "--virtual-host-name": [str],
+            "--all-virtual-hosts": bool,
             "--config-file-path": And(
                 os.path.exists, error="Config file doesn't exist"
             ),
         }
     )
 
-    args = schema.validate(args)
+    return schema.validate(args)
 
-    # Start RabbitMQ consumer
 
-    rabbitmq: Optional[RabbitMQ] = None
+def get_virtual_hosts(config: Config, args: dict) -> List[VirtualHost]:
+    """Get virtual hosts to consume, by command line arguments."""
+    if args["--all-virtual-hosts"]:
+        return config.virtual_hosts
+
+    return [
+        config.get_virtual_host(virtual_host_name)
+        for virtual_host_name in args["--virtual-host-name"]
+    ]
+
+
+def main() -> None:
+    """Start RabbitMQ consumer."""
+    args = get_args()
+
+    # Start RabbitMQ consumer
 
     try:
         # Get objects
 
         config = Config(args["--config-file-path"])
-        rabbitmq = RabbitMQ(args["--virtual-host-name"], config)
 
-        # Import exchange modules
+        # Configure logging. The root logger has the same level as the handler,
+        # so that logs below the level are discarded before they're formatted.
 
-        modules = import_exchange_handler_modules(
-            rabbitmq.virtual_host_config.exchanges
-        )
+        root_logger.setLevel(config.logging.level)
+        handler.setLevel(config.logging.level)
+
+        if config.logging.format == LogFormat.JSON:
+            handler.setFormatter(JSONFormatter())
+
+        virtual_hosts = get_virtual_hosts(config, args)
+
+        # Import exchange modules, and introspect handlers. Handlers are shared
+        # by all virtual hosts.
+
+        exchanges = [
+            exchange
+            for virtual_host in virtual_hosts
+            for exchange in virtual_host.exchanges
+        ]
+
+        exchange_handlers = get_exchange_handlers(exchanges)
 
-        # Create log server client
+        # Start process pools for exchanges with the process execution mode.
+        # Like handlers, they are shared by all virtual hosts.
 
-        log_server_client = None
+        process_pools.update(get_handler_process_pools(exchanges, exchange_handlers))
 
-        if config.log_server:
-            log_server_client = LogServerClient(
-                config.log_server.base_url, config.log_server.api_token, rabbitmq
+        # Start metrics exporters
+
+        if config.metrics:
+            metrics_exporters.extend(get_metrics_exporters(REGISTRY, config.metrics))
+
+        # Start tracing
+
+        if config.tracing:
+            TRACER.configure(
+                config.tracing.path, sample_rate=config.tracing.sample_rate
             )
 
-        # Configure consuming
-
-        rabbitmq.channel.basic_consume(
-            queue=rabbitmq.virtual_host_config.queue,
-            on_message_callback=lambda channel, method, properties, body: callback(
-                rabbitmq,
-                channel,
-                method,
-                properties,
-                modules,
-                log_server_client,
-                body.decode("utf-8"),
-            ),
-        )
+        # With the asyncio engine, consume on the event loop, until SIGTERM is
+        # received
+
+        if config.engine == Engine.ASYNCIO:
+            asyncio.run(
+                consume(config, virtual_hosts, exchange_handlers, process_pools)
+            )
+
+            return
+
+        # Connect to every virtual host
+
+        for virtual_host in virtual_hosts:
+            consumers.append(
+                Consumer(virtual_host.name, config, exchange_handlers, process_pools)
+            )
+
+        # Start consuming
+
+        for consumer in consumers:
+            consumer.start_consuming()
 
         # Notify systemd at startup
 
         sdnotify.SystemdNotifier().notify("READY=1")
 
-        # Set signal handler
+        # Set signal handlers
 
         signal.signal(signal.SIGTERM, handle_sigterm)
+        signal.signal(signal.SIGHUP, handle_sighup)
 
-        # Start consuming
+        # Wait until a connection stops or SIGTERM is received. Reload config
+        # when SIGHUP is received, and adjust prefetch counts periodically.
+
+        while not any(consumer.rabbitmq.is_stopped for consumer in consumers):
+            for consumer in consumers:
+                consumer.adjust_prefetch()
 
-        rabbitmq.channel.start_consuming()
+            if not reload_requested.wait(INTERVAL_CHECK_CONNECTIONS):
+                continue
+
+            reload_requested.clear()
+
+            reload(config, exchange_handlers)
+
+        for consumer in consumers:
+            consumer.rabbitmq.raise_for_exception()
     finally:
-        if rabbitmq:
-            # Stop consuming
+        # Stop consuming, and close connections
+
+        for consumer in consumers:
+            consumer.close()
 
-            logger.info("Stopping consuming...")
+        # Stop worker processes
+
+        for exchange_name, process_pool in process_pools.items():
+            process_pool.shutdown()
+
+            logger.info(
+                "Process pool metrics for exchange '%s': %s",
+                exchange_name,
+                process_pool.metrics,
+            )
 
-            rabbitmq.channel.stop_consuming()
+        # Stop metrics exporters
 
-            # Close connection
+        for metrics_exporter in metrics_exporters:
+            metrics_exporter.close()
 
-            logger.info("Closing connection...")
+        # Stop tracing. Traces of RPC requests processed while draining are
+        # already written.
 
-            rabbitmq.connection.close()
+        TRACER.close()
@@ -0,0 +1,63 @@
+"""Registry of exchange handlers."""
+
+import inspect
+import types
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Type
+
+from cyberfusion.RabbitMQConsumer.caching import ResultCache, get_result_cache
+from cyberfusion.RabbitMQConsumer.config import Exchange
+from cyberfusion.RabbitMQConsumer.contracts import (
+    HandlerBase,
+    RPCRequestBase,
+    RPCResponseBase,
+)
+from cyberfusion.RabbitMQConsumer.utilities import (
+    get_exchange_handler_class_request_model,
+    get_exchange_handler_class_response_model,
+    import_exchange_handler_modules,
+)
+
+
+@dataclass(frozen=True)
+class ExchangeHandler:
+    """Exchange handler, with attributes resolved by introspection."""
+
+    exchange_name: str
+    module: types.ModuleType
+    handler: HandlerBase
+    request_model: Type[RPCRequestBase]
+    response_model: Type[RPCResponseBase]
+    lock_attribute: Optional[str]
+    is_async: bool
+    result_cache: Optional[ResultCache] = None
+
+
+def get_exchange_handler(
+    exchange_name: str, module: types.ModuleType
+) -> ExchangeHandler:
+    """Instantiate handler in exchange handler module, and introspect it."""
+    handler = module.Handler()
+
+    return ExchangeHandler(
+        exchange_name=exchange_name,
+        module=module,
+        handler=handler,
+        request_model=get_exchange_handler_class_request_model(handler),
+        response_model=get_exchange_handler_class_response_model(handler),
+        lock_attribute=handler.lock_attribute,
+        is_async=inspect.iscoroutinefunction(handler.__call__),
+        result_cache=get_result_cache(exchange_name, handler),
+    )
+
+
+def get_exchange_handlers(exchanges: List[Exchange]) -> Dict[str, ExchangeHandler]:
+    """Import exchange handler modules specified in config, and introspect them.
+
+    This is done once at startup, so that processing RPC requests requires
+    lookups only.
+    """
+    return {
+        exchange_name: get_exchange_handler(exchange_name, module)
+        for exchange_name, module in import_exchange_handler_modules(exchanges).items()
+    }
@@ -0,0 +1,68 @@
+"""Functions for reloading config."""
+
+import logging
+from typing import Collection, Dict, Optional
+
+from cyberfusion.RabbitMQConsumer.config import (
+    Config,
+    ConfigSnapshot,
+    get_added_exchanges,
+    get_restart_required_changes,
+)
+from cyberfusion.RabbitMQConsumer.exceptions import ConfigInvalidError
+from cyberfusion.RabbitMQConsumer.process_pool import (
+    HandlerProcessPool,
+    get_handler_process_pools,
+)
+from cyberfusion.RabbitMQConsumer.registry import (
+    ExchangeHandler,
+    get_exchange_handlers,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def reload_config(
+    config: Config,
+    virtual_host_names: Collection[str],
+    exchange_handlers: Dict[str, ExchangeHandler],
+    process_pools: Dict[str, HandlerProcessPool],
+) -> Optional[ConfigSnapshot]:
+    """Reload config file, and start handlers for exchanges that were added.
+
+    Returns the applied snapshot, which consumers should apply (changes that
+    require a restart are left out). If the config file is invalid, the current
+    config is kept, and None is returned.
+    """
+    logger.info("Reloading config...")
+
+    try:
+        old, new = config.reload()
+    except ConfigInvalidError as e:
+        logger.error("Config file invalid, not reloading: %s", e)
+
+        return None
+
+    for change in get_restart_required_changes(old, new, virtual_host_names):
+        logger.warning("%s, restart to apply", change)
+
+    # Import handler modules, and start process pools, for added exchanges.
+    # Like at startup, these are shared by all virtual hosts.
+
+    added_exchanges = [
+        exchange
+        for virtual_host_name in virtual_host_names
+        if virtual_host_name in old.virtual_hosts
+        and virtual_host_name in new.virtual_hosts
+        for exchange in get_added_exchanges(
+            old.virtual_hosts[virtual_host_name], new.virtual_hosts[virtual_host_name]
+        )
+        if exchange.name not in exchange_handlers
+    ]
+
+    exchange_handlers.update(get_exchange_handlers(added_exchanges))
+    process_pools.update(get_handler_process_pools(added_exchanges, exchange_handlers))
+
+    logger.info("Reloaded config")
+
+    return config.snapshot
@@ -0,0 +1,101 @@
+"""Classes for logging about RPC requests."""
+
+import json
+import logging
+from typing import Any, List, MutableMapping, Optional, Tuple, Union
+
+# Replaces values that were decrypted, like the log server client does
+
+REDACTED_VALUE = "*****"
+
+
+class RPCRequestLoggerAdapter(logging.LoggerAdapter):
+    """Add exchange and correlation ID to logs about RPC request.
+
+    They are prefixed to the message, and set as record attributes (for the
+    JSON formatter). As with loggers, this is only done when the log is
+    emitted.
+    """
+
+    def __init__(
+        self, logger: logging.Logger, exchange: str, correlation_id: Optional[str]
+    ) -> None:
+        """Set attributes."""
+        super().__init__(
+            logger, {"exchange": exchange, "correlation_id": correlation_id}
+        )
+
+        self.exchange = exchange
+        self.correlation_id = correlation_id
+
+    def process(
+        self, msg: Any, kwargs: MutableMapping[str, Any]
+    ) -> Tuple[Any, MutableMapping[str, Any]]:
+        """Add prefix and record attributes."""
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}  # type: ignore[dict-item]
+
+        return f"[{self.exchange}] [{self.correlation_id}] {msg}", kwargs
+
+
+class LogBody:
+    """Body of RPC request or response, formatted when the log is emitted.
+
+    Decrypted values (of payloads) are redacted, and the body is truncated to
+    the max size.
+    """
+
+    def __init__(
+        self,
+        body: Union[str, bytes, dict],
+        *,
+        max_size: int,
+        decrypted_values: Optional[List[str]] = None,
+    ) -> None:
+        """Set attributes."""
+        self.body = body
+        self.max_size = max_size
+        self.decrypted_values = decrypted_values or []
+
+    def __str__(self) -> str:
+        """Get redacted and truncated body."""
+        if isinstance(self.body, dict):
+            body = json.dumps(
+                {
+                    key: REDACTED_VALUE if key in self.decrypted_values else value
+                    for key, value in self.body.items()
+                }
+            )
+        elif isinstance(self.body, bytes):
+            body = self.body.decode("utf-8", errors="replace")
+        else:
+            body = self.body
+
+        if len(body) <= self.max_size:
+            return body
+
+        return (
+            f"{body[: self.max_size]}... ({len(body) - self.max_size} more characters)"
+        )
+
+
+class JSONFormatter(logging.Formatter):
+    """Format logs as JSON objects, one per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format record."""
+        result = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+
+        for attribute in ["exchange", "correlation_id"]:
+            if hasattr(record, attribute):
+                result[attribute] = getattr(record, attribute)
+
+        if record.exc_info:
+            result["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(result)
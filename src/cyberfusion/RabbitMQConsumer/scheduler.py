@@ -0,0 +1,270 @@
+"""Classes for scheduling work items per lock key."""
+
+import asyncio
+import contextlib
+import functools
+import heapq
+import itertools
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from cyberfusion.RabbitMQConsumer.types import LockKey
+from cyberfusion.RabbitMQConsumer.worker_pool import WorkerPool, WorkItem
+
+logger = logging.getLogger(__name__)
+
+# Work item, with its key and priority
+
+ScheduledWorkItem = Tuple[LockKey, WorkItem, int]
+
+
+@dataclass
+class KeyedSchedulerMetrics:
+    """Keyed scheduler metrics."""
+
+    keys: int
+    waiting: int
+    limited: int
+
+
+class KeyedScheduler:
+    """Run work items on worker pool, one at a time per key, in order.
+
+    Work items for a key that already has a work item running wait in a FIFO
+    queue for that key, instead of occupying a worker. When the running work
+    item finishes, the next one for the key is submitted.
+
+    Keys start with the exchange name. If a limit is set for an exchange, at
+    most that amount of its work items run simultaneously. Work items over the
+    limit wait, without occupying a worker, until one finishes.
+
+    Work items with a higher priority are submitted to the worker pool first.
+    """
+
+    def __init__(
+        self, worker_pool: WorkerPool, *, limits: Optional[Dict[str, int]] = None
+    ) -> None:
+        """Set attributes."""
+        self.worker_pool = worker_pool
+        self.limits = limits or {}
+
+        self._lock = threading.Lock()
+
+        # Keys with a work item running (or submitted to the worker pool, or
+        # waiting for the exchange's limit), with the work items waiting for it
+
+        self._queues: Dict[LockKey, Deque[Tuple[WorkItem, int]]] = {}
+
+        # Per exchange, the amount of work items running (or submitted to the
+        # worker pool), and a heap of work items waiting for the limit, ordered
+        # by rank (negated priority), then sequence
+
+        self._running: Dict[str, int] = {}
+        self._limited: Dict[str, List[Tuple[int, int, LockKey, WorkItem]]] = {}
+
+        self._sequence = itertools.count()
+
+    @property
+    def metrics(self) -> KeyedSchedulerMetrics:
+        """Get metrics."""
+        with self._lock:
+            return KeyedSchedulerMetrics(
+                keys=len(self._queues),
+                waiting=sum(len(queue) for queue in self._queues.values()),
+                limited=sum(len(heap) for heap in self._limited.values()),
+            )
+
+    def set_limit(self, exchange_name: str, limit: int) -> None:
+        """Set limit of simultaneously running work items, for added exchange."""
+        with self._lock:
+            self.limits[exchange_name] = limit
+
+    def submit(self, key: LockKey, work_item: WorkItem, *, priority: int = 0) -> bool:
+        """Run work item when no other work item for key is running.
+
+        Returns False when the work item was rejected by the worker pool.
+        """
+        with self._lock:
+            queue = self._queues.get(key)
+
+            if queue is not None:
+                queue.append((work_item, priority))
+
+                return True
+
+            self._queues[key] = deque()
+
+            # Work items only wait for the limit while it's reached, so this is
+            # either the given work item, or nothing
+
+            ready = self._schedule(key, work_item, priority)
+
+        if not ready:
+            return True
+
+        if not self.worker_pool.submit(
+            functools.partial(self._run, key, work_item), priority=priority
+        ):
+            with self._lock:
+                del self._queues[key]
+
+                self._running[key[0]] -= 1
+
+            return False
+
+        return True
+
+    def _schedule(
+        self, key: LockKey, work_item: WorkItem, priority: int
+    ) -> List[ScheduledWorkItem]:
+        """Wait for the exchange's limit, and get work items that may run now.
+
+        Must be called with lock held. The caller must submit the returned work
+        items to the worker pool.
+        """
+        exchange_name = key[0]
+
+        heapq.heappush(
+            self._limited.setdefault(exchange_name, []),
+            (-priority, next(self._sequence), key, work_item),
+        )
+
+        return self._get_ready(exchange_name)
+
+    def _get_ready(self, exchange_name: str) -> List[ScheduledWorkItem]:
+        """Get work items for exchange that may run now, in order of priority.
+
+        Must be called with lock held.
+        """
+        heap = self._limited.get(exchange_name)
+
+        ready: List[ScheduledWorkItem] = []
+
+        limit = self.limits.get(exchange_name)
+
+        while heap and (limit is None or self._running.get(exchange_name, 0) < limit):
+            rank, _, key, work_item = heapq.heappop(heap)
+
+            self._running[exchange_name] = self._running.get(exchange_name, 0) + 1
+
+            ready.append((key, work_item, -rank))
+
+        if not heap:
+            self._limited.pop(exchange_name, None)
+
+        return ready
+
+    def _complete(self, key: LockKey) -> List[ScheduledWorkItem]:
+        """Finish work item for key, and get work items that may run now."""
+        exchange_name = key[0]
+
+        with self._lock:
+            self._running[exchange_name] -= 1
+
+            if not self._running[exchange_name]:
+                del self._running[exchange_name]
+
+            queue = self._queues[key]
+
+            if not queue:
+                del self._queues[key]
+
+                return self._get_ready(exchange_name)
+
+            work_item, priority = queue.popleft()
+
+            return self._schedule(key, work_item, priority)
+
+    def _run(self, key: LockKey, work_item: WorkItem) -> None:
+        """Run work item, followed by the ones that may run after it."""
+        pending = [(key, work_item)]
+
+        while pending:
+            key, work_item = pending.pop(0)
+
+            try:
+                work_item()
+            except Exception:
+                logger.exception("Unhandled exception in work item")
+
+            # Let the worker pool run the next work items, so that they are
+            # queued behind work items with a higher priority. If the worker
+            # pool is shut down, run them in this thread, so that the worker
+            # pool drains them.
+
+            for next_key, next_work_item, priority in self._complete(key):
+                if not self.worker_pool.submit(
+                    functools.partial(self._run, next_key, next_work_item),
+                    priority=priority,
+                ):
+                    pending.append((next_key, next_work_item))
+
+
+class AsyncioPrioritySemaphore:
+    """Semaphore for asyncio, that wakes waiters with a higher priority first.
+
+    Waiters with the same priority are woken in order of arrival. A released
+    slot is passed to the next waiter directly, so that no other coroutine can
+    take it in between.
+    """
+
+    def __init__(self, value: int) -> None:
+        """Set attributes."""
+        self._value = value
+
+        # Heap of waiters, ordered by priority (highest first), then arrival.
+        # Cancelled waiters are skipped when releasing.
+
+        self._waiters: List[Tuple[int, int, "asyncio.Future[None]"]] = []
+        self._counter = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        """Get amount of waiters."""
+        return sum(not future.done() for _, _, future in self._waiters)
+
+    async def acquire(self, priority: int = 0) -> None:
+        """Acquire slot, waiting for one if none is free."""
+        if self._value > 0:
+            self._value -= 1
+
+            return
+
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+
+        heapq.heappush(self._waiters, (-priority, next(self._counter), future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # If the slot was passed to this waiter already, pass it on
+
+            if future.done() and not future.cancelled():
+                self.release()
+
+            raise
+
+    def release(self) -> None:
+        """Release slot, passing it to the waiter with the highest priority."""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+
+            if not future.done():
+                future.set_result(None)
+
+                return
+
+        self._value += 1
+
+    @contextlib.asynccontextmanager
+    async def hold(self, priority: int = 0) -> AsyncIterator[None]:
+        """Hold slot for the duration of the block."""
+        await self.acquire(priority)
+
+        try:
+            yield
+        finally:
+            self.release()
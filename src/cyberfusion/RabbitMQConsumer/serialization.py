@@ -0,0 +1,32 @@
+"""Functions for serializing and deserializing JSON."""
+
+import json
+from typing import Any, Callable, Union
+
+import pydantic_core
+from pydantic import BaseModel
+
+from cyberfusion.RabbitMQConsumer.config import JSONBackend
+
+Loads = Callable[[Union[bytes, str]], Any]
+
+
+def get_loads(backend: JSONBackend) -> Loads:
+    """Get function to deserialize JSON with backend."""
+    if backend == JSONBackend.ORJSON:
+        try:
+            import orjson
+        except ImportError:
+            raise RuntimeError("orjson not installed, can't use it as JSON backend")
+
+        return orjson.loads
+
+    return json.loads
+
+
+def serialize_model(model: BaseModel) -> bytes:
+    """Serialize Pydantic model to JSON.
+
+    Serialization is done by Pydantic's core, regardless of JSON backend.
+    """
+    return pydantic_core.to_json(model)
@@ -0,0 +1,69 @@
+"""Classes for coalescing identical RPC requests."""
+
+import threading
+from dataclasses import dataclass
+from typing import Dict, Generic, Hashable, List, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class SingleFlightMetrics:
+    """Single-flight metrics."""
+
+    groups: int
+    coalesced: int
+
+
+class SingleFlight(Generic[T]):
+    """Group identical RPC requests, so that only the first one is processed.
+
+    The first RPC request for a key becomes the leader of a group. Identical RPC
+    requests received while the leader is queued or running join the group as
+    followers. Once the leader is processed, it completes the group, and gets
+    the followers, which get its RPC response.
+
+    RPC requests received after the group was completed start a new group.
+    """
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        self._lock = threading.Lock()
+
+        # Map keys to followers
+
+        self._groups: Dict[Hashable, List[T]] = {}
+
+        self._coalesced = 0
+
+    @property
+    def metrics(self) -> SingleFlightMetrics:
+        """Get metrics."""
+        with self._lock:
+            return SingleFlightMetrics(
+                groups=len(self._groups), coalesced=self._coalesced
+            )
+
+    def join(self, key: Hashable, item: T) -> bool:
+        """Join group as follower, or start group as leader.
+
+        Returns whether the item joined as follower.
+        """
+        with self._lock:
+            followers = self._groups.get(key)
+
+            if followers is None:
+                self._groups[key] = []
+
+                return False
+
+            followers.append(item)
+
+            self._coalesced += 1
+
+            return True
+
+    def complete(self, key: Hashable) -> List[T]:
+        """End group, and get its followers."""
+        with self._lock:
+            return self._groups.pop(key, [])
@@ -0,0 +1,232 @@
+"""Classes for spooling records to disk."""
+
+import json
+import logging
+import os
+import struct
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFIX_SEGMENT = "segment-"
+SUFFIX_SEGMENT = ".spool"
+
+# Every record is prefixed by its length, as unsigned 32-bit big-endian integer
+
+LENGTH_PREFIX = struct.Struct(">I")
+
+
+@dataclass
+class SpoolMetrics:
+    """Spool metrics."""
+
+    segments: int
+    size: int
+    spooled: int
+    dropped: int
+
+
+class Spool:
+    """Append-only spool of JSON records, stored in rotating segment files.
+
+    Records are appended to the active segment. Once it exceeds the max segment
+    size, a new segment is started. Segments are read oldest first, and removed
+    once their records were processed.
+
+    As a new segment is started on initialisation, segments left by a previous
+    process are never appended to, only read.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        max_size: int = 100 * 1024 * 1024,
+        max_segment_size: int = 1024 * 1024,
+    ) -> None:
+        """Set attributes, and find existing segments."""
+        self.directory = directory
+        self.max_size = max_size
+        self.max_segment_size = max_segment_size
+
+        self._lock = threading.Lock()
+
+        self._spooled = 0
+        self._dropped = 0
+
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+        # Map segment paths to sizes, ordered from oldest to newest
+
+        self._segments: Dict[str, int] = {}
+
+        sequences = []
+
+        for file_name in os.listdir(self.directory):
+            if not file_name.startswith(PREFIX_SEGMENT) or not file_name.endswith(
+                SUFFIX_SEGMENT
+            ):
+                continue
+
+            sequences.append(int(file_name[len(PREFIX_SEGMENT) : -len(SUFFIX_SEGMENT)]))
+
+        for sequence in sorted(sequences):
+            path = self._get_segment_path(sequence)
+
+            self._segments[path] = os.path.getsize(path)
+
+        if self._segments:
+            logger.info(
+                "Found %s existing segments in spool '%s'",
+                len(self._segments),
+                self.directory,
+            )
+
+        self._active_sequence = max(sequences, default=0) + 1
+
+    @property
+    def metrics(self) -> SpoolMetrics:
+        """Get metrics."""
+        with self._lock:
+            return SpoolMetrics(
+                segments=len(self._segments),
+                size=sum(self._segments.values()),
+                spooled=self._spooled,
+                dropped=self._dropped,
+            )
+
+    @property
+    def is_empty(self) -> bool:
+        """Determine if spool contains any records."""
+        with self._lock:
+            return not any(self._segments.values())
+
+    def _get_segment_path(self, sequence: int) -> str:
+        """Get path to segment file by sequence."""
+        return os.path.join(
+            self.directory, f"{PREFIX_SEGMENT}{sequence:020d}{SUFFIX_SEGMENT}"
+        )
+
+    @property
+    def _active_path(self) -> str:
+        """Get path to segment that records are appended to."""
+        return self._get_segment_path(self._active_sequence)
+
+    def append(self, records: List[dict]) -> None:
+        """Append records to active segment.
+
+        If the spool would exceed its max size, the oldest segments are removed.
+        If that isn't enough, the records are dropped.
+        """
+        data = b"".join(
+            LENGTH_PREFIX.pack(len(encoded_record)) + encoded_record
+            for encoded_record in (
+                json.dumps(record).encode("utf-8") for record in records
+            )
+        )
+
+        with self._lock:
+            while sum(self._segments.values()) + len(data) > self.max_size:
+                oldest_path = next(iter(self._segments), None)
+
+                if oldest_path is None or oldest_path == self._active_path:
+                    logger.warning(
+                        "Spool '%s' full, dropping %s records",
+                        self.directory,
+                        len(records),
+                    )
+
+                    self._dropped += len(records)
+
+                    return
+
+                logger.warning(
+                    "Spool '%s' full, removing oldest segment '%s'",
+                    self.directory,
+                    oldest_path,
+                )
+
+                self._remove_segment(oldest_path)
+
+            with open(self._active_path, "ab") as f:
+                f.write(data)
+
+                f.flush()
+
+                os.fsync(f.fileno())
+
+            self._segments[self._active_path] = self._segments.get(
+                self._active_path, 0
+            ) + len(data)
+
+            self._spooled += len(records)
+
+            if self._segments[self._active_path] >= self.max_segment_size:
+                self._active_sequence += 1
+
+    def read_oldest_segment(self) -> Optional[Tuple[str, List[dict]]]:
+        """Get path and records of oldest segment.
+
+        If the oldest segment is the active one, a new segment is started, so
+        that no records are appended to the returned segment.
+        """
+        with self._lock:
+            path = next((path for path, size in self._segments.items() if size), None)
+
+            if path is None:
+                return None
+
+            if path == self._active_path:
+                self._active_sequence += 1
+
+        return path, self._read_segment(path)
+
+    def remove_segment(self, path: str) -> None:
+        """Remove segment, once its records were processed."""
+        with self._lock:
+            self._remove_segment(path)
+
+    def _remove_segment(self, path: str) -> None:
+        """Remove segment. Lock must be held."""
+        self._segments.pop(path, None)
+
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _read_segment(self, path: str) -> List[dict]:
+        """Read records from segment.
+
+        A record that was partially written (e.g. when the process crashed while
+        appending) is ignored.
+        """
+        records: List[dict] = []
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return records
+
+        offset = 0
+
+        while offset + LENGTH_PREFIX.size <= len(data):
+            (length,) = LENGTH_PREFIX.unpack_from(data, offset)
+
+            offset += LENGTH_PREFIX.size
+
+            if offset + length > len(data):
+                logger.warning(
+                    "Ignoring partially written record in segment '%s'", path
+                )
+
+                break
+
+            records.append(json.loads(data[offset : offset + length]))
+
+            offset += length
+
+        return records
@@ -0,0 +1,155 @@
+"""Classes for calling handlers with a timeout."""
+
+import logging
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from cyberfusion.RabbitMQConsumer.exceptions import HandlerTimeoutError
+
+logger = logging.getLogger(__name__)
+
+IDLE_THREAD_NAME = "TimeoutTracker-idle"
+
+
+@dataclass
+class TimeoutTrackerMetrics:
+    """Timeout tracker metrics."""
+
+    timeouts: Dict[str, int]
+    quarantined: int
+
+
+@dataclass
+class _Call:
+    """Function call, run by call thread."""
+
+    function: Callable[[], Any]
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Any = None
+    exception: Optional[BaseException] = None
+
+
+class _CallThread(threading.Thread):
+    """Thread that runs calls one at a time, until stopped."""
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        super().__init__(name=IDLE_THREAD_NAME, daemon=True)
+
+        self._calls: "queue.SimpleQueue[Optional[_Call]]" = queue.SimpleQueue()
+
+    def submit(self, call: _Call) -> None:
+        """Run call."""
+        self._calls.put(call)
+
+    def stop(self) -> None:
+        """Stop, once the current call (if any) returns."""
+        self._calls.put(None)
+
+    def run(self) -> None:
+        """Run calls."""
+        while True:
+            call = self._calls.get()
+
+            if call is None:
+                return
+
+            try:
+                call.result = call.function()
+            except BaseException as e:
+                call.exception = e
+
+            call.done.set()
+
+
+class TimeoutTracker:
+    """Call functions with a timeout, and count timeouts per exchange.
+
+    Functions are called in call threads, which are reused: a thread is only
+    started when no call thread is idle.
+
+    Threads can't be killed. Therefore, a function that times out keeps running
+    in its own thread, which is quarantined: it is no longer waited for, and
+    its result is discarded. Once the function returns, the thread exits. As
+    call threads are daemon threads, they don't prevent exiting.
+    """
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        self._lock = threading.Lock()
+
+        self._timeouts: Dict[str, int] = {}
+        self._idle: List[_CallThread] = []
+        self._quarantined: List[_CallThread] = []
+
+    @property
+    def metrics(self) -> TimeoutTrackerMetrics:
+        """Get metrics.
+
+        Quarantined threads that finished in the meantime are not counted.
+        """
+        with self._lock:
+            self._quarantined = [
+                thread for thread in self._quarantined if thread.is_alive()
+            ]
+
+            return TimeoutTrackerMetrics(
+                timeouts=dict(self._timeouts), quarantined=len(self._quarantined)
+            )
+
+    def count(self, exchange_name: str) -> None:
+        """Count timeout for exchange."""
+        with self._lock:
+            self._timeouts[exchange_name] = self._timeouts.get(exchange_name, 0) + 1
+
+    def call(self, function: Callable[[], Any], timeout: float, *, name: str) -> Any:
+        """Call function in call thread, and return its result.
+
+        Exceptions raised by the function are raised. If the function doesn't
+        return within the timeout, HandlerTimeoutError is raised, and the
+        thread is quarantined. The thread is named after the call while running
+        it.
+        """
+        with self._lock:
+            thread = self._idle.pop() if self._idle else None
+
+        if not thread:
+            thread = _CallThread()
+
+            thread.start()
+
+        thread.name = name
+
+        call = _Call(function)
+
+        thread.submit(call)
+
+        if not call.done.wait(timeout):
+            logger.warning("Quarantining thread '%s' after timeout", name)
+
+            thread.stop()
+
+            with self._lock:
+                self._quarantined.append(thread)
+
+            raise HandlerTimeoutError
+
+        thread.name = IDLE_THREAD_NAME
+
+        with self._lock:
+            self._idle.append(thread)
+
+        if call.exception is not None:
+            raise call.exception
+
+        return call.result
+
+    def close(self) -> None:
+        """Stop idle call threads."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for thread in idle:
+            thread.stop()
@@ -0,0 +1,300 @@
+"""Classes for tracing phases of processing RPC requests."""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, TextIO, Union
+
+logger = logging.getLogger(__name__)
+
+AttributeValue = Union[str, int, float, bool]
+
+# Name of root span, covering the entire RPC request
+
+NAME_ROOT_SPAN = "rpc_request"
+
+STATUS_OK = "STATUS_CODE_OK"
+STATUS_ERROR = "STATUS_CODE_ERROR"
+
+
+def get_trace_id(correlation_id: Optional[str]) -> str:
+    """Get trace ID by correlation ID.
+
+    The trace ID is derived from the correlation ID, so that traces can be
+    found by correlation ID, and traces of redelivered messages are grouped.
+    Messages without correlation ID get a random trace ID.
+    """
+    if correlation_id is None:
+        return uuid.uuid4().hex
+
+    return hashlib.md5(
+        correlation_id.encode("utf-8"), usedforsecurity=False
+    ).hexdigest()
+
+
+def _get_span_id() -> str:
+    """Get random span ID."""
+    return os.urandom(8).hex()
+
+
+@dataclass
+class Span:
+    """Span, with durations measured by monotonic clock."""
+
+    name: str
+    span_id: str
+    parent_span_id: Optional[str]
+    start_time: float
+    end_time: Optional[float] = None
+    attributes: Dict[str, AttributeValue] = field(default_factory=dict)
+
+
+class Trace:
+    """Trace of RPC request, consisting of a root span and a span per phase.
+
+    Spans are exported in the OpenTelemetry JSON format. As durations are
+    measured with a monotonic clock, wall clock timestamps are derived from the
+    wall clock time at which the trace started.
+    """
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        correlation_id: Optional[str],
+        attributes: Dict[str, AttributeValue],
+    ) -> None:
+        """Set attributes, and start root span."""
+        self.tracer = tracer
+        self.trace_id = get_trace_id(correlation_id)
+
+        self._start_time_unix_nano = time.time_ns()
+        self._start_time = time.monotonic()
+
+        self.root_span = Span(
+            name=NAME_ROOT_SPAN,
+            span_id=_get_span_id(),
+            parent_span_id=None,
+            start_time=self._start_time,
+            attributes=dict(attributes),
+        )
+
+        if correlation_id is not None:
+            self.root_span.attributes["rpc.correlation_id"] = correlation_id
+
+        self.spans: List[Span] = []
+
+        self.status = STATUS_OK
+
+        self._finished = False
+
+    def set_attribute(self, key: str, value: AttributeValue) -> None:
+        """Set attribute on root span."""
+        self.root_span.attributes[key] = value
+
+    def set_error(self) -> None:
+        """Mark trace as failed."""
+        self.status = STATUS_ERROR
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Record span for duration of block."""
+        span = Span(
+            name=name,
+            span_id=_get_span_id(),
+            parent_span_id=self.root_span.span_id,
+            start_time=time.monotonic(),
+        )
+
+        try:
+            yield
+        finally:
+            span.end_time = time.monotonic()
+
+            self.spans.append(span)
+
+    def add_span(self, name: str, start_time: float) -> None:
+        """Record span from given monotonic time until now."""
+        self.spans.append(
+            Span(
+                name=name,
+                span_id=_get_span_id(),
+                parent_span_id=self.root_span.span_id,
+                start_time=start_time,
+                end_time=time.monotonic(),
+            )
+        )
+
+    def finish(self) -> None:
+        """End root span, and export trace."""
+        if self._finished:
+            return
+
+        self._finished = True
+
+        self.root_span.end_time = time.monotonic()
+
+        self.tracer.export(self)
+
+    def _get_unix_nano(self, monotonic_time: float) -> int:
+        """Convert monotonic time to wall clock time in nanoseconds."""
+        return self._start_time_unix_nano + int(
+            (monotonic_time - self._start_time) * 1_000_000_000
+        )
+
+    def to_dicts(self) -> List[dict]:
+        """Get spans in OpenTelemetry JSON format."""
+        spans = []
+
+        for span in [self.root_span] + self.spans:
+            span_dict = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "startTimeUnixNano": self._get_unix_nano(span.start_time),
+                "endTimeUnixNano": self._get_unix_nano(
+                    span.end_time if span.end_time is not None else span.start_time
+                ),
+                "attributes": [
+                    {"key": key, "value": _get_attribute_value(value)}
+                    for key, value in span.attributes.items()
+                ],
+            }
+
+            if span.parent_span_id:
+                span_dict["parentSpanId"] = span.parent_span_id
+            else:
+                span_dict["status"] = {"code": self.status}
+
+            spans.append(span_dict)
+
+        return spans
+
+
+def _get_attribute_value(value: AttributeValue) -> dict:
+    """Get attribute value in OpenTelemetry JSON format."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+
+    if isinstance(value, float):
+        return {"doubleValue": value}
+
+    return {"stringValue": value}
+
+
+class NullTrace(Trace):
+    """Trace that records nothing, for RPC requests that are not sampled."""
+
+    def __init__(self) -> None:
+        """Set attributes."""
+
+    def set_attribute(self, key: str, value: AttributeValue) -> None:
+        """Do nothing."""
+
+    def set_error(self) -> None:
+        """Do nothing."""
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Do nothing."""
+        yield
+
+    def add_span(self, name: str, start_time: float) -> None:
+        """Do nothing."""
+
+    def finish(self) -> None:
+        """Do nothing."""
+
+
+NULL_TRACE = NullTrace()
+
+
+class Tracer:
+    """Start traces, and write them to a file as JSON lines.
+
+    Every line contains the spans of a single trace. Only the given fraction
+    of RPC requests is traced.
+
+    Disabled until configured.
+    """
+
+    def __init__(self) -> None:
+        """Set attributes."""
+        self.path: Optional[str] = None
+        self.sample_rate = 0.0
+
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+
+    @property
+    def is_enabled(self) -> bool:
+        """Determine if tracing is enabled."""
+        return self._file is not None and self.sample_rate > 0
+
+    def configure(self, path: str, *, sample_rate: float = 1.0) -> None:
+        """Enable tracing to file."""
+        self.close()
+
+        with self._lock:
+            self.path = path
+            self.sample_rate = sample_rate
+
+            self._file = open(path, "a", encoding="utf-8")
+
+        logger.info("Writing traces to '%s' (sample rate %s)", path, sample_rate)
+
+    def start_trace(
+        self, correlation_id: Optional[str], attributes: Dict[str, AttributeValue]
+    ) -> Trace:
+        """Start trace for RPC request, or get null trace if not sampled.
+
+        Tracing never fails processing: if the trace can't be started, the null
+        trace is returned.
+        """
+        if not self.is_enabled or random.random() >= self.sample_rate:
+            return NULL_TRACE
+
+        try:
+            return Trace(self, correlation_id, attributes)
+        except Exception:
+            logger.exception("Failed to start trace")
+
+            return NULL_TRACE
+
+    def export(self, trace: Trace) -> None:
+        """Write trace to file. Failures are logged, rather than raised."""
+        try:
+            line = json.dumps({"spans": trace.to_dicts()}) + "\n"
+
+            with self._lock:
+                if not self._file:
+                    return
+
+                self._file.write(line)
+                self._file.flush()
+        except Exception:
+            logger.exception("Failed to export trace")
+
+    def close(self) -> None:
+        """Close file."""
+        with self._lock:
+            if not self._file:
+                return
+
+            self._file.close()
+
+            self._file = None
+
+
+# The tracer is process-wide, like metrics
+
+TRACER = Tracer()
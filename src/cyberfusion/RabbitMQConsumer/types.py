@@ -1,6 +1,7 @@
 """Custom types."""
 
-import threading
-from typing import Dict, NewType
+from typing import Hashable, Tuple
 
-Locks = NewType("Locks", Dict[str, Dict[str, threading.Lock]])
+# Exchange name and value of lock attribute
+
+LockKey = Tuple[str, Hashable]
@@ -7,7 +7,7 @@ import logging
 import pkgutil
 import ssl
 import types
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Type
 
 import pika
 
@@ -98,14 +98,14 @@ def import_installed_handler_modules() -> List[types.ModuleType]:
 
 def get_exchange_handler_class_request_model(
     handler: HandlerBase,
-) -> RPCRequestBase:
+) -> Type[RPCRequestBase]:
     """Get exchange handler request model by introspection."""
     return inspect.signature(handler.__call__).parameters["request"].annotation
 
 
 def get_exchange_handler_class_response_model(
     handler: HandlerBase,
-) -> RPCResponseBase:
+) -> Type[RPCResponseBase]:
     """Get exchange handler response model by introspection."""
     return inspect.signature(handler.__call__).return_annotation
 
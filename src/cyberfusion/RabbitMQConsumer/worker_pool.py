@@ -0,0 +1,172 @@
+"""Classes for running work items on a fixed amount of threads."""
+
+import itertools
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WorkItem = Callable[[], None]
+
+# Sentinels that stop threads are ranked after all work items, so that queued
+# work items are processed before threads stop
+
+RANK_SENTINEL = float("inf")
+
+
+@dataclass
+class WorkerPoolMetrics:
+    """Worker pool metrics."""
+
+    size: int
+    active: int
+    queued: int
+    completed: int
+    rejected: int
+
+
+class WorkerPool:
+    """Pool of threads, processing work items from a queue.
+
+    Work items with a higher priority are processed first. Work items with the
+    same priority are processed in order of submission.
+    """
+
+    def __init__(self, size: int, *, name: str = "Worker") -> None:
+        """Set attributes and start threads."""
+        if size < 1:
+            raise ValueError("Worker pool size must be at least 1")
+
+        self.size = size
+        self.name = name
+
+        # Queue entries are ordered by rank (negated priority), then sequence
+
+        self._queue: "queue.PriorityQueue[Tuple[float, int, Optional[WorkItem]]]" = (
+            queue.PriorityQueue()
+        )
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+        self._active = 0
+        self._completed = 0
+        self._rejected = 0
+
+        self._threads: List[threading.Thread] = []
+
+        for _ in range(self.size):
+            self._start_thread()
+
+    @property
+    def metrics(self) -> WorkerPoolMetrics:
+        """Get metrics."""
+        with self._lock:
+            return WorkerPoolMetrics(
+                size=self.size,
+                active=self._active,
+                queued=self._queue.qsize(),
+                completed=self._completed,
+                rejected=self._rejected,
+            )
+
+    def submit(self, work_item: WorkItem, *, priority: int = 0) -> bool:
+        """Queue work item.
+
+        Returns False when the work item was rejected, as the pool is shut down.
+        """
+        with self._lock:
+            if self._shutdown:
+                self._rejected += 1
+
+                return False
+
+            self._put(-priority, work_item)
+
+        return True
+
+    def _put(self, rank: float, work_item: Optional[WorkItem]) -> None:
+        """Queue work item, or sentinel (None). Must be called with lock held."""
+        self._queue.put((rank, next(self._sequence), work_item))
+
+    def _start_thread(self) -> None:
+        """Start thread processing work items."""
+        thread = threading.Thread(
+            target=self._work, name=f"{self.name}-{len(self._threads)}", daemon=True
+        )
+
+        thread.start()
+
+        self._threads.append(thread)
+
+    def resize(self, size: int) -> None:
+        """Change amount of threads.
+
+        When shrinking, threads exit once they've finished their current work
+        item, and queued work items.
+        """
+        if size < 1:
+            raise ValueError("Worker pool size must be at least 1")
+
+        with self._lock:
+            if self._shutdown:
+                return
+
+            for _ in range(self.size - size):
+                self._put(RANK_SENTINEL, None)
+
+            for _ in range(size - self.size):
+                self._start_thread()
+
+            self.size = size
+
+    def shutdown(self, *, wait: bool = True) -> None:
+        """Stop accepting work items, and wait for queued ones to finish.
+
+        Work items that were queued before shutting down are still processed.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+
+            self._shutdown = True
+
+            # Stop one thread per sentinel. As sentinels are ranked after all
+            # work items, the queue is drained before threads exit.
+
+            for _ in self._threads:
+                self._put(RANK_SENTINEL, None)
+
+        if not wait:
+            return
+
+        logger.info("Waiting for worker pool '%s' to drain...", self.name)
+
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self) -> None:
+        """Process work items until sentinel is received."""
+        while True:
+            _, _, work_item = self._queue.get()
+
+            if work_item is None:
+                return
+
+            with self._lock:
+                self._active += 1
+
+            try:
+                work_item()
+            except Exception:
+                # Work items are expected to handle their own exceptions. If they
+                # don't, don't let the thread die, as that shrinks the pool.
+
+                logger.exception("Unhandled exception in work item")
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
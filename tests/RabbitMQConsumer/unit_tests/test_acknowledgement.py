@@ -0,0 +1,109 @@
+from typing import Callable, List, Tuple
+
+from cyberfusion.RabbitMQConsumer.acknowledgement import AckCoalescer
+
+
+def get_ack_coalescer(
+    acks: List[Tuple[int, bool]], timers: List[Callable[[], None]]
+) -> AckCoalescer:
+    return AckCoalescer(
+        lambda delivery_tag, multiple: acks.append((delivery_tag, multiple)),
+        lambda _delay, callback: timers.append(callback),
+        flush_interval=0.1,
+        max_completed=10,
+    )
+
+
+def test_ack_coalescer_acknowledges_range() -> None:
+    acks: List[Tuple[int, bool]] = []
+    timers: List[Callable[[], None]] = []
+
+    ack_coalescer = get_ack_coalescer(acks, timers)
+
+    for delivery_tag in range(1, 6):
+        ack_coalescer.track(delivery_tag)
+
+    # Complete out of order. Delivery tag 4 is still being processed.
+
+    for delivery_tag in (3, 1, 2, 5):
+        ack_coalescer.complete(delivery_tag)
+
+    assert not acks
+    assert len(timers) == 1
+
+    timers.pop()()
+
+    assert acks == [(3, True), (5, False)]
+
+    ack_coalescer.complete(4)
+
+    timers.pop()()
+
+    assert acks == [(3, True), (5, False), (4, False)]
+
+    metrics = ack_coalescer.metrics
+
+    assert metrics.outstanding == 0
+    assert metrics.completed == 0
+    assert metrics.acknowledged == 5
+    assert metrics.frames == 3
+
+
+def test_ack_coalescer_flushes_at_max_completed() -> None:
+    acks: List[Tuple[int, bool]] = []
+    timers: List[Callable[[], None]] = []
+
+    ack_coalescer = get_ack_coalescer(acks, timers)
+
+    for delivery_tag in range(1, 11):
+        ack_coalescer.track(delivery_tag)
+        ack_coalescer.complete(delivery_tag)
+
+    assert acks == [(10, True)]
+
+    # Flushing on timer is a no-op, as nothing is left
+
+    timers.pop()()
+
+    assert acks == [(10, True)]
+
+
+def test_ack_coalescer_skips_forgotten() -> None:
+    acks: List[Tuple[int, bool]] = []
+    timers: List[Callable[[], None]] = []
+
+    ack_coalescer = get_ack_coalescer(acks, timers)
+
+    for delivery_tag in range(1, 4):
+        ack_coalescer.track(delivery_tag)
+
+    ack_coalescer.forget(1)
+
+    ack_coalescer.complete(2)
+    ack_coalescer.complete(3)
+
+    ack_coalescer.flush()
+
+    assert acks == [(3, True)]
+
+
+def test_ack_coalescer_acknowledges_range_over_rejected() -> None:
+    acks: List[Tuple[int, bool]] = []
+    timers: List[Callable[[], None]] = []
+
+    ack_coalescer = get_ack_coalescer(acks, timers)
+
+    for delivery_tag in range(1, 4):
+        ack_coalescer.track(delivery_tag)
+
+    # Delivery tag 2 is rejected, so it doesn't hold back the range
+
+    ack_coalescer.complete(1)
+    ack_coalescer.forget(2)
+    ack_coalescer.complete(3)
+
+    timers.pop()()
+
+    assert acks == [(3, True)]
+    assert ack_coalescer.metrics.outstanding == 0
+    assert ack_coalescer.metrics.acknowledged == 2
@@ -0,0 +1,435 @@
+import asyncio
+import dataclasses
+import inspect
+import json
+import os
+import shutil
+from collections import defaultdict
+from typing import Dict, List, Optional, Union
+from unittest.mock import ANY, MagicMock
+
+import pika
+import pytest
+import yaml
+
+from cyberfusion.RabbitMQConsumer.asyncio_consumer import AsyncioConsumer
+from cyberfusion.RabbitMQConsumer.config import Config
+from cyberfusion.RabbitMQConsumer.contracts import (
+    AsyncHandlerBase,
+    HandlerBase,
+    RPCRequestBase,
+    RPCResponseBase,
+)
+from cyberfusion.RabbitMQConsumer.processor import (
+    MESSAGE_TIMEOUT,
+    MESSAGE_UNEXPECTED_ERROR,
+    MESSAGE_VALIDATION_ERROR,
+)
+from cyberfusion.RabbitMQConsumer.registry import get_exchange_handlers
+from cyberfusion.RabbitMQHandlers.exchanges.dx_example import (
+    RPCRequestExample,
+    RPCResponseDataExample,
+    RPCResponseExample,
+)
+
+CONFIG_FILE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "rabbitmq.yml"
+)
+
+
+class GatedHandler(AsyncHandlerBase):
+    """Handler that returns once the gate for the favourite food is opened."""
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.gates: Dict[str, asyncio.Event] = defaultdict(asyncio.Event)
+        self.started: List[str] = []
+        self.finished: List[str] = []
+
+    @property
+    def lock_attribute(self) -> str:
+        return "favourite_food"
+
+    async def __call__(  # type: ignore[override]
+        self, request: RPCRequestBase
+    ) -> RPCResponseBase:
+        assert isinstance(request, RPCRequestExample)
+
+        favourite_food = request.favourite_food.value
+
+        self.started.append(favourite_food)
+
+        await self.gates[favourite_food].wait()
+
+        self.finished.append(favourite_food)
+
+        return RPCResponseExample(
+            success=True,
+            message=favourite_food,
+            data=RPCResponseDataExample(tolerable=True),
+        )
+
+
+class SyncHandler(HandlerBase):
+    """Handler that runs in the executor, and fails for onions."""
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.calls: List[str] = []
+
+    def __call__(self, request: RPCRequestBase) -> RPCResponseBase:
+        assert isinstance(request, RPCRequestExample)
+
+        self.calls.append(request.favourite_food.value)
+
+        if request.favourite_food.value == "onion":
+            raise RuntimeError("Onions are intolerable")
+
+        return RPCResponseExample(
+            success=True,
+            message="Determined toleration",
+            data=RPCResponseDataExample(tolerable=True),
+        )
+
+
+def get_config(
+    tmp_path, *, virtual_host: Optional[dict] = None, **exchange: object
+) -> Config:
+    path = str(tmp_path / "rabbitmq.yml")
+
+    shutil.copy(CONFIG_FILE_PATH, path)
+
+    with open(path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["engine"] = "asyncio"
+    contents["mock"] = False
+    contents["virtual_hosts"]["test"].update(virtual_host or {})
+    contents["virtual_hosts"]["test"]["exchanges"]["dx_example"].update(exchange)
+
+    with open(path, "w") as f:
+        yaml.dump(contents, f)
+
+    return Config(path)
+
+
+def get_consumer(config: Config, handler: HandlerBase) -> AsyncioConsumer:
+    exchange_handlers = get_exchange_handlers(config.get_all_exchanges())
+
+    exchange_handlers["dx_example"] = dataclasses.replace(
+        exchange_handlers["dx_example"],
+        handler=handler,
+        is_async=inspect.iscoroutinefunction(handler.__call__),
+    )
+
+    consumer = AsyncioConsumer("test", config, exchange_handlers, {})
+
+    consumer.rabbitmq.channel = MagicMock()
+
+    return consumer
+
+
+def deliver(
+    consumer: AsyncioConsumer,
+    body: Union[dict, bytes],
+    *,
+    delivery_tag: int = 1,
+    exchange: str = "dx_example",
+    priority: Optional[int] = None,
+) -> None:
+    consumer.callback(
+        consumer.rabbitmq.channel,
+        pika.spec.Basic.Deliver(delivery_tag=delivery_tag, exchange=exchange),
+        pika.spec.BasicProperties(
+            correlation_id=str(delivery_tag), reply_to="reply", priority=priority
+        ),
+        body if isinstance(body, bytes) else json.dumps(body).encode(),
+    )
+
+
+def get_published(consumer: AsyncioConsumer) -> Dict[str, dict]:
+    channel = consumer.rabbitmq.channel
+
+    assert isinstance(channel, MagicMock)
+
+    return {
+        call.kwargs["properties"].correlation_id: json.loads(call.kwargs["body"])
+        for call in channel.basic_publish.call_args_list
+    }
+
+
+def get_acknowledged(consumer: AsyncioConsumer) -> List[int]:
+    channel = consumer.rabbitmq.channel
+
+    assert isinstance(channel, MagicMock)
+
+    return [call.kwargs["delivery_tag"] for call in channel.basic_ack.call_args_list]
+
+
+async def settle() -> None:
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_asyncio_consumer_hot_lock_key_does_not_starve_limit(tmp_path) -> None:
+    handler = GatedHandler()
+
+    consumer = get_consumer(get_config(tmp_path, max_simultaneous_requests=2), handler)
+
+    async def main() -> None:
+        for delivery_tag in (1, 2, 3):
+            deliver(consumer, {"favourite_food": "onion"}, delivery_tag=delivery_tag)
+
+        deliver(consumer, {"favourite_food": "banana"}, delivery_tag=4)
+
+        await settle()
+
+        # RPC requests waiting for the lock of the hot key don't occupy the
+        # exchange's limit, so the other key is processed
+
+        assert handler.started == ["onion", "banana"]
+
+        handler.gates["banana"].set()
+
+        await settle()
+
+        assert get_acknowledged(consumer) == [4]
+
+        handler.gates["onion"].set()
+
+        await consumer.drain()
+        await consumer.close()
+
+    asyncio.run(main())
+
+    assert handler.finished == ["banana", "onion", "onion", "onion"]
+    assert sorted(get_acknowledged(consumer)) == [1, 2, 3, 4]
+
+
+def test_asyncio_consumer_publishes_and_acknowledges(tmp_path) -> None:
+    handler = SyncHandler()
+
+    consumer = get_consumer(get_config(tmp_path), handler)
+
+    async def main() -> None:
+        deliver(consumer, {"favourite_food": "banana"}, delivery_tag=1)
+        deliver(consumer, {"favourite_food": "onion"}, delivery_tag=2)
+
+        await consumer.drain()
+        await consumer.close()
+
+    asyncio.run(main())
+
+    assert sorted(handler.calls) == ["banana", "onion"]
+
+    published = get_published(consumer)
+
+    assert published["1"]["success"]
+    assert published["1"]["data"] == {"tolerable": True}
+    assert not published["2"]["success"]
+    assert published["2"]["message"] == MESSAGE_UNEXPECTED_ERROR
+
+    channel = consumer.rabbitmq.channel
+
+    assert isinstance(channel, MagicMock)
+
+    assert {
+        call.kwargs["routing_key"] for call in channel.basic_publish.call_args_list
+    } == {"reply"}
+    assert sorted(get_acknowledged(consumer)) == [1, 2]
+
+    assert consumer.lock_manager.metrics.locks == 0
+
+
+def test_asyncio_consumer_validation_failure(tmp_path) -> None:
+    handler = SyncHandler()
+
+    consumer = get_consumer(get_config(tmp_path), handler)
+
+    async def main() -> None:
+        deliver(consumer, {"favourite_food": "banana", "chance_percentage": -1})
+
+        await consumer.drain()
+        await consumer.close()
+
+    asyncio.run(main())
+
+    assert handler.calls == []
+
+    published = get_published(consumer)
+
+    assert len(published) == 1
+    assert published["1"]["message"] == MESSAGE_VALIDATION_ERROR
+    assert get_acknowledged(consumer) == [1]
+
+
+@pytest.mark.parametrize(
+    "body,exchange",
+    [
+        (b"{", "dx_example"),
+        (b'["gAAAAAB"]', "dx_example"),
+        (b"{}", "dx_missing"),
+    ],
+)
+def test_asyncio_consumer_rejects(tmp_path, body: bytes, exchange: str) -> None:
+    handler = SyncHandler()
+
+    consumer = get_consumer(get_config(tmp_path), handler)
+
+    async def main() -> None:
+        deliver(consumer, body, exchange=exchange)
+
+        await consumer.drain()
+        await consumer.close()
+
+    asyncio.run(main())
+
+    channel = consumer.rabbitmq.channel
+
+    assert isinstance(channel, MagicMock)
+
+    channel.basic_reject.assert_called_once_with(delivery_tag=1, requeue=False)
+    channel.basic_publish.assert_not_called()
+    channel.basic_ack.assert_not_called()
+
+    assert handler.calls == []
+
+
+def test_asyncio_consumer_cancels_timed_out_handler(tmp_path) -> None:
+    handler = GatedHandler()
+
+    consumer = get_consumer(get_config(tmp_path, timeout=0.05), handler)
+
+    async def main() -> None:
+        deliver(consumer, {"favourite_food": "banana"}, delivery_tag=1)
+
+        await consumer.drain()
+
+        # Next RPC request for the same key is not blocked by the timed out one
+
+        handler.gates["banana"].set()
+
+        deliver(consumer, {"favourite_food": "banana"}, delivery_tag=2)
+
+        await consumer.drain()
+        await consumer.close()
+
+    asyncio.run(main())
+
+    # The timed out handler was cancelled, so it didn't finish
+
+    assert handler.started == ["banana", "banana"]
+    assert handler.finished == ["banana"]
+
+    published = get_published(consumer)
+
+    assert published["1"]["message"] == MESSAGE_TIMEOUT
+    assert published["2"]["success"]
+    assert get_acknowledged(consumer) == [1, 2]
+
+    assert consumer.timeout_tracker.metrics.timeouts == {"dx_example": 1}
+    assert consumer.lock_manager.metrics.locks == 0
+
+
+def test_asyncio_consumer_drains_on_shutdown(tmp_path) -> None:
+    handler = GatedHandler()
+
+    consumer = get_consumer(get_config(tmp_path), handler)
+
+    channel = consumer.rabbitmq.channel
+
+    assert isinstance(channel, MagicMock)
+
+    channel.basic_consume.return_value = "consumer-tag"
+    channel.basic_cancel.side_effect = lambda consumer_tag, callback: callback(None)
+
+    async def main() -> None:
+        consumer.rabbitmq.start_consuming(consumer.callback)
+
+        deliver(consumer, {"favourite_food": "banana"}, delivery_tag=1)
+        deliver(consumer, {"favourite_food": "orange"}, delivery_tag=2)
+
+        await settle()
+
+        await consumer.cancel()
+
+        channel.basic_cancel.assert_called_once()
+        assert channel.basic_cancel.call_args.args[0] == "consumer-tag"
+
+        drain = asyncio.create_task(consumer.drain())
+
+        await settle()
+
+        # RPC requests being processed are waited for
+
+        assert not drain.done()
+        assert get_acknowledged(consumer) == []
+
+        handler.gates["banana"].set()
+        handler.gates["orange"].set()
+
+        await drain
+        await consumer.close()
+
+    asyncio.run(main())
+
+    assert sorted(get_published(consumer)) == ["1", "2"]
+    assert sorted(get_acknowledged(consumer)) == [1, 2]
+
+
+def test_asyncio_consumer_counts_limited_as_waiting(tmp_path) -> None:
+    handler = GatedHandler()
+
+    consumer = get_consumer(
+        get_config(
+            tmp_path,
+            virtual_host={
+                "max_simultaneous_requests": 2,
+                "adaptive_prefetch": {"target_latency": 60},
+            },
+            max_simultaneous_requests=1,
+        ),
+        handler,
+    )
+
+    channel = consumer.rabbitmq.channel
+
+    assert isinstance(channel, MagicMock)
+
+    channel.basic_qos.side_effect = lambda prefetch_count, callback: callback(None)
+
+    async def main() -> None:
+        # Finish an RPC request, so that handler latency is known
+
+        handler.gates["banana"].set()
+
+        deliver(consumer, {"favourite_food": "banana"}, delivery_tag=1)
+
+        await settle()
+
+        # RPC requests for other keys wait for the exchange's limit
+
+        deliver(consumer, {"favourite_food": "orange"}, delivery_tag=2)
+        deliver(consumer, {"favourite_food": "banana"}, delivery_tag=3)
+        deliver(consumer, {"favourite_food": "onion"}, delivery_tag=4)
+
+        await settle()
+
+        assert consumer.lock_manager.metrics.waiting == 0
+        assert consumer.semaphores["dx_example"].waiting == 2
+
+        await consumer.adjust_prefetch()
+
+        assert consumer.rabbitmq.prefetch_count == 1
+
+        handler.gates["orange"].set()
+        handler.gates["onion"].set()
+
+        await consumer.drain()
+        await consumer.close()
+
+    asyncio.run(main())
+
+    channel.basic_qos.assert_called_with(prefetch_count=1, callback=ANY)
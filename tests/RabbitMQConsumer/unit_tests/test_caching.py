@@ -0,0 +1,111 @@
+from typing import Optional
+from unittest.mock import patch
+
+from cyberfusion.RabbitMQConsumer.caching import (
+    RESULT_CACHES,
+    TTLCache,
+    get_result_cache,
+    invalidate_cached_responses,
+)
+from cyberfusion.RabbitMQConsumer.contracts import (
+    HandlerBase,
+    RPCRequestBase,
+    RPCResponseBase,
+)
+
+
+class RPCRequestFruit(RPCRequestBase):
+    name: str
+
+
+class CachingHandler(HandlerBase):
+    @property
+    def cache_ttl(self) -> Optional[float]:
+        return 60
+
+    def __call__(self, request: RPCRequestFruit) -> RPCResponseBase:  # type: ignore[override]
+        return RPCResponseBase(success=True, message=request.name, data=None)
+
+
+def test_ttl_cache_evicts_least_recently_used() -> None:
+    cache: TTLCache[str, int] = TTLCache(max_size=2, ttl=60)
+
+    cache.set("onion", 1)
+    cache.set("orange", 2)
+
+    assert cache.get("onion") == 1
+
+    cache.set("banana", 3)
+
+    assert cache.get("orange") is None
+    assert cache.get("onion") == 1
+    assert cache.metrics.evicted == 1
+
+
+def test_ttl_cache_expires() -> None:
+    cache: TTLCache[str, int] = TTLCache(max_size=2, ttl=60)
+
+    with patch("time.monotonic", return_value=1000.0):
+        cache.set("onion", 1)
+
+    with patch("time.monotonic", return_value=1060.0):
+        assert cache.get("onion") is None
+
+    assert cache.metrics.expired == 1
+
+
+def test_result_cache_invalidation() -> None:
+    handler = CachingHandler()
+
+    result_cache = get_result_cache("dx_fruit", handler)
+
+    assert result_cache
+    assert RESULT_CACHES["dx_fruit"] is result_cache
+
+    onion = RPCRequestFruit(name="onion")
+    orange = RPCRequestFruit(name="orange")
+
+    for request in (onion, orange):
+        result_cache.set("test", result_cache.get_key(request), handler(request))
+
+    result_cache.set(
+        "test",
+        result_cache.get_key(RPCRequestFruit(name="banana")),
+        RPCResponseBase(success=False, message="banana", data=None),
+    )
+
+    assert result_cache.metrics.size == 2
+
+    invalidate_cached_responses("dx_fruit", onion)
+
+    assert result_cache.get("test", result_cache.get_key(onion)) is None
+    assert result_cache.get("test", result_cache.get_key(orange)) is not None
+
+    invalidate_cached_responses("dx_fruit")
+
+    assert result_cache.metrics.size == 0
+
+
+def test_result_cache_per_virtual_host() -> None:
+    handler = CachingHandler()
+
+    result_cache = get_result_cache("dx_fruit", handler)
+
+    assert result_cache
+
+    onion = RPCRequestFruit(name="onion")
+    key = result_cache.get_key(onion)
+
+    result_cache.set("test", key, handler(onion))
+    result_cache.set("example", key, handler(onion))
+
+    assert result_cache.get("other", key) is None
+
+    invalidate_cached_responses("dx_fruit", virtual_host_name="example")
+
+    assert result_cache.get("example", key) is None
+    assert result_cache.get("test", key) is not None
+
+
+def test_result_cache_disabled_by_default() -> None:
+    assert get_result_cache("dx_example", HandlerBase()) is None
@@ -0,0 +1,277 @@
+import os
+import shutil
+
+import pytest
+import yaml
+
+from cyberfusion.RabbitMQConsumer.config import (
+    Config,
+    get_added_exchanges,
+    get_exchange_limits,
+    get_queue_arguments,
+    get_restart_required_changes,
+)
+from cyberfusion.RabbitMQConsumer.exceptions import (
+    ConfigInvalidError,
+    VirtualHostNotExistsError,
+)
+
+CONFIG_FILE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "rabbitmq.yml"
+)
+
+
+@pytest.fixture
+def config_file_path(tmp_path) -> str:
+    path = str(tmp_path / "rabbitmq.yml")
+
+    shutil.copy(CONFIG_FILE_PATH, path)
+
+    return path
+
+
+def update_config_file(path: str, contents: dict) -> None:
+    with open(path, "w") as f:
+        yaml.dump(contents, f)
+
+
+def test_config_indexes_virtual_hosts(config_file_path: str) -> None:
+    config = Config(config_file_path)
+
+    assert config.get_virtual_host("test").queue == "test"
+
+    with pytest.raises(VirtualHostNotExistsError):
+        config.get_virtual_host("onion")
+
+
+def test_config_invalid(config_file_path: str) -> None:
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["virtual_hosts"]["test"]["max_simultaneous_requests"] = 0
+
+    update_config_file(config_file_path, contents)
+
+    with pytest.raises(ConfigInvalidError, match="max_simultaneous_requests"):
+        Config(config_file_path)
+
+
+def test_config_ignores_unknown_keys(config_file_path: str) -> None:
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["onion"] = True
+    contents["log_server"] = {"base_url": "http://localhost", "api_token": "onion"}
+    contents["log_server"]["onion"] = True
+    contents["virtual_hosts"]["test"]["onion"] = True
+    contents["virtual_hosts"]["test"]["exchanges"]["dx_example"]["onion"] = True
+
+    update_config_file(config_file_path, contents)
+
+    config = Config(config_file_path)
+
+    assert config.get_virtual_host("test").queue == "test"
+
+
+def test_config_reload(config_file_path: str) -> None:
+    config = Config(config_file_path)
+
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["mock"] = not config.mock
+    contents["virtual_hosts"]["test"]["max_simultaneous_requests"] = 10
+    contents["virtual_hosts"]["test"]["exchanges"]["dx_onion"] = {"type": "direct"}
+
+    update_config_file(config_file_path, contents)
+
+    old, new = config.reload()
+
+    assert config.snapshot == new
+    assert new.mock != old.mock
+    assert [
+        exchange.name
+        for exchange in get_added_exchanges(
+            old.virtual_hosts["test"], new.virtual_hosts["test"]
+        )
+    ] == ["dx_onion"]
+    assert not get_restart_required_changes(old, new, ["test"])
+
+
+def test_config_reload_restart_required(config_file_path: str) -> None:
+    config = Config(config_file_path)
+
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["virtual_hosts"]["test"]["queue"] = "onion"
+    contents["virtual_hosts"]["test"]["exchanges"] = {"dx_onion": {"type": "direct"}}
+
+    update_config_file(config_file_path, contents)
+
+    old, new = config.reload()
+
+    assert get_restart_required_changes(old, new, ["test"]) == [
+        "'virtual_hosts.test.queue' changed",
+        "Exchange 'dx_example' removed from virtual host 'test'",
+    ]
+
+
+def test_config_reload_keeps_restart_required(config_file_path: str) -> None:
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["log_server"] = {"base_url": "http://localhost", "api_token": "onion"}
+
+    update_config_file(config_file_path, contents)
+
+    config = Config(config_file_path)
+
+    server = config.server
+    exchange = config.get_virtual_host("test").exchanges[0]
+
+    contents["server"]["host"] = "onion"
+    contents["logging"] = {"level": "DEBUG"}
+    contents["log_server"]["api_token"] = "banana"
+    contents["log_server"]["queue_size"] = 1
+    contents["virtual_hosts"]["test"]["queue"] = "onion"
+    contents["virtual_hosts"]["test"]["max_simultaneous_requests"] = 10
+    contents["virtual_hosts"]["test"]["exchanges"] = {
+        exchange.name: {"type": "direct", "timeout": 1.0},
+        "dx_onion": {"type": "direct"},
+    }
+
+    update_config_file(config_file_path, contents)
+
+    old, new = config.reload()
+
+    assert new.server.host == "onion"
+
+    # Live readers report the config that the running process uses
+
+    assert config.server == server
+    assert config.logging == old.logging
+
+    assert config.log_server
+    assert config.log_server.api_token == "banana"
+    assert config.log_server.queue_size == 1000
+
+    virtual_host = config.get_virtual_host("test")
+
+    assert virtual_host.queue == "test"
+    assert virtual_host.max_simultaneous_requests == 10
+    assert [exchange.name for exchange in virtual_host.exchanges] == [
+        exchange.name,
+        "dx_onion",
+    ]
+    assert virtual_host.exchanges[0] == exchange
+
+    # Reloading again still reports changes that weren't applied
+
+    old, new = config.reload()
+
+    assert "'server' changed" in get_restart_required_changes(old, new, ["test"])
+
+
+def test_config_reload_invalid_keeps_snapshot(config_file_path: str) -> None:
+    config = Config(config_file_path)
+
+    snapshot = config.snapshot
+
+    with open(config_file_path, "w") as f:
+        f.write("server: [")
+
+    with pytest.raises(ConfigInvalidError):
+        config.reload()
+
+    assert config.snapshot is snapshot
+
+
+def test_config_json_backend_invalid(config_file_path: str) -> None:
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["json_backend"] = "onion"
+
+    update_config_file(config_file_path, contents)
+
+    with pytest.raises(ConfigInvalidError, match="JSON backend"):
+        Config(config_file_path)
+
+
+def test_config_max_priority(config_file_path: str) -> None:
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["virtual_hosts"]["test"]["max_priority"] = 10
+
+    update_config_file(config_file_path, contents)
+
+    virtual_host = Config(config_file_path).get_virtual_host("test")
+
+    assert get_queue_arguments(virtual_host) == {"x-max-priority": 10}
+
+    contents["virtual_hosts"]["test"]["max_priority"] = 256
+
+    update_config_file(config_file_path, contents)
+
+    with pytest.raises(ConfigInvalidError, match="max_priority"):
+        Config(config_file_path)
+
+
+def test_config_exchange_limits(config_file_path: str) -> None:
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    exchange_name = next(iter(contents["virtual_hosts"]["test"]["exchanges"]))
+
+    contents["virtual_hosts"]["test"]["exchanges"][exchange_name][
+        "max_simultaneous_requests"
+    ] = 2
+
+    update_config_file(config_file_path, contents)
+
+    virtual_host = Config(config_file_path).get_virtual_host("test")
+
+    assert get_exchange_limits(virtual_host) == {exchange_name: 2}
+
+
+def test_config_adaptive_prefetch(config_file_path: str) -> None:
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["virtual_hosts"]["test"]["adaptive_prefetch"] = {
+        "target_latency": 2.5,
+        "min_prefetch_count": 2,
+    }
+
+    update_config_file(config_file_path, contents)
+
+    adaptive_prefetch = (
+        Config(config_file_path).get_virtual_host("test").adaptive_prefetch
+    )
+
+    assert adaptive_prefetch
+    assert adaptive_prefetch.target_latency == 2.5
+    assert adaptive_prefetch.min_prefetch_count == 2
+    assert adaptive_prefetch.interval == 5.0
+
+
+def test_config_dead_letter_exchange(config_file_path: str) -> None:
+    with open(config_file_path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["virtual_hosts"]["test"]["dead_letter_queue"] = "test.dead-letter"
+
+    update_config_file(config_file_path, contents)
+
+    with pytest.raises(ConfigInvalidError, match="dead_letter_exchange"):
+        Config(config_file_path)
+
+    contents["virtual_hosts"]["test"]["dead_letter_exchange"] = "dlx"
+
+    update_config_file(config_file_path, contents)
+
+    virtual_host = Config(config_file_path).get_virtual_host("test")
+
+    assert get_queue_arguments(virtual_host) == {"x-dead-letter-exchange": "dlx"}
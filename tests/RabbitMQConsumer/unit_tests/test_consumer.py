@@ -0,0 +1,208 @@
+import json
+import os
+import shutil
+from typing import Iterator, Optional
+from unittest.mock import MagicMock
+
+import pytest
+import yaml
+from pytest_mock import MockerFixture
+
+from cyberfusion.RabbitMQConsumer.config import Config
+from cyberfusion.RabbitMQConsumer.consumer import Consumer
+from cyberfusion.RabbitMQConsumer.metrics import (
+    DECRYPTION_VALUES,
+    HANDLER_TIMEOUTS,
+    LOCK_ACQUISITIONS,
+    REASON_MALFORMED,
+    REASON_MAX_DELIVERIES,
+    REASON_UNPROCESSABLE,
+    REGISTRY,
+    RPC_REQUESTS_REJECTED,
+)
+from cyberfusion.RabbitMQConsumer.registry import get_exchange_handlers
+from cyberfusion.RabbitMQConsumer.reloading import reload_config
+
+CONFIG_FILE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "rabbitmq.yml"
+)
+
+
+@pytest.fixture
+def consumer(tmp_path, mocker: MockerFixture) -> Iterator[Consumer]:
+    path = str(tmp_path / "rabbitmq.yml")
+
+    shutil.copy(CONFIG_FILE_PATH, path)
+
+    with open(path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["virtual_hosts"]["test"]["dead_letter_exchange"] = "dlx"
+    contents["virtual_hosts"]["test"]["dead_letter_queue"] = "test.dead-letter"
+    contents["virtual_hosts"]["test"]["max_deliveries"] = 3
+
+    with open(path, "w") as f:
+        yaml.dump(contents, f)
+
+    config = Config(path)
+
+    mocker.patch("pika.BlockingConnection")
+
+    consumer = Consumer(
+        "test", config, get_exchange_handlers(config.get_all_exchanges()), {}
+    )
+
+    yield consumer
+
+    consumer.drain()
+
+
+def deliver(
+    consumer: Consumer,
+    body: bytes,
+    *,
+    exchange: str = "dx_example",
+    headers: Optional[dict] = None,
+) -> MagicMock:
+    channel = MagicMock()
+    channel.connection.add_callback_threadsafe.side_effect = lambda f: f()
+
+    consumer.callback(
+        channel,
+        MagicMock(exchange=exchange, delivery_tag=1, redelivered=False),
+        MagicMock(correlation_id=None, reply_to="r", priority=None, headers=headers),
+        body,
+    )
+
+    return channel
+
+
+def get_rejected(reason: str, exchange: str = "dx_example") -> float:
+    return RPC_REQUESTS_REJECTED.get(
+        virtual_host="test", exchange=exchange, reason=reason
+    )
+
+
+def test_consumer_declares_dead_letter_exchange(consumer: Consumer) -> None:
+    channel = consumer.rabbitmq.channel
+
+    channel.exchange_declare.assert_any_call(
+        exchange="dlx", exchange_type="fanout", durable=True
+    )
+    channel.queue_bind.assert_any_call(exchange="dlx", queue="test.dead-letter")
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        # Not valid JSON, with and without possible Fernet token
+        b"{",
+        b'{"a": "gAAAAAB',
+        # Not a JSON object, while possibly containing Fernet token
+        b'["gAAAAAB"]',
+        b'"gAAAAAB"',
+    ],
+)
+def test_consumer_rejects_malformed_body(consumer: Consumer, body: bytes) -> None:
+    rejected = get_rejected(REASON_MALFORMED)
+
+    channel = deliver(consumer, body)
+
+    channel.basic_reject.assert_called_once_with(delivery_tag=1, requeue=False)
+    channel.basic_ack.assert_not_called()
+    channel.basic_publish.assert_not_called()
+
+    assert get_rejected(REASON_MALFORMED) == rejected + 1
+
+
+def test_consumer_rejects_after_max_deliveries(consumer: Consumer) -> None:
+    rejected = get_rejected(REASON_MAX_DELIVERIES)
+
+    channel = deliver(
+        consumer,
+        json.dumps({"favourite_food": "banana", "chance_percentage": 5}).encode(),
+        headers={"x-delivery-count": 3},
+    )
+
+    channel.basic_reject.assert_called_once_with(delivery_tag=1, requeue=False)
+
+    assert get_rejected(REASON_MAX_DELIVERIES) == rejected + 1
+
+
+def test_consumer_rejects_unprocessable(consumer: Consumer) -> None:
+    rejected = get_rejected(REASON_UNPROCESSABLE, "dx_missing")
+
+    channel = deliver(consumer, b"{}", exchange="dx_missing")
+
+    channel.basic_reject.assert_called_once_with(delivery_tag=1, requeue=False)
+
+    assert get_rejected(REASON_UNPROCESSABLE, "dx_missing") == rejected + 1
+
+
+def test_consumer_acknowledges_invalid_request(consumer: Consumer) -> None:
+    channel = deliver(
+        consumer,
+        json.dumps({"favourite_food": "banana", "chance_percentage": -1}).encode(),
+    )
+
+    channel.basic_reject.assert_not_called()
+    channel.basic_publish.assert_called_once()
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+
+def test_consumer_exports_component_metrics(consumer: Consumer) -> None:
+    consumer.lock_manager.acquire("onion")
+    consumer.lock_manager.release("onion")
+
+    consumer.timeout_tracker.count("dx_example")
+
+    deliver(consumer, b'{"a": "gAAAAAB"}')
+
+    REGISTRY.render()
+
+    assert LOCK_ACQUISITIONS.get(virtual_host="test") == 1
+    assert HANDLER_TIMEOUTS.get(virtual_host="test", exchange="dx_example") == 1
+    assert DECRYPTION_VALUES.get(virtual_host="test", result="skipped") == 1
+
+
+def reload_consumer(consumer: Consumer, contents: dict) -> None:
+    with open(consumer.config.path, "w") as f:
+        yaml.dump(contents, f)
+
+    snapshot = reload_config(consumer.config, ["test"], {}, {})
+
+    assert snapshot
+
+    consumer.reload(snapshot.virtual_hosts["test"])
+
+
+def test_consumer_reconfigures_log_server_client(consumer: Consumer) -> None:
+    with open(consumer.config.path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["log_server"] = {"base_url": "http://localhost", "api_token": "onion"}
+
+    reload_consumer(consumer, contents)
+
+    log_server_client = consumer.log_server_client
+
+    assert log_server_client
+    assert log_server_client.api_token == "onion"
+
+    # Reloadable settings are applied, even when settings that require a
+    # restart changed as well
+
+    contents["log_server"]["api_token"] = "banana"
+    contents["log_server"]["queue_size"] = 1
+
+    reload_consumer(consumer, contents)
+
+    assert consumer.log_server_client is log_server_client
+    assert log_server_client.api_token == "banana"
+    assert log_server_client._queue.maxsize == 1000
+
+    contents["log_server"]["base_url"] = "http://127.0.0.1"
+
+    reload_consumer(consumer, contents)
+
+    assert log_server_client.base_url == "http://127.0.0.1"
@@ -0,0 +1,29 @@
+import pika
+
+from cyberfusion.RabbitMQConsumer.dead_lettering import get_delivery_count
+
+
+def test_get_delivery_count() -> None:
+    assert get_delivery_count(pika.BasicProperties()) == 0
+
+    # Quorum queues
+
+    assert (
+        get_delivery_count(pika.BasicProperties(headers={"x-delivery-count": 3})) == 3
+    )
+
+    # Dead-lettered before, e.g. by rejecting and routing back to the queue
+
+    assert (
+        get_delivery_count(
+            pika.BasicProperties(
+                headers={
+                    "x-death": [
+                        {"count": 2, "reason": "rejected"},
+                        {"count": 1, "reason": "expired"},
+                    ]
+                }
+            )
+        )
+        == 3
+    )
@@ -0,0 +1,52 @@
+import json
+
+from cryptography.fernet import Fernet
+
+from cyberfusion.RabbitMQConsumer.decryption import (
+    Decryptor,
+    is_possible_fernet_token,
+    may_contain_fernet_token,
+)
+
+KEY_OLD = Fernet.generate_key().decode()
+KEY_NEW = Fernet.generate_key().decode()
+
+
+def test_is_possible_fernet_token() -> None:
+    assert is_possible_fernet_token(Fernet(KEY_OLD).encrypt(b"").decode())
+    assert not is_possible_fernet_token("password")
+    assert not is_possible_fernet_token("gAAAAA")
+
+
+def test_may_contain_fernet_token() -> None:
+    token = Fernet(KEY_OLD).encrypt(b"").decode()
+
+    assert may_contain_fernet_token(json.dumps({"password": token}).encode())
+    assert not may_contain_fernet_token(json.dumps({"password": "onion"}).encode())
+
+
+def test_decryptor_decrypts_with_any_key() -> None:
+    decryptor = Decryptor([KEY_NEW, KEY_OLD])
+
+    payload, decrypted_values = decryptor.decrypt_payload(
+        {
+            "old": Fernet(KEY_OLD).encrypt(b"old").decode(),
+            "new": Fernet(KEY_NEW).encrypt(b"new").decode(),
+            "unknown": Fernet(Fernet.generate_key()).encrypt(b"unknown").decode(),
+            "plain": "plain",
+            "number": 1,
+        }
+    )
+
+    assert payload["old"] == "old"
+    assert payload["new"] == "new"
+    assert payload["unknown"].startswith("gAAAAA")
+    assert payload["plain"] == "plain"
+    assert payload["number"] == 1
+    assert decrypted_values == ["old", "new"]
+
+    metrics = decryptor.metrics
+
+    assert metrics.decrypted == 2
+    assert metrics.invalid == 1
+    assert metrics.skipped == 1
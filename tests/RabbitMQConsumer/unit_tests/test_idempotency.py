@@ -0,0 +1,56 @@
+from unittest.mock import patch
+
+from cyberfusion.RabbitMQConsumer.idempotency import IdempotencyStore
+
+KEY = ("test", "dx_example", "onion")
+
+
+def test_idempotency_store_evicts_least_recently_used() -> None:
+    store = IdempotencyStore(max_size=2)
+
+    store.set(("test", "dx_example", "1"), b"1")
+    store.set(("test", "dx_example", "2"), b"2")
+
+    assert store.get(("test", "dx_example", "1")) == b"1"
+
+    store.set(("test", "dx_example", "3"), b"3")
+
+    assert store.get(("test", "dx_example", "2")) is None
+    assert store.get(("test", "dx_example", "1")) == b"1"
+
+    metrics = store.metrics
+
+    assert metrics.size == 2
+    assert metrics.hits == 2
+    assert metrics.misses == 1
+
+
+def test_idempotency_store_expires() -> None:
+    store = IdempotencyStore(ttl=60)
+
+    with patch("time.monotonic", return_value=1000.0):
+        store.set(KEY, b"response")
+
+    with patch("time.monotonic", return_value=1059.0):
+        assert store.get(KEY) == b"response"
+
+    with patch("time.monotonic", return_value=1060.0):
+        assert store.get(KEY) is None
+
+    assert store.metrics.expired == 1
+
+
+def test_idempotency_store_persists(tmp_path) -> None:
+    path = str(tmp_path / "responses.sqlite3")
+
+    store = IdempotencyStore(path=path)
+
+    store.set(KEY, b"response")
+    store.close()
+
+    store = IdempotencyStore(path=path)
+
+    assert store.get(KEY) == b"response"
+    assert store.get(("test", "dx_example", "banana")) is None
+
+    store.close()
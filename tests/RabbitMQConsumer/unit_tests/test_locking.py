@@ -0,0 +1,187 @@
+import asyncio
+import threading
+import time
+
+from cyberfusion.RabbitMQConsumer.locking import AsyncioLockManager, LockManager
+
+
+def test_lock_manager_removes_idle_locks() -> None:
+    lock_manager = LockManager()
+
+    for number in range(100):
+        lock_manager.acquire(("dx_example", number))
+        lock_manager.release(("dx_example", number))
+
+    assert lock_manager.metrics.locks == 0
+    assert lock_manager.metrics.acquisitions == 100
+
+
+def test_lock_manager_excludes_same_key() -> None:
+    lock_manager = LockManager()
+
+    key = ("dx_example", "onion")
+
+    lock_manager.acquire(key)
+
+    acquired = threading.Event()
+
+    def acquire() -> None:
+        lock_manager.acquire(key)
+
+        acquired.set()
+
+        lock_manager.release(key)
+
+    thread = threading.Thread(target=acquire)
+
+    thread.start()
+
+    assert not acquired.wait(timeout=0.1)
+    assert lock_manager.metrics.waiting == 1
+
+    # Unrelated keys are not blocked
+
+    lock_manager.acquire(("dx_example", "banana"))
+    lock_manager.release(("dx_example", "banana"))
+
+    lock_manager.release(key)
+
+    thread.join()
+
+    assert acquired.is_set()
+
+    metrics = lock_manager.metrics
+
+    assert metrics.locks == 0
+    assert metrics.contentions == 1
+    assert metrics.wait_time > 0
+
+
+def test_asyncio_lock_manager_excludes_same_key() -> None:
+    lock_manager = AsyncioLockManager()
+
+    key = ("dx_example", "onion")
+
+    order = []
+
+    async def hold(name: str) -> None:
+        await lock_manager.acquire(key)
+
+        order.append(f"{name}-acquired")
+
+        await asyncio.sleep(0.01)
+
+        order.append(f"{name}-released")
+
+        lock_manager.release(key)
+
+    async def main() -> None:
+        await asyncio.gather(hold("first"), hold("second"))
+
+    asyncio.run(main())
+
+    assert order == [
+        "first-acquired",
+        "first-released",
+        "second-acquired",
+        "second-released",
+    ]
+
+    metrics = lock_manager.metrics
+
+    assert metrics.locks == 0
+    assert metrics.acquisitions == 2
+    assert metrics.contentions == 1
+
+
+def test_lock_manager_spreads_keys_over_shards() -> None:
+    lock_manager = LockManager(shards=4)
+
+    keys = [("dx_example", number) for number in range(100)]
+
+    for key in keys:
+        lock_manager.acquire(key)
+
+    assert all(shard.entries for shard in lock_manager._shards)
+    assert sum(len(shard.entries) for shard in lock_manager._shards) == 100
+
+    for key in keys:
+        assert key in lock_manager._get_shard(key).entries
+
+        lock_manager.release(key)
+
+    assert not any(shard.entries for shard in lock_manager._shards)
+
+
+def test_lock_manager_keeps_waited_for_locks() -> None:
+    lock_manager = LockManager()
+
+    key = ("dx_example", "onion")
+
+    lock_manager.acquire(key)
+
+    entry = lock_manager._get_shard(key).entries[key]
+
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def acquire() -> None:
+        lock_manager.acquire(key)
+
+        acquired.set()
+        release.wait()
+
+        lock_manager.release(key)
+
+    thread = threading.Thread(target=acquire)
+
+    thread.start()
+
+    while lock_manager.metrics.waiting != 1:
+        time.sleep(0.01)
+
+    # Lock is not evicted on release, as it's waited for, so the waiter holds
+    # the same lock as any later acquirer
+
+    lock_manager.release(key)
+
+    assert acquired.wait(timeout=1)
+    assert lock_manager._get_shard(key).entries[key] is entry
+    assert entry.references == 1
+
+    release.set()
+
+    thread.join()
+
+    assert key not in lock_manager._get_shard(key).entries
+    assert lock_manager.metrics.locks == 0
+
+
+def test_asyncio_lock_manager_removes_locks_of_cancelled_waiters() -> None:
+    lock_manager = AsyncioLockManager()
+
+    key = ("dx_example", "onion")
+
+    async def main() -> None:
+        await lock_manager.acquire(key)
+
+        waiter = asyncio.create_task(lock_manager.acquire(key))
+
+        await asyncio.sleep(0)
+
+        assert lock_manager.metrics.waiting == 1
+
+        waiter.cancel()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            pass
+
+        assert lock_manager.metrics.waiting == 0
+
+        lock_manager.release(key)
+
+    asyncio.run(main())
+
+    assert lock_manager.metrics.locks == 0
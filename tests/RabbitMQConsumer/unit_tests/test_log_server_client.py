@@ -0,0 +1,127 @@
+from unittest.mock import MagicMock
+
+import requests
+from pytest_mock import MockerFixture
+
+from cyberfusion.RabbitMQConsumer.log_server_client import LogServerClient
+from cyberfusion.RabbitMQConsumer.spool import Spool
+
+
+def test_log_server_client_ships_batches_on_close(mocker: MockerFixture) -> None:
+    post = mocker.patch("requests.Session.post")
+
+    log_server_client = LogServerClient(
+        "http://localhost/api/v1/",
+        "test",
+        MagicMock(),
+        batch_size=10,
+        flush_interval=60,
+    )
+
+    log_server_client.log_rpc_request(
+        correlation_id="1",
+        request_payload={"password": "secret", "name": "test"},
+        decrypted_values=["password"],
+        exchange_name="dx_example",
+    )
+    log_server_client.log_rpc_response(
+        correlation_id="1", response_payload={"success": True}, traceback=None
+    )
+
+    log_server_client.close()
+
+    assert [call.args[0] for call in post.call_args_list] == [
+        "http://localhost/api/v1/rpc-requests/batch",
+        "http://localhost/api/v1/rpc-responses/batch",
+    ]
+    assert post.call_args_list[0].kwargs["json"][0]["request_payload"] == {
+        "password": "*****",
+        "name": "test",
+    }
+    assert log_server_client.metrics.shipped == 2
+
+
+def test_log_server_client_drops_when_queue_full(mocker: MockerFixture) -> None:
+    mocker.patch("requests.Session.post")
+
+    log_server_client = LogServerClient(
+        "http://localhost/api/v1/",
+        "test",
+        MagicMock(),
+        queue_size=1,
+        batch_size=10,
+        flush_interval=60,
+    )
+
+    # The shipping thread may have taken the first record already, so the second
+    # or third record is dropped
+
+    for _ in range(3):
+        log_server_client.log_rpc_response(
+            correlation_id="1", response_payload={}, traceback=None
+        )
+
+    assert log_server_client.metrics.dropped >= 1
+
+    log_server_client.close()
+
+
+def test_log_server_client_spools_failed_records(
+    mocker: MockerFixture, tmp_path
+) -> None:
+    mocker.patch(
+        "requests.Session.post", side_effect=requests.exceptions.ConnectionError
+    )
+
+    spool = Spool(str(tmp_path))
+
+    log_server_client = LogServerClient(
+        "http://localhost/api/v1/", "test", MagicMock(), spool=spool
+    )
+
+    log_server_client.log_rpc_response(
+        correlation_id="1", response_payload={}, traceback=None
+    )
+
+    log_server_client.close()
+
+    _, records = spool.read_oldest_segment()
+
+    assert records == [
+        {
+            "path": "rpc-responses",
+            "payload": {
+                "correlation_id": "1",
+                "response_payload": {},
+                "traceback": None,
+            },
+        }
+    ]
+
+
+def test_log_server_client_ships_before_spooling_on_close(
+    mocker: MockerFixture, tmp_path
+) -> None:
+    post = mocker.patch("requests.Session.post")
+
+    spool = Spool(str(tmp_path))
+
+    log_server_client = LogServerClient(
+        "http://localhost/api/v1/",
+        "test",
+        MagicMock(),
+        spool=spool,
+        batch_size=10,
+        flush_interval=60,
+    )
+
+    log_server_client.log_rpc_response(
+        correlation_id="1", response_payload={}, traceback=None
+    )
+
+    log_server_client.close()
+
+    post.assert_called_once()
+
+    assert spool.is_empty
+    assert log_server_client.metrics.shipped == 1
@@ -0,0 +1,105 @@
+import urllib.request
+
+from cyberfusion.RabbitMQConsumer.metrics import (
+    MetricsRegistry,
+    MetricsServer,
+    MetricsTextfileWriter,
+)
+
+
+def test_metrics_registry_renders_text_format() -> None:
+    registry = MetricsRegistry()
+
+    counter = registry.counter("requests_total", "Requests.", ["exchange"])
+    gauge = registry.gauge("queue_depth", "Queue depth.")
+    histogram = registry.histogram(
+        "duration_seconds", "Duration.", ["phase"], buckets=(0.1, 1.0)
+    )
+
+    counter.inc(exchange="dx_example")
+    counter.inc(2, exchange="dx_example")
+
+    registry.add_collector(lambda: gauge.set(5))
+
+    histogram.observe(0.05, phase="handler")
+    histogram.observe(0.5, phase="handler")
+    histogram.observe(5, phase="handler")
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{exchange="dx_example"} 3.0',
+        "# HELP queue_depth Queue depth.",
+        "# TYPE queue_depth gauge",
+        "queue_depth 5.0",
+        "# HELP duration_seconds Duration.",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{phase="handler",le="0.1"} 1',
+        'duration_seconds_bucket{phase="handler",le="1.0"} 2',
+        'duration_seconds_bucket{phase="handler",le="+Inf"} 3',
+        'duration_seconds_sum{phase="handler"} 5.55',
+        'duration_seconds_count{phase="handler"} 3',
+    ]
+
+
+def test_metrics_server_serves_metrics() -> None:
+    registry = MetricsRegistry()
+
+    registry.counter("requests_total", "Requests.").inc()
+
+    metrics_server = MetricsServer(registry, "127.0.0.1", 0)
+
+    try:
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{metrics_server.port}/metrics"
+        ) as response:
+            assert "requests_total 1.0" in response.read().decode("utf-8")
+    finally:
+        metrics_server.close()
+
+
+def test_metrics_textfile_writer_writes_on_close(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    registry = MetricsRegistry()
+
+    counter = registry.counter("requests_total", "Requests.")
+
+    path = tmp_path / "rabbitmq_consumer.prom"
+
+    metrics_textfile_writer = MetricsTextfileWriter(registry, str(path), interval=3600)
+
+    counter.inc()
+
+    metrics_textfile_writer.close()
+
+    assert "requests_total 1.0" in path.read_text()
+    assert [file.name for file in tmp_path.iterdir()] == ["rabbitmq_consumer.prom"]
+
+
+def test_metrics_registry_escapes_label_values() -> None:
+    registry = MetricsRegistry()
+
+    counter = registry.counter("requests_total", "Requests.", ["exchange"])
+    histogram = registry.histogram(
+        "duration_seconds", "Duration.", ["exchange"], buckets=(1.0,)
+    )
+
+    exchange = 'dx_"example"\\\nother'
+
+    counter.inc(exchange=exchange)
+    histogram.observe(0.5, exchange=exchange)
+
+    lines = registry.render().splitlines()
+
+    # Backslashes are escaped before quotes and newlines, so that they aren't
+    # escaped twice
+
+    assert 'requests_total{exchange="dx_\\"example\\"\\\\\\nother"} 1.0' in lines
+    assert (
+        'duration_seconds_bucket{exchange="dx_\\"example\\"\\\\\\nother",le="1.0"} 1'
+        in lines
+    )
+    assert 'duration_seconds_count{exchange="dx_\\"example\\"\\\\\\nother"} 1' in lines
+
+    # Every sample is on its own line
+
+    assert len(lines) == 9
@@ -0,0 +1,63 @@
+from cyberfusion.RabbitMQConsumer.metrics import PHASE_DURATION, PHASE_HANDLER
+from cyberfusion.RabbitMQConsumer.prefetch import HandlerLatency, PrefetchController
+
+
+def test_prefetch_controller_aimd() -> None:
+    prefetch_controller = PrefetchController(
+        target_latency=1.0, min_prefetch_count=2, max_prefetch_count=10
+    )
+
+    healthy = {"latency": 0.5, "saturation": 0.5, "waiting": 0, "memory": None}
+    slow = {**healthy, "latency": 2.0}
+
+    assert prefetch_controller.adjust(**slow) == 5
+    assert prefetch_controller.adjust(**slow) == 2
+    assert prefetch_controller.adjust(**slow) == 2
+
+    assert prefetch_controller.adjust(**healthy) == 3
+    assert prefetch_controller.adjust(**healthy) == 4
+
+    metrics = prefetch_controller.metrics
+
+    assert metrics.decreases == 2
+    assert metrics.increases == 2
+
+
+def test_prefetch_controller_overloaded() -> None:
+    prefetch_controller = PrefetchController(
+        target_latency=1.0, min_prefetch_count=1, max_prefetch_count=4, max_memory=100
+    )
+
+    healthy = {"latency": 0.5, "saturation": 0.5, "waiting": 0, "memory": 50}
+
+    assert not prefetch_controller.is_overloaded(**healthy)
+
+    # No handler finished, while all prefetched messages are being processed
+
+    assert prefetch_controller.is_overloaded(
+        **{**healthy, "latency": None, "saturation": 1.0}
+    )
+    assert not prefetch_controller.is_overloaded(**{**healthy, "latency": None})
+
+    assert prefetch_controller.is_overloaded(**{**healthy, "waiting": 4})
+    assert prefetch_controller.is_overloaded(**{**healthy, "memory": 200})
+
+
+def test_handler_latency_is_mean_since_last_sample() -> None:
+    handler_latency = HandlerLatency("test", ["dx_prefetch"])
+
+    assert handler_latency.sample() is None
+
+    for duration in (1.0, 3.0):
+        PHASE_DURATION.observe(
+            duration, virtual_host="test", exchange="dx_prefetch", phase=PHASE_HANDLER
+        )
+
+    # Handler latency of other virtual hosts is excluded
+
+    PHASE_DURATION.observe(
+        60.0, virtual_host="other", exchange="dx_prefetch", phase=PHASE_HANDLER
+    )
+
+    assert handler_latency.sample() == 2.0
+    assert handler_latency.sample() is None
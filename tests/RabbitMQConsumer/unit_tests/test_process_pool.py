@@ -0,0 +1,92 @@
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from cyberfusion.RabbitMQConsumer.config import Exchange, ExchangeType, ExecutionMode
+from cyberfusion.RabbitMQConsumer.process_pool import get_handler_process_pools
+from cyberfusion.RabbitMQConsumer.registry import get_exchange_handlers
+from cyberfusion.RabbitMQHandlers.exchanges.dx_example import (
+    RPCRequestExample,
+    RPCResponseExample,
+)
+
+
+def test_handler_process_pool_replaces_crashed_workers() -> None:
+    exchanges = [
+        Exchange(
+            name="dx_example",
+            type=ExchangeType.DIRECT,
+            execution_mode=ExecutionMode.PROCESS,
+            processes=1,
+        )
+    ]
+
+    process_pools = get_handler_process_pools(
+        exchanges, get_exchange_handlers(exchanges)
+    )
+
+    process_pool = process_pools["dx_example"]
+
+    try:
+        request = RPCRequestExample(favourite_food="onion")
+
+        assert isinstance(process_pool.call(request), RPCResponseExample)
+
+        # Kill worker process. The pool breaks, and is replaced.
+
+        for process in process_pool._executor._processes.values():
+            os.kill(process.pid, signal.SIGKILL)
+
+        with pytest.raises(BrokenProcessPool):
+            process_pool.call(request)
+
+        assert isinstance(process_pool.call(request), RPCResponseExample)
+
+        assert process_pool.metrics.calls == 3
+        assert process_pool.metrics.crashes == 1
+    finally:
+        process_pool.shutdown()
+
+
+def test_handler_process_pool_timeout_excludes_waiting() -> None:
+    exchanges = [
+        Exchange(
+            name="dx_example",
+            type=ExchangeType.DIRECT,
+            execution_mode=ExecutionMode.PROCESS,
+            processes=1,
+        )
+    ]
+
+    process_pool = get_handler_process_pools(
+        exchanges, get_exchange_handlers(exchanges)
+    )["dx_example"]
+
+    try:
+        # Occupy the only worker process, so that the call waits for it longer
+        # than its timeout
+
+        process_pool._free.acquire()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(
+                process_pool.call,
+                RPCRequestExample(favourite_food="onion"),
+                timeout=2.0,
+            )
+
+            time.sleep(3.0)
+
+            assert not future.done()
+
+            process_pool._free.release()
+
+            assert isinstance(future.result(), RPCResponseExample)
+
+        assert process_pool.metrics.timeouts == 0
+    finally:
+        process_pool.shutdown()
@@ -0,0 +1,470 @@
+import dataclasses
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, List, Optional, Union
+from unittest.mock import MagicMock
+
+import pika
+import pytest
+import yaml
+from pydantic import ValidationError
+from pytest_mock import MockerFixture
+
+from cyberfusion.RabbitMQConsumer import processor as processor_module
+from cyberfusion.RabbitMQConsumer.config import Config
+from cyberfusion.RabbitMQConsumer.contracts import (
+    HandlerBase,
+    RPCRequestBase,
+    RPCResponseBase,
+)
+from cyberfusion.RabbitMQConsumer.idempotency import IdempotencyStore
+from cyberfusion.RabbitMQConsumer.locking import LockManager
+from cyberfusion.RabbitMQConsumer.processor import (
+    MESSAGE_TIMEOUT,
+    MESSAGE_UNEXPECTED_ERROR,
+    MESSAGE_VALIDATION_ERROR,
+    OUTCOME_REPLAYED,
+    Processor,
+    ProcessorBase,
+)
+from cyberfusion.RabbitMQConsumer.rabbitmq import RabbitMQ
+from cyberfusion.RabbitMQConsumer.registry import ExchangeHandler, get_exchange_handlers
+from cyberfusion.RabbitMQConsumer.single_flight import SingleFlight
+from cyberfusion.RabbitMQHandlers.exchanges.dx_example import (
+    RPCRequestExample,
+    RPCResponseDataExample,
+    RPCResponseExample,
+)
+
+CONFIG_FILE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "rabbitmq.yml"
+)
+
+
+class Handler(HandlerBase):
+    """Handler that records RPC requests it's called with.
+
+    Fails for onions, and is slow for oranges.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.requests: List[RPCRequestBase] = []
+
+    @property
+    def lock_attribute(self) -> str:
+        return "favourite_food"
+
+    def __call__(self, request: RPCRequestBase) -> RPCResponseBase:
+        assert isinstance(request, RPCRequestExample)
+
+        self.requests.append(request)
+
+        if request.favourite_food.value == "onion":
+            raise RuntimeError("Onions are intolerable")
+
+        if request.favourite_food.value == "orange":
+            time.sleep(0.5)
+
+        return RPCResponseExample(
+            success=True,
+            message="Determined toleration",
+            data=RPCResponseDataExample(tolerable=True),
+        )
+
+
+@pytest.fixture
+def config(tmp_path) -> Config:
+    path = str(tmp_path / "rabbitmq.yml")
+
+    shutil.copy(CONFIG_FILE_PATH, path)
+
+    with open(path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["mock"] = False
+
+    with open(path, "w") as f:
+        yaml.dump(contents, f)
+
+    return Config(path)
+
+
+@pytest.fixture
+def rabbitmq(config: Config, mocker: MockerFixture) -> RabbitMQ:
+    mocker.patch("pika.BlockingConnection")
+
+    return RabbitMQ("test", config)
+
+
+@pytest.fixture
+def channel() -> MagicMock:
+    channel = MagicMock()
+    channel.connection.add_callback_threadsafe.side_effect = lambda f: f()
+
+    return channel
+
+
+def get_exchange_handler(config: Config, handler: HandlerBase) -> ExchangeHandler:
+    exchange_handler = get_exchange_handlers(config.get_all_exchanges())["dx_example"]
+
+    return dataclasses.replace(exchange_handler, handler=handler)
+
+
+def get_processor(
+    rabbitmq: RabbitMQ,
+    channel: MagicMock,
+    exchange_handler: ExchangeHandler,
+    payload: Union[dict, bytes],
+    *,
+    lock_manager: Optional[LockManager] = None,
+    log_server_client: Optional[MagicMock] = None,
+    delivery_tag: int = 1,
+    correlation_id: Optional[str] = None,
+    redelivered: bool = False,
+    **kwargs: Any,
+) -> Processor:
+    return Processor(
+        exchange_handler=exchange_handler,
+        rabbitmq=rabbitmq,
+        channel=channel,
+        method=pika.spec.Basic.Deliver(
+            delivery_tag=delivery_tag,
+            exchange="dx_example",
+            redelivered=redelivered,
+        ),
+        properties=pika.spec.BasicProperties(
+            correlation_id=correlation_id or str(delivery_tag), reply_to="reply"
+        ),
+        lock_manager=lock_manager or LockManager(),
+        payload=payload,
+        log_server_client=log_server_client,
+        decrypted_values=[],
+        **kwargs,
+    )
+
+
+def get_published(channel: MagicMock) -> List[dict]:
+    return [
+        json.loads(call.kwargs["body"]) for call in channel.basic_publish.call_args_list
+    ]
+
+
+def get_published_by_correlation_id(channel: MagicMock) -> Dict[str, dict]:
+    return {
+        call.kwargs["properties"].correlation_id: json.loads(call.kwargs["body"])
+        for call in channel.basic_publish.call_args_list
+    }
+
+
+def get_acknowledged(channel: MagicMock) -> List[int]:
+    return [call.kwargs["delivery_tag"] for call in channel.basic_ack.call_args_list]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"favourite_food": "banana"},
+        b'{"favourite_food": "banana"}',
+    ],
+)
+def test_processor_validates_request_once(
+    config: Config,
+    rabbitmq: RabbitMQ,
+    channel: MagicMock,
+    mocker: MockerFixture,
+    payload: Union[dict, bytes],
+) -> None:
+    model_validate = mocker.spy(RPCRequestExample, "model_validate")
+    model_validate_json = mocker.spy(RPCRequestExample, "model_validate_json")
+
+    handler = Handler()
+
+    processor = get_processor(
+        rabbitmq, channel, get_exchange_handler(config, handler), payload
+    )
+
+    processor()
+
+    assert model_validate.call_count + model_validate_json.call_count == 1
+
+    # The handler gets the model that was validated
+
+    assert handler.requests == [processor.request]
+
+
+def test_processor_publishes_validation_failure_once(
+    config: Config, rabbitmq: RabbitMQ, channel: MagicMock
+) -> None:
+    handler = Handler()
+
+    with pytest.raises(ValidationError):
+        get_processor(
+            rabbitmq,
+            channel,
+            get_exchange_handler(config, handler),
+            {"favourite_food": "banana", "chance_percentage": -1},
+        )
+
+    published = get_published(channel)
+
+    assert len(published) == 1
+    assert not published[0]["success"]
+    assert published[0]["message"] == MESSAGE_VALIDATION_ERROR
+
+    # The consumer acknowledges the message, not the processor
+
+    channel.basic_ack.assert_not_called()
+
+    assert handler.requests == []
+
+
+def test_processor_serializes_response_once(
+    config: Config, rabbitmq: RabbitMQ, channel: MagicMock, mocker: MockerFixture
+) -> None:
+    serialize_model = mocker.spy(processor_module, "serialize_model")
+
+    log_server_client = MagicMock()
+
+    processor = get_processor(
+        rabbitmq,
+        channel,
+        get_exchange_handler(config, Handler()),
+        {"favourite_food": "banana"},
+        log_server_client=log_server_client,
+    )
+
+    processor()
+
+    assert serialize_model.call_count == 1
+
+    # The log server gets the published RPC response
+
+    body = channel.basic_publish.call_args.kwargs["body"]
+
+    assert body == serialize_model.spy_return
+
+    log_server_client.log_rpc_response.assert_called_once_with(
+        correlation_id="1", response_payload=json.loads(body), traceback=None
+    )
+
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+
+def process_single_flight(
+    config: Config,
+    rabbitmq: RabbitMQ,
+    channel: MagicMock,
+    handler: Handler,
+    payload: dict,
+    **kwargs: Any,
+) -> List[Processor]:
+    """Process leader, with two identical RPC requests received meanwhile."""
+    exchange_handler = get_exchange_handler(config, handler)
+
+    single_flight: SingleFlight[ProcessorBase] = SingleFlight()
+
+    processors = [
+        get_processor(
+            rabbitmq,
+            channel,
+            exchange_handler,
+            payload,
+            delivery_tag=delivery_tag,
+            single_flight=single_flight,
+            **kwargs,
+        )
+        for delivery_tag in (1, 2, 3)
+    ]
+
+    leader, *followers = processors
+
+    assert not leader.join_single_flight()
+
+    for follower in followers:
+        assert follower.join_single_flight()
+
+    leader()
+
+    assert single_flight.metrics.groups == 0
+
+    return processors
+
+
+def test_processor_single_flight_followers_publish_leader_response(
+    config: Config, rabbitmq: RabbitMQ, channel: MagicMock
+) -> None:
+    handler = Handler()
+
+    process_single_flight(
+        config, rabbitmq, channel, handler, {"favourite_food": "banana"}
+    )
+
+    assert len(handler.requests) == 1
+
+    published = get_published_by_correlation_id(channel)
+
+    assert sorted(published) == ["1", "2", "3"]
+    assert published["1"]["success"]
+    assert published["2"] == published["1"]
+    assert published["3"] == published["1"]
+
+    assert get_acknowledged(channel) == [1, 2, 3]
+
+
+@pytest.mark.parametrize(
+    "favourite_food,timeout,message",
+    [
+        ("onion", None, MESSAGE_UNEXPECTED_ERROR),
+        ("orange", 0.05, MESSAGE_TIMEOUT),
+    ],
+)
+def test_processor_single_flight_leader_fails(
+    config: Config,
+    rabbitmq: RabbitMQ,
+    channel: MagicMock,
+    favourite_food: str,
+    timeout: Optional[float],
+    message: str,
+) -> None:
+    handler = Handler()
+
+    processors = process_single_flight(
+        config,
+        rabbitmq,
+        channel,
+        handler,
+        {"favourite_food": favourite_food},
+        timeout=timeout,
+    )
+
+    assert len(handler.requests) == 1
+
+    # Followers get the leader's error RPC response, and are counted with its
+    # outcome
+
+    published = get_published_by_correlation_id(channel)
+
+    assert sorted(published) == ["1", "2", "3"]
+
+    for body in published.values():
+        assert not body["success"]
+        assert body["message"] == message
+
+    assert {processor.outcome for processor in processors} == {processors[0].outcome}
+    assert get_acknowledged(channel) == [1, 2, 3]
+
+
+def test_processor_single_flight_excludes_redelivered(
+    config: Config, rabbitmq: RabbitMQ, channel: MagicMock
+) -> None:
+    handler = Handler()
+
+    exchange_handler = get_exchange_handler(config, handler)
+
+    single_flight: SingleFlight[ProcessorBase] = SingleFlight()
+
+    leader = get_processor(
+        rabbitmq,
+        channel,
+        exchange_handler,
+        {"favourite_food": "banana"},
+        single_flight=single_flight,
+    )
+
+    assert not leader.join_single_flight()
+
+    # Redelivered messages may have to replay their own stored RPC response, so
+    # they're processed separately
+
+    redelivered = get_processor(
+        rabbitmq,
+        channel,
+        exchange_handler,
+        {"favourite_food": "banana"},
+        delivery_tag=2,
+        redelivered=True,
+        single_flight=single_flight,
+    )
+
+    assert not redelivered.join_single_flight()
+    assert single_flight.metrics.coalesced == 0
+
+    redelivered()
+    leader()
+
+    assert len(handler.requests) == 2
+    assert sorted(get_published_by_correlation_id(channel)) == ["1", "2"]
+    assert sorted(get_acknowledged(channel)) == [1, 2]
+
+
+def test_processor_replays_stored_response_on_redelivery(
+    config: Config, rabbitmq: RabbitMQ, channel: MagicMock
+) -> None:
+    handler = Handler()
+
+    exchange_handler = get_exchange_handler(config, handler)
+
+    idempotency_store = IdempotencyStore()
+
+    get_processor(
+        rabbitmq,
+        channel,
+        exchange_handler,
+        {"favourite_food": "banana"},
+        correlation_id="onion",
+        idempotency_store=idempotency_store,
+    )()
+
+    processor = get_processor(
+        rabbitmq,
+        channel,
+        exchange_handler,
+        {"favourite_food": "banana"},
+        delivery_tag=2,
+        correlation_id="onion",
+        redelivered=True,
+        idempotency_store=idempotency_store,
+    )
+
+    processor()
+
+    # The handler is not called again
+
+    assert len(handler.requests) == 1
+    assert processor.outcome == OUTCOME_REPLAYED
+
+    first, replayed = channel.basic_publish.call_args_list
+
+    assert replayed.kwargs["body"] == first.kwargs["body"]
+    assert replayed.kwargs["properties"].correlation_id == "onion"
+
+    assert get_acknowledged(channel) == [1, 2]
+
+
+def test_processor_does_not_replay_first_delivery(
+    config: Config, rabbitmq: RabbitMQ, channel: MagicMock
+) -> None:
+    handler = Handler()
+
+    idempotency_store = IdempotencyStore()
+
+    idempotency_store.set(("test", "dx_example", "onion"), b'{"success": false}')
+
+    processor = get_processor(
+        rabbitmq,
+        channel,
+        get_exchange_handler(config, handler),
+        {"favourite_food": "banana"},
+        correlation_id="onion",
+        idempotency_store=idempotency_store,
+    )
+
+    processor()
+
+    assert len(handler.requests) == 1
+    assert processor.outcome != OUTCOME_REPLAYED
+    assert get_published(channel)[0]["success"]
@@ -0,0 +1,118 @@
+import os
+import shutil
+from unittest.mock import MagicMock
+
+import pika
+import pytest
+import yaml
+from pika.adapters.blocking_connection import BlockingChannel
+from pytest_mock import MockerFixture
+
+from cyberfusion.RabbitMQConsumer.config import Config
+from cyberfusion.RabbitMQConsumer.rabbitmq import (
+    ConfirmTracker,
+    RabbitMQ,
+    get_channel_impl,
+)
+
+CONFIG_FILE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "rabbitmq.yml"
+)
+
+
+def get_connection(*args: object) -> MagicMock:
+    connection = MagicMock()
+
+    def get_channel() -> MagicMock:
+        return MagicMock(connection=connection)
+
+    connection.channel.side_effect = get_channel
+
+    return connection
+
+
+def test_confirm_tracker_counts_confirmations() -> None:
+    count_publish = MagicMock()
+
+    confirm_tracker = ConfirmTracker(count_publish)
+
+    for correlation_id in ("onion", "orange", "banana"):
+        confirm_tracker.track(correlation_id)
+
+    confirm_tracker.on_return(
+        MagicMock(),
+        pika.spec.Basic.Return(),
+        pika.spec.BasicProperties(correlation_id="orange"),
+        b"",
+    )
+    confirm_tracker.on_delivery_confirmation(
+        pika.frame.Method(1, pika.spec.Basic.Ack(delivery_tag=2, multiple=True))
+    )
+
+    assert confirm_tracker.unconfirmed == 1
+
+    confirm_tracker.on_delivery_confirmation(
+        pika.frame.Method(1, pika.spec.Basic.Nack(delivery_tag=3))
+    )
+
+    assert confirm_tracker.unconfirmed == 0
+
+    assert [call.kwargs for call in count_publish.call_args_list] == [
+        {"unroutable": 1},
+        {"published": 1},
+        {"nacked": 1},
+    ]
+
+
+def test_rabbitmq_opens_channels_per_connection(
+    tmp_path, mocker: MockerFixture
+) -> None:
+    path = str(tmp_path / "rabbitmq.yml")
+
+    shutil.copy(CONFIG_FILE_PATH, path)
+
+    with open(path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["virtual_hosts"]["test"]["connections"] = 2
+    contents["virtual_hosts"]["test"]["channels_per_connection"] = 3
+
+    with open(path, "w") as f:
+        yaml.dump(contents, f)
+
+    mocker.patch("pika.BlockingConnection", side_effect=get_connection)
+
+    rabbitmq = RabbitMQ("test", Config(path))
+
+    assert len(rabbitmq.connections) == 2
+    assert len(set(rabbitmq.channels)) == 6
+
+    for connection in rabbitmq.connections:
+        assert connection.channel.call_count == 3
+
+    for channel in rabbitmq.channels:
+        channel.basic_qos.assert_called_once_with(
+            prefetch_count=rabbitmq.prefetch_count
+        )
+
+    # Prefetch count is applied to every channel, in its own connection's thread
+
+    for connection in rabbitmq.connections:
+        connection.add_callback_threadsafe.side_effect = lambda f: f()
+
+    rabbitmq.set_prefetch_count(1)
+
+    for channel in rabbitmq.channels:
+        channel.basic_qos.assert_called_with(prefetch_count=1)
+        assert channel.connection.add_callback_threadsafe.call_count == 3
+
+
+def test_get_channel_impl() -> None:
+    channel_impl = pika.channel.Channel(MagicMock(), 1, MagicMock())
+
+    assert get_channel_impl(BlockingChannel(channel_impl, MagicMock())) is channel_impl
+
+    # Fail clearly if pika's internals changed
+
+    with pytest.raises(RuntimeError):
+        get_channel_impl(MagicMock(_impl=None))
@@ -0,0 +1,139 @@
+import os
+import shutil
+
+import pytest
+import yaml
+from cryptography.fernet import Fernet
+from docopt import DocoptExit
+from pytest_mock import MockerFixture
+
+from cyberfusion.RabbitMQConsumer.config import Config
+from cyberfusion.RabbitMQConsumer.consumer import Consumer
+from cyberfusion.RabbitMQConsumer.rabbitmq_consume import get_args, get_virtual_hosts
+from cyberfusion.RabbitMQConsumer.registry import get_exchange_handlers
+
+CONFIG_FILE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "rabbitmq.yml"
+)
+
+
+@pytest.fixture
+def config_file_path(tmp_path) -> str:
+    path = str(tmp_path / "rabbitmq.yml")
+
+    shutil.copy(CONFIG_FILE_PATH, path)
+
+    with open(path) as f:
+        contents = yaml.safe_load(f)
+
+    contents["virtual_hosts"]["other"] = {
+        **contents["virtual_hosts"]["test"],
+        "queue": "other",
+        "fernet_key": Fernet.generate_key().decode(),
+    }
+
+    with open(path, "w") as f:
+        yaml.dump(contents, f)
+
+    return path
+
+
+def test_get_args_repeated_virtual_host_name(config_file_path: str) -> None:
+    args = get_args(
+        [
+            "--virtual-host-name=test",
+            "--virtual-host-name=other",
+            f"--config-file-path={config_file_path}",
+        ]
+    )
+
+    assert args["--virtual-host-name"] == ["test", "other"]
+    assert not args["--all-virtual-hosts"]
+
+    virtual_hosts = get_virtual_hosts(Config(config_file_path), args)
+
+    assert [virtual_host.name for virtual_host in virtual_hosts] == ["test", "other"]
+
+
+def test_get_args_all_virtual_hosts(config_file_path: str) -> None:
+    args = get_args(["--all-virtual-hosts", f"--config-file-path={config_file_path}"])
+
+    assert args["--virtual-host-name"] == []
+    assert args["--all-virtual-hosts"]
+
+    virtual_hosts = get_virtual_hosts(Config(config_file_path), args)
+
+    assert {virtual_host.name for virtual_host in virtual_hosts} == {"test", "other"}
+
+
+def test_get_args_virtual_hosts_exclusive(config_file_path: str) -> None:
+    with pytest.raises(DocoptExit):
+        get_args(
+            [
+                "--virtual-host-name=test",
+                "--all-virtual-hosts",
+                f"--config-file-path={config_file_path}",
+            ]
+        )
+
+    with pytest.raises(DocoptExit):
+        get_args([f"--config-file-path={config_file_path}"])
+
+
+def test_consumers_isolated_per_virtual_host(
+    config_file_path: str, mocker: MockerFixture
+) -> None:
+    config = Config(config_file_path)
+
+    mocker.patch("pika.BlockingConnection")
+
+    exchange_handlers = get_exchange_handlers(config.get_all_exchanges())
+
+    consumers = [
+        Consumer(virtual_host_name, config, exchange_handlers, {})
+        for virtual_host_name in ("test", "other")
+    ]
+
+    try:
+        test_consumer, other_consumer = consumers
+
+        # Locks of one virtual host don't block RPC requests of another
+
+        key = ("dx_example", "onion")
+
+        test_consumer.lock_manager.acquire(key)
+
+        assert other_consumer.lock_manager.acquire(key) == 0.0
+
+        assert test_consumer.lock_manager.metrics.locks == 1
+        assert other_consumer.lock_manager.metrics.locks == 1
+
+        test_consumer.lock_manager.release(key)
+        other_consumer.lock_manager.release(key)
+
+        # Values encrypted with the Fernet key of one virtual host are only
+        # decrypted by its own decryptor
+
+        test_decryptor = test_consumer.rabbitmq.decryptor
+        other_decryptor = other_consumer.rabbitmq.decryptor
+
+        assert test_decryptor is not None
+        assert other_decryptor is not None
+
+        assert test_decryptor is not other_decryptor
+
+        token = (
+            Fernet(other_consumer.rabbitmq.fernet_keys[0]).encrypt(b"secret").decode()
+        )
+
+        assert other_decryptor.decrypt_payload({"password": token}) == (
+            {"password": "secret"},
+            ["password"],
+        )
+        assert test_decryptor.decrypt_payload({"password": token}) == (
+            {"password": token},
+            [],
+        )
+    finally:
+        for consumer in consumers:
+            consumer.drain()
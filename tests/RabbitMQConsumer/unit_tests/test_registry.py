@@ -0,0 +1,25 @@
+from cyberfusion.RabbitMQConsumer.config import Exchange, ExchangeType
+from cyberfusion.RabbitMQConsumer.registry import get_exchange_handlers
+from cyberfusion.RabbitMQHandlers.exchanges.dx_example import (
+    Handler,
+    RPCRequestExample,
+    RPCResponseExample,
+)
+
+
+def test_get_exchange_handlers() -> None:
+    exchange_handlers = get_exchange_handlers(
+        [
+            Exchange(name="dx_example", type=ExchangeType.DIRECT),
+            Exchange(name="dx_does_not_exist", type=ExchangeType.DIRECT),
+        ]
+    )
+
+    assert list(exchange_handlers) == ["dx_example"]
+
+    exchange_handler = exchange_handlers["dx_example"]
+
+    assert isinstance(exchange_handler.handler, Handler)
+    assert exchange_handler.request_model == RPCRequestExample
+    assert exchange_handler.response_model == RPCResponseExample
+    assert exchange_handler.lock_attribute == "favourite_food"
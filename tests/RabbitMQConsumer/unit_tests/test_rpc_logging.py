@@ -0,0 +1,44 @@
+import json
+import logging
+
+from cyberfusion.RabbitMQConsumer.rpc_logging import (
+    REDACTED_VALUE,
+    JSONFormatter,
+    LogBody,
+    RPCRequestLoggerAdapter,
+)
+
+
+def test_log_body_redacts_decrypted_values() -> None:
+    body = LogBody(
+        {"username": "onion", "password": "banana"},
+        max_size=1024,
+        decrypted_values=["password"],
+    )
+
+    assert json.loads(str(body)) == {"username": "onion", "password": REDACTED_VALUE}
+
+
+def test_log_body_truncates() -> None:
+    body = LogBody("a" * 10, max_size=4)
+
+    assert str(body) == "aaaa... (6 more characters)"
+
+
+def test_rpc_request_logger_adapter(caplog) -> None:
+    request_logger = RPCRequestLoggerAdapter(
+        logging.getLogger("test"), "dx_example", "onion"
+    )
+
+    with caplog.at_level(logging.INFO, logger="test"):
+        request_logger.info("Received RPC request")
+        request_logger.debug("Acquiring lock...")
+
+    (record,) = caplog.records
+
+    assert record.getMessage() == "[dx_example] [onion] Received RPC request"
+
+    formatted = json.loads(JSONFormatter().format(record))
+
+    assert formatted["exchange"] == "dx_example"
+    assert formatted["correlation_id"] == "onion"
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+from typing import List
+
+from cyberfusion.RabbitMQConsumer.scheduler import (
+    AsyncioPrioritySemaphore,
+    KeyedScheduler,
+)
+from cyberfusion.RabbitMQConsumer.worker_pool import WorkerPool
+
+
+def test_keyed_scheduler_runs_other_keys_while_key_is_blocked() -> None:
+    worker_pool = WorkerPool(2)
+    scheduler = KeyedScheduler(worker_pool)
+
+    release = threading.Event()
+    other_key_ran = threading.Event()
+
+    results = []
+
+    scheduler.submit(("dx_example", "onion"), release.wait)
+
+    # Without scheduling per key, these would occupy the second worker
+
+    for number in range(3):
+        scheduler.submit(
+            ("dx_example", "onion"), lambda number=number: results.append(number)
+        )
+
+    scheduler.submit(("dx_example", "banana"), other_key_ran.set)
+
+    assert other_key_ran.wait(timeout=5)
+    assert results == []
+    assert scheduler.metrics.waiting == 3
+
+    release.set()
+
+    worker_pool.shutdown(wait=True)
+
+    assert results == [0, 1, 2]
+    assert scheduler.metrics.keys == 0
+
+
+def test_keyed_scheduler_limits_exchange() -> None:
+    worker_pool = WorkerPool(3)
+    scheduler = KeyedScheduler(worker_pool, limits={"dx_example": 1})
+
+    release = threading.Event()
+    other_exchange_ran = threading.Event()
+
+    results = []
+
+    scheduler.submit(("dx_example", "onion"), release.wait)
+
+    # Different key, but same exchange, so waits for the limit
+
+    scheduler.submit(("dx_example", "banana"), lambda: results.append("banana"))
+
+    scheduler.submit(("dx_other", "onion"), other_exchange_ran.set)
+
+    assert other_exchange_ran.wait(timeout=5)
+    assert results == []
+    assert scheduler.metrics.limited == 1
+
+    release.set()
+
+    worker_pool.shutdown(wait=True)
+
+    assert results == ["banana"]
+    assert scheduler.metrics.limited == 0
+
+
+def test_keyed_scheduler_runs_higher_priority_first() -> None:
+    worker_pool = WorkerPool(1)
+    scheduler = KeyedScheduler(worker_pool, limits={"dx_example": 1})
+
+    release = threading.Event()
+
+    results = []
+
+    scheduler.submit(("dx_example", "onion"), release.wait)
+
+    for priority, key in [(1, "banana"), (5, "apple"), (3, "cherry")]:
+        scheduler.submit(
+            ("dx_example", key), lambda key=key: results.append(key), priority=priority
+        )
+
+    release.set()
+
+    worker_pool.shutdown(wait=True)
+
+    assert results == ["apple", "cherry", "banana"]
+
+
+def test_asyncio_priority_semaphore_wakes_higher_priority_first() -> None:
+    async def main() -> List[str]:
+        semaphore = AsyncioPrioritySemaphore(1)
+
+        results: List[str] = []
+
+        async def run(key: str, priority: int) -> None:
+            async with semaphore.hold(priority=priority):
+                results.append(key)
+
+        await semaphore.acquire()
+
+        tasks = [
+            asyncio.create_task(run(key, priority))
+            for priority, key in [(1, "banana"), (5, "apple"), (3, "cherry")]
+        ]
+
+        cancelled = asyncio.create_task(run("onion", 10))
+
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+
+        assert semaphore.waiting == 3
+
+        semaphore.release()
+
+        await asyncio.gather(*tasks)
+
+        return results
+
+    assert asyncio.run(main()) == ["apple", "cherry", "banana"]
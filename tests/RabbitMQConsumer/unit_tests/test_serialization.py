@@ -0,0 +1,19 @@
+import json
+
+import pytest
+
+from cyberfusion.RabbitMQConsumer.config import JSONBackend
+from cyberfusion.RabbitMQConsumer.contracts import RPCResponseBase
+from cyberfusion.RabbitMQConsumer.serialization import get_loads, serialize_model
+
+
+@pytest.mark.parametrize("backend", list(JSONBackend))
+def test_serialize_model_round_trips(backend: JSONBackend) -> None:
+    pytest.importorskip(backend.value)
+
+    response = RPCResponseBase(success=True, message="onion", data=None)
+
+    body = serialize_model(response)
+
+    assert body == response.model_dump_json().encode()
+    assert get_loads(backend)(body) == json.loads(response.model_dump_json())
@@ -0,0 +1,21 @@
+from cyberfusion.RabbitMQConsumer.single_flight import SingleFlight
+
+
+def test_single_flight_groups_identical_requests() -> None:
+    single_flight: SingleFlight[str] = SingleFlight()
+
+    assert not single_flight.join("onion", "leader")
+    assert single_flight.join("onion", "follower-1")
+    assert single_flight.join("onion", "follower-2")
+    assert not single_flight.join("orange", "other-leader")
+
+    assert single_flight.complete("onion") == ["follower-1", "follower-2"]
+
+    # Once completed, the next identical request starts a new group
+
+    assert not single_flight.join("onion", "new-leader")
+
+    metrics = single_flight.metrics
+
+    assert metrics.groups == 2
+    assert metrics.coalesced == 2
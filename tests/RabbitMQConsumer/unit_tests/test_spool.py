@@ -0,0 +1,55 @@
+import os
+
+from cyberfusion.RabbitMQConsumer.spool import Spool
+
+
+def test_spool_survives_restart(tmp_path) -> None:
+    spool = Spool(str(tmp_path), max_segment_size=1)
+
+    spool.append([{"number": 1}])
+    spool.append([{"number": 2}, {"number": 3}])
+
+    spool = Spool(str(tmp_path), max_segment_size=1)
+
+    assert not spool.is_empty
+
+    path, records = spool.read_oldest_segment()
+
+    assert records == [{"number": 1}]
+
+    spool.remove_segment(path)
+
+    path, records = spool.read_oldest_segment()
+
+    assert records == [{"number": 2}, {"number": 3}]
+
+    spool.remove_segment(path)
+
+    assert spool.is_empty
+    assert spool.read_oldest_segment() is None
+
+
+def test_spool_ignores_partially_written_record(tmp_path) -> None:
+    spool = Spool(str(tmp_path))
+
+    spool.append([{"number": 1}, {"number": 2}])
+
+    path, _ = spool.read_oldest_segment()
+
+    os.truncate(path, os.path.getsize(path) - 1)
+
+    _, records = Spool(str(tmp_path)).read_oldest_segment()
+
+    assert records == [{"number": 1}]
+
+
+def test_spool_removes_oldest_segments_when_full(tmp_path) -> None:
+    spool = Spool(str(tmp_path), max_size=40, max_segment_size=1)
+
+    for number in range(5):
+        spool.append([{"number": number}])
+
+    _, records = spool.read_oldest_segment()
+
+    assert records == [{"number": 3}]
+    assert spool.metrics.size <= 40
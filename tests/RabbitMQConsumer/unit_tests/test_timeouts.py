@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from cyberfusion.RabbitMQConsumer.exceptions import HandlerTimeoutError
+from cyberfusion.RabbitMQConsumer.timeouts import TimeoutTracker
+
+
+def test_timeout_tracker_returns_result() -> None:
+    timeout_tracker = TimeoutTracker()
+
+    assert timeout_tracker.call(lambda: "onion", 1.0, name="Handler") == "onion"
+
+
+def test_timeout_tracker_reuses_threads() -> None:
+    timeout_tracker = TimeoutTracker()
+
+    thread_names = [
+        timeout_tracker.call(
+            lambda: threading.current_thread().name, 1.0, name=f"Handler-{i}"
+        )
+        for i in range(2)
+    ]
+
+    assert thread_names == ["Handler-0", "Handler-1"]
+
+    # The same idle thread is used for both calls
+
+    idle_threads = list(timeout_tracker._idle)
+
+    assert len(idle_threads) == 1
+
+    timeout_tracker.close()
+
+    idle_threads[0].join()
+
+
+def test_timeout_tracker_raises_exception() -> None:
+    timeout_tracker = TimeoutTracker()
+
+    def fail() -> None:
+        raise ValueError("banana")
+
+    with pytest.raises(ValueError, match="banana"):
+        timeout_tracker.call(fail, 1.0, name="Handler")
+
+
+def test_timeout_tracker_quarantines_thread() -> None:
+    timeout_tracker = TimeoutTracker()
+
+    event = threading.Event()
+
+    with pytest.raises(HandlerTimeoutError):
+        timeout_tracker.call(event.wait, 0.01, name="Handler")
+
+    timeout_tracker.count("dx_example")
+
+    metrics = timeout_tracker.metrics
+
+    assert metrics.timeouts == {"dx_example": 1}
+    assert metrics.quarantined == 1
+
+    # Once the thread finishes, it's no longer quarantined
+
+    event.set()
+
+    for thread in threading.enumerate():
+        if thread.name == "Handler":
+            thread.join()
+
+    assert timeout_tracker.metrics.quarantined == 0
@@ -0,0 +1,91 @@
+import json
+
+from cyberfusion.RabbitMQConsumer.tracing import (
+    NULL_TRACE,
+    STATUS_ERROR,
+    Tracer,
+    get_trace_id,
+)
+
+
+def test_tracer_writes_trace(tmp_path) -> None:
+    path = str(tmp_path / "traces.jsonl")
+
+    tracer = Tracer()
+    tracer.configure(path)
+
+    trace = tracer.start_trace("onion", {"rpc.exchange": "dx_example"})
+
+    with trace.span("handler"):
+        pass
+
+    trace.set_error()
+    trace.finish()
+    trace.finish()
+
+    tracer.close()
+
+    with open(path) as f:
+        lines = f.readlines()
+
+    assert len(lines) == 1
+
+    root_span, span = json.loads(lines[0])["spans"]
+
+    assert root_span["traceId"] == span["traceId"] == get_trace_id("onion")
+    assert root_span["name"] == "rpc_request"
+    assert root_span["status"] == {"code": STATUS_ERROR}
+    assert {"key": "rpc.correlation_id", "value": {"stringValue": "onion"}} in (
+        root_span["attributes"]
+    )
+
+    assert span["name"] == "handler"
+    assert span["parentSpanId"] == root_span["spanId"]
+    assert root_span["startTimeUnixNano"] <= span["startTimeUnixNano"]
+    assert span["startTimeUnixNano"] <= span["endTimeUnixNano"]
+    assert span["endTimeUnixNano"] <= root_span["endTimeUnixNano"]
+
+
+def test_tracer_samples(tmp_path) -> None:
+    tracer = Tracer()
+
+    assert tracer.start_trace("onion", {}) is NULL_TRACE
+
+    tracer.configure(str(tmp_path / "traces.jsonl"), sample_rate=0)
+
+    assert tracer.start_trace("onion", {}) is NULL_TRACE
+
+    tracer.close()
+
+
+def test_tracer_without_correlation_id(tmp_path) -> None:
+    path = str(tmp_path / "traces.jsonl")
+
+    tracer = Tracer()
+    tracer.configure(path)
+
+    tracer.start_trace(None, {"rpc.exchange": "dx_example"}).finish()
+    tracer.start_trace(None, {"rpc.exchange": "dx_example"}).finish()
+
+    tracer.close()
+
+    with open(path) as f:
+        root_spans = [json.loads(line)["spans"][0] for line in f]
+
+    assert root_spans[0]["traceId"] != root_spans[1]["traceId"]
+    assert all(
+        attribute["key"] != "rpc.correlation_id"
+        for attribute in root_spans[0]["attributes"]
+    )
+
+
+def test_tracer_failure_not_raised(tmp_path) -> None:
+    tracer = Tracer()
+    tracer.configure(str(tmp_path / "traces.jsonl"))
+
+    trace = tracer.start_trace("onion", {})
+    trace.root_span.attributes["rpc.exchange"] = object()  # type: ignore[assignment]
+
+    trace.finish()
+
+    tracer.close()
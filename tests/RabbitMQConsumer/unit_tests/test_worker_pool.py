@@ -0,0 +1,87 @@
+import threading
+
+from cyberfusion.RabbitMQConsumer.worker_pool import WorkerPool
+
+
+def test_worker_pool_processes_queued_work_items_before_shutdown() -> None:
+    results = []
+
+    worker_pool = WorkerPool(2)
+
+    for number in range(10):
+        assert worker_pool.submit(lambda number=number: results.append(number))
+
+    worker_pool.shutdown(wait=True)
+
+    assert sorted(results) == list(range(10))
+    assert worker_pool.metrics.completed == 10
+    assert worker_pool.metrics.active == 0
+    assert worker_pool.metrics.queued == 0
+
+
+def test_worker_pool_rejects_after_shutdown() -> None:
+    worker_pool = WorkerPool(1)
+
+    worker_pool.shutdown(wait=True)
+
+    assert not worker_pool.submit(lambda: None)
+    assert worker_pool.metrics.rejected == 1
+
+
+def test_worker_pool_survives_exception_in_work_item() -> None:
+    event = threading.Event()
+
+    def raise_exception() -> None:
+        raise Exception
+
+    worker_pool = WorkerPool(1)
+
+    worker_pool.submit(raise_exception)
+    worker_pool.submit(event.set)
+
+    assert event.wait(timeout=5)
+
+    worker_pool.shutdown(wait=True)
+
+    assert worker_pool.metrics.completed == 2
+
+
+def test_worker_pool_resizes() -> None:
+    barrier = threading.Barrier(3)
+
+    worker_pool = WorkerPool(1)
+
+    worker_pool.resize(3)
+
+    # Only completes if three work items run simultaneously
+
+    for _ in range(3):
+        worker_pool.submit(lambda: barrier.wait(timeout=5))
+
+    worker_pool.resize(1)
+
+    worker_pool.shutdown(wait=True)
+
+    assert worker_pool.metrics.completed == 3
+    assert worker_pool.metrics.size == 1
+
+
+def test_worker_pool_runs_higher_priority_first() -> None:
+    release = threading.Event()
+
+    results = []
+
+    worker_pool = WorkerPool(1)
+
+    worker_pool.submit(release.wait)
+
+    for priority in [1, 5, 3]:
+        worker_pool.submit(
+            lambda priority=priority: results.append(priority), priority=priority
+        )
+
+    release.set()
+
+    worker_pool.shutdown(wait=True)
+
+    assert results == [5, 3, 1]